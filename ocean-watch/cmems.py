@@ -0,0 +1,555 @@
+'''
+Shared helpers for retrieving Copernicus Marine (CMEMS) global biogeochemistry data
+for river mouths
+Imported by the river-mouths scripts in this directory
+'''
+import asyncio
+import concurrent.futures
+import functools
+import json
+import logging
+import os
+import random
+import re
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import dateutil.relativedelta
+import numpy as np
+import pandas as pd
+import requests
+from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+
+logger = logging.getLogger(__name__)
+
+# monthly global biogeochemical analysis and forecast, 1/4 degree
+DATASET_ID = 'global-analysis-forecast-bio-001-028-monthly'
+WMS_ENDPOINT = 'https://nrt.cmems-du.eu/thredds/wms/' + DATASET_ID
+NCSS_ENDPOINT = 'https://nrt.cmems-du.eu/thredds/ncss/' + DATASET_ID
+
+# first month of the series collected for each river mouth
+SERIES_START = '2019-01-16'
+
+# prepare request parameters
+variables = [
+    'o2',
+    'no3',
+    'po4'
+]
+depths = [
+    -0.49402499198913574,
+    -1.5413750410079956,
+    -2.6456689834594727,
+    -3.8194949626922607,
+    -5.078224182128906,
+]
+
+# model grid: cell centres every quarter degree, aligned on whole degrees
+GRID_STEP = 0.25
+GRID_LON0 = -180.0
+GRID_LAT0 = -80.0
+
+def grid_cell(x, y):
+    '''
+    Model grid cell containing each point, as numbered by iIndex/jIndex in WMS responses
+    INPUT   x, y: longitudes and latitudes of points (numeric or array-like)
+    RETURN  i, j: column and row of cell containing each point (int or int arrays)
+    '''
+    i = np.rint((np.asarray(x, dtype='float64') - GRID_LON0) / GRID_STEP).astype('int64')
+    j = np.rint((np.asarray(y, dtype='float64') - GRID_LAT0) / GRID_STEP).astype('int64')
+    # longitude wraps around at the antimeridian
+    i = np.mod(i, int(round(360 / GRID_STEP)))
+    return i, j
+
+def grid_centre(x, y):
+    '''
+    Centre of model grid cell containing each point
+    INPUT   x, y: longitudes and latitudes of points (numeric or array-like)
+    RETURN  cell_x, cell_y: longitudes and latitudes of cell centres (float or float arrays)
+    '''
+    i, j = grid_cell(x, y)
+    return GRID_LON0 + i * GRID_STEP, GRID_LAT0 + j * GRID_STEP
+
+def check_grid(parsed, x, y):
+    '''
+    Confirm that the assumed model grid numbers cells as the server does, by comparing
+    the cell and centre it gives for a point with those of grid_cell and grid_centre
+    INPUT   parsed: GetFeatureInfo response for the point, from parse_feature_info (dictionary)
+            x, y: long/lat coordinates requested (numeric)
+    RETURN  None; raises ValueError if the grids disagree
+    '''
+    i, j = grid_cell(x, y)
+    cell_x, cell_y = grid_centre(x, y)
+    if (parsed['iIndex'], parsed['jIndex']) != (int(i), int(j)) or \
+            not np.allclose([parsed['gridCentreLon'], parsed['gridCentreLat']], [cell_x, cell_y]):
+        raise ValueError('Model grid differs from GRID_LON0={}, GRID_LAT0={}, GRID_STEP={}: server gives cell '
+                '({}, {}) centred at ({}, {}) for ({}, {}), expected ({}, {}) centred at ({}, {})'.format(
+                GRID_LON0, GRID_LAT0, GRID_STEP, parsed['iIndex'], parsed['jIndex'], parsed['gridCentreLon'],
+                parsed['gridCentreLat'], x, y, int(i), int(j), cell_x, cell_y))
+
+def series_end(now=None):
+    '''
+    Last month available for the whole series: the 16th of the month before last,
+    or of the month before that early in the month
+    INPUT   now: time from which to judge; current UTC time if not provided (datetime)
+    RETURN  date_end: date of last monthly value, as YYYY-MM-DD (string)
+    '''
+    if now is None:
+        now = datetime.utcnow()
+    dt_end = now.replace(day=16)
+    months_ago = 2 if (now.day > 16) else 3
+    dt_end = dt_end - dateutil.relativedelta.relativedelta(months=months_ago)
+    return dt_end.strftime('%Y-%m-%d')
+
+def next_month(dt):
+    '''
+    Date of the monthly value following a given one; values fall on the 16th
+    INPUT   dt: date of a monthly value (datetime or Timestamp)
+    RETURN  date_next: date of following value, as YYYY-MM-DD (string)
+    '''
+    dt_next = pd.Timestamp(dt).replace(day=16) + dateutil.relativedelta.relativedelta(months=1)
+    return dt_next.strftime('%Y-%m-%d')
+
+def build_wms_request(x, y, variable, depth, date_start=SERIES_START, date_end=None):
+    '''
+    Create GetFeatureInfo request for the time series at a point
+    INPUT   x, y: long/lat coordinates of point (numeric)
+            variable: model variable, e.g. 'o2' (string)
+            depth: model depth, negative downward (numeric)
+            date_start: first monthly value, as YYYY-MM-DD (string)
+            date_end: last monthly value, as YYYY-MM-DD; series_end() if not provided (string)
+    RETURN  req: request url (string)
+    '''
+    xmin = x-0.0
+    ymin = y-0.0
+    xmax = x+0.0000001
+    ymax = y+0.0000001
+    if date_end is None:
+        date_end = series_end()
+    req_template = (
+        WMS_ENDPOINT + '?'
+        'SERVICE=WMS'
+        '&VERSION=1.1.1'
+        '&REQUEST=GetFeatureInfo'
+        '&QUERY_LAYERS={variable}'
+        '&BBOX={xmin},{ymin},{xmax},{ymax}'
+        '&HEIGHT=1'
+        '&WIDTH=1'
+        '&INFO_FORMAT=text/xml'
+        '&SRS=EPSG:4326'
+        '&X=0'
+        '&Y=0'
+        '&elevation={depth}'
+        '&time={date_start}T12:00:00.000Z/{date_end}T12:00:00.000Z'
+    )
+    return req_template.format(variable=variable, xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax,
+        depth=depth, date_start=date_start, date_end=date_end)
+
+# GetFeatureInfo responses are small, flat documents; pull out the few elements
+# needed with regular expressions rather than building an element tree
+_FEATURE_INFO_SCALARS = {
+    'longitude': (re.compile(rb'<longitude>\s*([^<]*?)\s*</longitude>'), float),
+    'latitude': (re.compile(rb'<latitude>\s*([^<]*?)\s*</latitude>'), float),
+    'iIndex': (re.compile(rb'<iIndex>\s*([^<]*?)\s*</iIndex>'), int),
+    'jIndex': (re.compile(rb'<jIndex>\s*([^<]*?)\s*</jIndex>'), int),
+    'gridCentreLon': (re.compile(rb'<gridCentreLon>\s*([^<]*?)\s*</gridCentreLon>'), float),
+    'gridCentreLat': (re.compile(rb'<gridCentreLat>\s*([^<]*?)\s*</gridCentreLat>'), float),
+}
+_FEATURE_INFO_TIME = re.compile(rb'<time>\s*([^<]*?)\s*</time>')
+_FEATURE_INFO_VALUE = re.compile(rb'<value>\s*([^<]*?)\s*</value>')
+# columns of frames built from GetFeatureInfo responses, in order
+FEATURE_INFO_COLUMNS = ['longitude','latitude','gridCentreLon','gridCentreLat','dt','value']
+
+def parse_feature_info(content):
+    '''
+    Extract location and time series from GetFeatureInfo response to Copernicus WMS
+    INPUT   content: body of response (bytes or string)
+    RETURN  parsed: 'longitude', 'latitude', 'iIndex', 'jIndex', 'gridCentreLon' and
+                'gridCentreLat' as scalars, 'dt' and 'value' as arrays; None if there is
+                no data at the location (ie invalid coordinates) (dictionary)
+    '''
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    values = _FEATURE_INFO_VALUE.findall(content)
+    if b'none' in values:
+        # legitimate request, but no data available at this location
+        return None
+    parsed = {}
+    for key, (pattern, cast) in _FEATURE_INFO_SCALARS.items():
+        match = pattern.search(content)
+        parsed[key] = cast(match.group(1)) if match is not None else None
+    times = _FEATURE_INFO_TIME.findall(content)
+    if len(times) != len(values):
+        raise ValueError('Mismatched times and values in GetFeatureInfo response')
+    # numpy parses ISO 8601 timestamps directly, once the UTC designator is dropped
+    parsed['dt'] = np.char.rstrip(np.array(times, dtype='S'), b'Z').astype('datetime64[ns]')
+    parsed['value'] = np.array(values, dtype='float64')
+    return parsed
+
+def feature_info_frame(parsed):
+    '''
+    Build structured data object from parsed GetFeatureInfo response
+    INPUT   parsed: output of parse_feature_info (dictionary)
+    RETURN  df_resp: one row per month, with FEATURE_INFO_COLUMNS (DataFrame)
+    '''
+    n = len(parsed['value'])
+    return pd.DataFrame({
+        'longitude': np.full(n, parsed['longitude'], dtype='float64'),
+        'latitude': np.full(n, parsed['latitude'], dtype='float64'),
+        'gridCentreLon': np.full(n, parsed['gridCentreLon'], dtype='float64'),
+        'gridCentreLat': np.full(n, parsed['gridCentreLat'], dtype='float64'),
+        'dt': parsed['dt'],
+        'value': parsed['value'],
+    }, columns=FEATURE_INFO_COLUMNS)
+
+def parse_response(response):
+    '''
+    Parse content of response from GetFeatureInfo query to Copernicus WMS
+    INPUT   response: raw response object from requests library (requests.models.Response)
+    RETURN  df_resp: structured data object for response; None if unable to parse (DataFrame)
+    '''
+    if response.status_code != 200:
+        return None
+    parsed = parse_feature_info(response.content)
+    if parsed is None:
+        return None
+    return feature_info_frame(parsed)
+
+def parse_responses(contents):
+    '''
+    Parse many GetFeatureInfo responses into a single frame, building it once
+    rather than one frame per response
+    INPUT   contents: bodies of responses (iterable of bytes or strings)
+    RETURN  df: rows of every response with data, with FEATURE_INFO_COLUMNS plus
+                'response' (position in contents), and 'iIndex' and 'jIndex' as Int64 (DataFrame)
+            invalid: positions of responses without data at their location (list of int)
+    '''
+    parts = []
+    invalid = []
+    for position, content in enumerate(contents):
+        parsed = parse_feature_info(content)
+        if parsed is None:
+            invalid.append(position)
+            continue
+        parts.append((position, parsed))
+    counts = np.array([len(parsed['value']) for _, parsed in parts], dtype='int64')
+
+    def repeat(key, dtype):
+        # one scalar per response, repeated for each of its months
+        return np.repeat(np.array([parsed[key] for _, parsed in parts], dtype=dtype), counts)
+
+    def repeat_index(key):
+        # grid indices are exact integers; missing ones stay missing rather than becoming NaN
+        present = np.array([parsed[key] is not None for _, parsed in parts], dtype=bool)
+        values = np.array([parsed[key] if parsed[key] is not None else 0 for _, parsed in parts], dtype='int64')
+        return pd.arrays.IntegerArray(np.repeat(values, counts), np.repeat(~present, counts))
+
+    df = pd.DataFrame({
+        'response': np.repeat(np.array([position for position, _ in parts], dtype='int64'), counts),
+        'longitude': repeat('longitude', 'float64'),
+        'latitude': repeat('latitude', 'float64'),
+        'gridCentreLon': repeat('gridCentreLon', 'float64'),
+        'gridCentreLat': repeat('gridCentreLat', 'float64'),
+        'iIndex': repeat_index('iIndex'),
+        'jIndex': repeat_index('jIndex'),
+        'dt': np.concatenate([parsed['dt'] for _, parsed in parts]) if parts else np.array([], dtype='datetime64[ns]'),
+        'value': np.concatenate([parsed['value'] for _, parsed in parts]) if parts else np.array([], dtype='float64'),
+    })
+    return df, invalid
+
+def build_subset_request(variable, depth, date_start, date_end, bbox=None):
+    '''
+    Create NetCDF Subset Service request for one variable at one depth over a time window
+    INPUT   variable: model variable, e.g. 'o2' (string)
+            depth: model depth, negative downward as in WMS requests (numeric)
+            date_start, date_end: first and last monthly values, as YYYY-MM-DD (string)
+            bbox: (west, south, east, north) to subset; whole globe if not provided (tuple)
+    RETURN  req: request url (string)
+    '''
+    west, south, east, north = bbox if bbox is not None else (-180, -90, 180, 90)
+    req_template = (
+        NCSS_ENDPOINT + '?'
+        'var={variable}'
+        '&north={north}&south={south}&west={west}&east={east}'
+        '&horizStride=1'
+        '&vertCoord={vert}'
+        '&time_start={date_start}T12:00:00Z'
+        '&time_end={date_end}T12:00:00Z'
+        '&accept=netcdf'
+    )
+    # wms elevation is negative downward; the netcdf depth axis is positive
+    return req_template.format(variable=variable, north=north, south=south, west=west, east=east,
+            vert=abs(depth), date_start=date_start, date_end=date_end)
+
+def download_subset(variable, depth, date_start, date_end, cache_dir, bbox=None, timeout=(30, 300)):
+    '''
+    Download gridded field for one variable at one depth, reusing an earlier download
+    of the same subset if there is one
+    Credentials are read from CMEMS_USER and CMEMS_PASSWORD, if set
+    INPUT   variable, depth, date_start, date_end, bbox: see build_subset_request
+            cache_dir: directory in which to keep downloaded subsets (string)
+            timeout: seconds to wait to connect, and for each part of the transfer; a
+                stalled transfer raises requests.Timeout (tuple)
+    RETURN  path: location of NetCDF file (string)
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    bbox_label = 'global' if bbox is None else '_'.join('{:g}'.format(b) for b in bbox)
+    path = os.path.join(cache_dir, '{}_{:.4f}_{}_{}_{}.nc'.format(
+            variable, abs(depth), date_start, date_end, bbox_label))
+    if os.path.isfile(path):
+        logger.debug('Using cached subset: ' + path)
+        return path
+    req = build_subset_request(variable, depth, date_start, date_end, bbox)
+    auth = None
+    if os.getenv('CMEMS_USER') is not None:
+        auth = (os.getenv('CMEMS_USER'), os.getenv('CMEMS_PASSWORD'))
+    logger.info('Download subset: ' + req)
+    part = path + '.part'
+    with requests.get(req, auth=auth, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        with open(part, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=1024*1024):
+                f.write(chunk)
+    # only complete downloads end up in the cache
+    os.replace(part, path)
+    return path
+
+def sample_subset(path, variable, x, y):
+    '''
+    Sample gridded field at many points at once, taking the nearest model cell to each
+    INPUT   path: NetCDF file from download_subset (string)
+            variable: model variable in file (string)
+            x, y: longitudes and latitudes of points (array-like)
+    RETURN  df: one row per point and month, with columns 'point' (position in x/y),
+                'longitude', 'latitude', 'gridCentreLon', 'gridCentreLat', 'dt', 'value';
+                points on land or otherwise outside the model have NaN values (DataFrame)
+    '''
+    # imported here so that xarray is only required by the gridded mode
+    import xarray as xr
+
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    with xr.open_dataset(path) as ds:
+        da = ds[variable]
+        if 'depth' in da.dims:
+            da = da.isel(depth=0)
+        # vectorized nearest-cell lookup along each axis
+        sampled = da.sel(longitude=xr.DataArray(x, dims='point'),
+                latitude=xr.DataArray(y, dims='point'), method='nearest')
+        values = sampled.transpose('time', 'point').values
+        times = pd.to_datetime(sampled['time'].values)
+        cell_x = sampled['longitude'].values
+        cell_y = sampled['latitude'].values
+    n_times, n_points = values.shape
+    df = pd.DataFrame({
+        'point': np.tile(np.arange(n_points), n_times),
+        'longitude': np.tile(x, n_times),
+        'latitude': np.tile(y, n_times),
+        'gridCentreLon': np.tile(cell_x, n_times),
+        'gridCentreLat': np.tile(cell_y, n_times),
+        'dt': np.repeat(times, n_points),
+        'value': values.reshape(-1),
+    })
+    return df
+
+
+def _unit_vectors(lon, lat):
+    # points on the unit sphere, so that straight-line neighbours are true neighbours
+    # across the antimeridian and at every latitude
+    lon = np.radians(np.asarray(lon, dtype='float64'))
+    lat = np.radians(np.asarray(lat, dtype='float64'))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+def nearest_valid_cells(path, variable, x, y):
+    '''
+    Find, for each point, the nearest model cell with data, using the cells with values
+    in a gridded subset as the model's ocean mask
+    INPUT   path: NetCDF file from download_subset (string)
+            variable: model variable in file (string)
+            x, y: longitudes and latitudes of points (array-like)
+    RETURN  df: one row per point, with 'valid' (whether the point's own cell has data),
+                'cell_x'/'cell_y' (centre of nearest cell with data) and 'distance_km'
+                (from point to that centre) (DataFrame)
+    '''
+    # imported here so that xarray and scipy are only required when searching the mask
+    import xarray as xr
+    from scipy.spatial import cKDTree
+
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    with xr.open_dataset(path) as ds:
+        da = ds[variable]
+        if 'depth' in da.dims:
+            da = da.isel(depth=0)
+        if 'time' in da.dims:
+            da = da.isel(time=0)
+        da = da.transpose('latitude', 'longitude')
+        ocean = np.isfinite(da.values)
+        lons = da['longitude'].values
+        lats = da['latitude'].values
+        own = da.sel(longitude=xr.DataArray(x, dims='point'),
+                latitude=xr.DataArray(y, dims='point'), method='nearest').values
+    rows, cols = np.nonzero(ocean)
+    cell_x, cell_y = lons[cols], lats[rows]
+    tree = cKDTree(_unit_vectors(cell_x, cell_y))
+    chord, nearest = tree.query(_unit_vectors(x, y))
+    # chord length on the unit sphere to great-circle distance
+    distance_km = 2 * 6371.0 * np.arcsin(np.clip(chord / 2, 0, 1))
+    return pd.DataFrame({
+        'valid': np.isfinite(own),
+        'cell_x': cell_x[nearest],
+        'cell_y': cell_y[nearest],
+        'distance_km': distance_km,
+    })
+
+
+class RequestFailed(Exception):
+    '''Request could not be completed, whether after retries or because retrying cannot help'''
+
+
+class WMSClient:
+    '''
+    Run many independent requests to the Copernicus servers as asyncio tasks, each
+    retried with exponential backoff and jitter up to a fixed number of attempts, so
+    that a run finishes in bounded time however many requests keep failing
+
+    Blocking requests calls run on a private thread pool and share one session, which
+    keeps connections alive between calls; the number of calls in flight to each host
+    is capped separately. Tasks that fail for good are appended to a dead-letter file
+    '''
+    def __init__(self, max_per_host=10, max_attempts=5, backoff_base=1.0, backoff_max=60.0,
+            timeout=60, dead_letter=None, log_every=1000):
+        '''
+        INPUT   max_per_host: maximum number of requests in flight to any one host (int)
+                max_attempts: attempts at each request before giving up on it (int)
+                backoff_base: seconds of backoff after first failed attempt, doubling
+                    with each further attempt (numeric)
+                backoff_max: maximum seconds of backoff between attempts (numeric)
+                timeout: seconds to wait for server to respond (numeric)
+                dead_letter: JSON lines file to which failed tasks are appended (string)
+                log_every: number of finished tasks between progress messages (int)
+        '''
+        self.max_per_host = max_per_host
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.dead_letter = dead_letter
+        self.log_every = log_every
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_per_host)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.n_requests = 0
+        self.n_retries = 0
+        self.n_done = 0
+        self.n_failed = 0
+
+    def _host_slots(self, url):
+        host = urlsplit(url).netloc
+        if host not in self._slots:
+            self._slots[host] = asyncio.Semaphore(self.max_per_host)
+        return self._slots[host]
+
+    def _backoff(self, attempt, retry_after=None):
+        # full jitter, so that requests failing together do not retry together
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        try:
+            delay = max(delay, float(retry_after))
+        except (TypeError, ValueError):
+            pass
+        return delay
+
+    async def fetch(self, url):
+        '''
+        Make GET request, retrying server errors, throttling and dropped connections
+        INPUT   url: request url (string)
+        RETURN  response: successful response (requests.models.Response)
+        '''
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self.session.get, url, timeout=self.timeout)
+        error = None
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                self.n_retries += 1
+            retry_after = None
+            try:
+                async with self._host_slots(url):
+                    self.n_requests += 1
+                    r = await loop.run_in_executor(self._executor, call)
+            except (ConnectionError, ChunkedEncodingError, Timeout) as e:
+                error = str(e)
+            else:
+                if r.status_code == 200:
+                    return r
+                if r.status_code != 429 and r.status_code < 500:
+                    # the request itself is at fault; asking again will not help
+                    raise RequestFailed('HTTP {}: {}'.format(r.status_code, url))
+                error = 'HTTP {}'.format(r.status_code)
+                retry_after = r.headers.get('Retry-After')
+            if attempt + 1 < self.max_attempts:
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+        raise RequestFailed('Gave up after {} attempts ({}): {}'.format(self.max_attempts, error, url))
+
+    def _write_dead_letter(self, task, error):
+        if self.dead_letter is None:
+            return
+        with open(self.dead_letter, 'a', encoding='utf-8') as f:
+            for key in task.get('keys', [{}]):
+                f.write(json.dumps(dict(key, url=task['url'], error=error), default=str) + '\n')
+
+    async def _run_task(self, task, handler):
+        try:
+            r = await self.fetch(task['url'])
+            loop = asyncio.get_running_loop()
+            # parsing is done off the event loop, alongside the requests
+            result = await loop.run_in_executor(self._executor, handler, task, r)
+        except (RequestFailed, ValueError) as e:
+            logger.warning('Request failed for good: ' + str(e))
+            self.n_failed += 1
+            self._write_dead_letter(task, str(e))
+            result = None
+        self.n_done += 1
+        if self.n_done % self.log_every == 0:
+            logger.info('{} of {} requests finished ({} failed, {} retries) after {:.0f}s'.format(
+                    self.n_done, self._n_tasks, self.n_failed, self.n_retries,
+                    time.monotonic() - self._started))
+        return result
+
+    async def collect_all(self, tasks, handler):
+        '''
+        Request and handle all tasks concurrently
+        INPUT   tasks: requests to make; each must provide 'url', and may provide 'keys',
+                    identifying what the task stands for in the dead-letter file
+                    (list of dictionaries)
+                handler: called with each task and its successful response, returning the
+                    result of the task; raises ValueError if the response is unusable (function)
+        RETURN  results: handler result for each task, in task order; None for tasks that
+                    failed (list)
+        '''
+        self._n_tasks = len(tasks)
+        async with self:
+            results = await asyncio.gather(*[self._run_task(task, handler) for task in tasks])
+        logger.info('{} tasks finished, {} failed'.format(self.n_done, self.n_failed))
+        return results
+
+    async def __aenter__(self):
+        '''
+        Open thread pool, for using fetch directly: async with client: ...
+        '''
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_per_host * 2)
+        self._slots = {}
+        self._started = time.monotonic()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._executor.shutdown(wait=False)
+        logger.info('{} requests made ({} of them retries) in {:.0f}s'.format(
+                self.n_requests, self.n_retries, time.monotonic() - self._started))
+
+    def run(self, tasks, handler):
+        '''
+        Blocking entry point for scripts; see collect_all
+        '''
+        return asyncio.run(self.collect_all(tasks, handler))
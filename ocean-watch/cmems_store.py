@@ -0,0 +1,227 @@
+'''
+On-disk store of river-mouth time series collected from Copernicus, partitioned
+by variable and depth
+Results are flushed to Parquet files as collection goes, and a manifest records
+which (hyriv_id, variable, depth) series each file holds, so an interrupted run
+loses at most what was still buffered and a rerun skips everything already stored
+
+Also defines the normalized layout of the results: a dimension table of river
+mouths and a narrow fact table of coded variable, depth, month and value
+'''
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+
+from cmems import variables, depths, grid_centre
+
+logger = logging.getLogger(__name__)
+
+
+def partition_name(variable, depth):
+    '''
+    Directory holding results for one variable at one depth
+    INPUT   variable: model variable (string)
+            depth: model depth (numeric)
+    RETURN  name: partition directory name (string)
+    '''
+    return '{}_{:.4f}'.format(variable, abs(float(depth)))
+
+
+# columns of the mouth dimension table, keyed by hyriv_id
+MOUTH_COLUMNS = ['hyriv_id','pfaf_id_12','hybas_id_5','hybas_id_3','ord_flow','osm_name',
+        'longitude','latitude','gridCentreLon','gridCentreLat']
+# columns of the fact table; variable_code and depth_code are positions in cmems.variables
+# and cmems.depths
+FACT_COLUMNS = ['hyriv_id','variable_code','depth_code','dt','value']
+
+
+def mouth_frame(gdf_mouths):
+    '''
+    Build dimension table of river mouths, holding everything that is constant over
+    a mouth's time series
+    INPUT   gdf_mouths: river mouths, with corrected coordinates in x_valid/y_valid (GeoDataFrame)
+    RETURN  df_mouths: one row per mouth with valid coordinates, with MOUTH_COLUMNS (DataFrame)
+    '''
+    gdf_valid = gdf_mouths[gdf_mouths['x_valid'].notnull() & gdf_mouths['y_valid'].notnull()]
+    df_mouths = pd.DataFrame(gdf_valid[['hyriv_id','pfaf_id_12','hybas_id_5','hybas_id_3',
+            'ord_flow','osm_name']]).reset_index(drop=True)
+    df_mouths['hyriv_id'] = df_mouths['hyriv_id'].astype('int32')
+    df_mouths['osm_name'] = df_mouths['osm_name'].astype('category')
+    df_mouths['longitude'] = gdf_valid['x_valid'].astype('float64').values
+    df_mouths['latitude'] = gdf_valid['y_valid'].astype('float64').values
+    df_mouths['gridCentreLon'], df_mouths['gridCentreLat'] = grid_centre(
+            df_mouths['longitude'].values, df_mouths['latitude'].values)
+    return df_mouths[MOUTH_COLUMNS]
+
+def fact_frame(df, variable, depth):
+    '''
+    Narrow fact table rows for one variable at one depth
+    INPUT   df: time series with 'hyriv_id', 'dt' and 'value' columns (DataFrame)
+            variable: model variable, from cmems.variables (string)
+            depth: model depth, from cmems.depths (numeric)
+    RETURN  df_facts: FACT_COLUMNS, with int32 mouth key, int8 codes, monthly dates
+                and float32 values (DataFrame)
+    '''
+    n = len(df)
+    return pd.DataFrame({
+        'hyriv_id': df['hyriv_id'].astype('int32').values,
+        'variable_code': np.full(n, variables.index(variable), dtype='int8'),
+        'depth_code': np.full(n, depths.index(depth), dtype='int8'),
+        'dt': pd.to_datetime(df['dt']).dt.normalize().values,
+        'value': df['value'].astype('float32').values,
+    }, columns=FACT_COLUMNS)
+
+def code_table():
+    '''
+    RETURN  df_codes: meaning of each variable and depth code in the fact table (DataFrame)
+    '''
+    return pd.concat([
+        pd.DataFrame({'kind': 'variable', 'code': range(len(variables)), 'variable': variables, 'depth': None}),
+        pd.DataFrame({'kind': 'depth', 'code': range(len(depths)), 'variable': None, 'depth': depths}),
+    ], ignore_index=True)
+
+
+class ResultStore:
+    '''
+    Parquet partitions plus SQLite manifest, with one manifest row per stored
+    (hyriv_id, variable, depth), and a record of which files have been uploaded
+    Safe to add to from several threads at once
+    '''
+    def __init__(self, root, flush_rows=200000):
+        '''
+        INPUT   root: directory of store; created if it does not exist (string)
+                flush_rows: buffered rows of a partition at which they are written out (int)
+        '''
+        self.root = root
+        self.flush_rows = flush_rows
+        os.makedirs(root, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(root, 'manifest.sqlite'), check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS series (hyriv_id TEXT NOT NULL, '
+                'variable TEXT NOT NULL, depth REAL NOT NULL, part TEXT NOT NULL, updated REAL, '
+                'PRIMARY KEY (hyriv_id, variable, depth))')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS uploads (part TEXT PRIMARY KEY, updated REAL)')
+        self.conn.commit()
+        self._lock = threading.Lock()
+        self._buffers = {}
+
+    def completed(self):
+        '''
+        RETURN  keys: series already stored (set of (hyriv_id, variable, depth) tuples)
+        '''
+        with self._lock:
+            rows = self.conn.execute('SELECT hyriv_id, variable, depth FROM series').fetchall()
+        return {(hyriv_id, variable, float(depth)) for hyriv_id, variable, depth in rows}
+
+    def add(self, df, variable, depth):
+        '''
+        Buffer results for one variable at one depth, writing them out once enough
+        have gathered; they count as stored only once written
+        INPUT   df: time series with 'hyriv_id' column (DataFrame)
+                variable: model variable (string)
+                depth: model depth (numeric)
+        '''
+        name = partition_name(variable, depth)
+        with self._lock:
+            buffer = self._buffers.setdefault(name, {'variable': variable, 'depth': depth,
+                    'frames': [], 'rows': 0})
+            buffer['frames'].append(df)
+            buffer['rows'] += len(df)
+            if buffer['rows'] >= self.flush_rows:
+                self._flush(name)
+
+    def flush(self):
+        '''
+        Write out everything buffered
+        '''
+        with self._lock:
+            for name in list(self._buffers):
+                self._flush(name)
+
+    def _flush(self, name):
+        buffer = self._buffers.pop(name)
+        if not buffer['frames']:
+            return
+        df = pd.concat(buffer['frames'], axis=0, ignore_index=True)
+        part_dir = os.path.join(self.root, name)
+        os.makedirs(part_dir, exist_ok=True)
+        part = os.path.join(name, 'part-{}.parquet'.format(uuid.uuid4().hex))
+        # write under a temporary name so that a crash never leaves a partial file behind
+        tmp = os.path.join(self.root, part + '.tmp')
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, os.path.join(self.root, part))
+        now = time.time()
+        self.conn.executemany('INSERT OR REPLACE INTO series (hyriv_id, variable, depth, part, updated) '
+                'VALUES (?, ?, ?, ?, ?)', [(str(hyriv_id), buffer['variable'], float(buffer['depth']), part, now)
+                        for hyriv_id in df['hyriv_id'].unique()])
+        self.conn.commit()
+        logger.debug('Stored {} rows in {}'.format(len(df), part))
+
+    def partitions(self, columns=None, pending=False):
+        '''
+        Read stored results one variable/depth partition at a time, so the whole
+        table never needs to be held at once
+        Files replaced by a later write of the same series are skipped
+        INPUT   columns: columns to read; all if not provided (list of strings)
+                pending: whether to read only files not yet marked uploaded (boolean)
+        RETURN  generator of (variable, depth, df) tuples, df sorted by river mouth and date
+        '''
+        query = 'SELECT DISTINCT variable, depth, part FROM series '
+        if pending:
+            query += 'WHERE part NOT IN (SELECT part FROM uploads) '
+        with self._lock:
+            rows = self.conn.execute(query + 'ORDER BY variable, depth, part').fetchall()
+        parts = {}
+        for variable, depth, part in rows:
+            parts.setdefault((variable, depth), []).append(part)
+        read_columns = columns
+        if columns is not None and 'hyriv_id' not in columns:
+            read_columns = list(columns) + ['hyriv_id']
+        for (variable, depth), files in parts.items():
+            with self._lock:
+                latest = self.conn.execute('SELECT hyriv_id, part FROM series WHERE variable=? AND depth=?',
+                        (variable, depth)).fetchall()
+            frames = []
+            for part in files:
+                df = pd.read_parquet(os.path.join(self.root, part), columns=read_columns)
+                # a series stored again later is only taken from its latest file
+                current = {hyriv_id for hyriv_id, latest_part in latest if latest_part == part}
+                frames.append(df[df['hyriv_id'].astype(str).isin(current).values])
+            df = pd.concat(frames, axis=0, ignore_index=True)
+            sort_cols = [c for c in ['hyriv_id', 'dt'] if c in df.columns]
+            df.sort_values(sort_cols, inplace=True, ignore_index=True)
+            if read_columns is not columns:
+                df = df.drop(columns='hyriv_id')
+            yield variable, depth, df
+
+    def mark_uploaded(self, variable, depth):
+        '''
+        Record every file of a partition as uploaded, so a rerun after an interrupted
+        upload does not send it again
+        INPUT   variable: model variable (string)
+                depth: model depth (numeric)
+        '''
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO uploads (part, updated) SELECT DISTINCT part, ? '
+                    'FROM series WHERE variable=? AND depth=?', (time.time(), variable, float(depth)))
+            self.conn.commit()
+
+    def uploaded(self):
+        '''
+        RETURN  n_parts: number of files already uploaded (int)
+        '''
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM uploads').fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self.conn.execute('SELECT COUNT(*) FROM series').fetchone()[0]
+
+    def close(self):
+        self.flush()
+        self.conn.close()
@@ -1,15 +1,100 @@
+import logging
+from cartoframes.auth import set_default_credentials
+from cartoframes import read_carto, to_carto
+import pandas as pd
+from pathlib import Path
+
+import contextlib
+
+from gfw_api import download_4wings_report, sum_gridded_effort_by_zone, target_years, verify_zip
+
 import os
-import requests
-import json
+import zipfile
+
+# set up logging
+
+# get top-level logger object
+logger = logging.getLogger()
+for handler in logger.handlers: logger.removeHandler(handler)
+# manually set level
+logger.setLevel(logging.DEBUG)
+# print to console
+console = logging.StreamHandler()
+logger.addHandler(console)
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+# bulk alternative to fishing-effort_collect-data.py: rather than one detail
+# report per zone and year, pull gridded effort for the whole globe once per year
+# and total it within each zone locally
+# name of table on Carto where you want to upload data
+dataset_name = 'com_030d_fishing_effort_by_zone'
+
+logger.debug('Authenticate Carto credentials')
+CARTO_USER = os.getenv('CARTO_WRI_RW_USER')
+CARTO_KEY = os.getenv('CARTO_WRI_RW_KEY')
+set_default_credentials(username=CARTO_USER,
+                        base_url="https://{user}.carto.com/".format(user=CARTO_USER),
+                        api_key=CARTO_KEY)
+
+WORKING_DIR = os.path.join(os.getenv('DOWNLOAD_DIR'), 'gfw-api-data')
+Path(WORKING_DIR).mkdir(parents=True, exist_ok=True)
+
+# grid cells are matched to zones by their reported coordinates, so the
+# resolution bounds how precisely effort near zone boundaries is assigned
+SPATIAL_RESOLUTION = 'low'
+# years run up to the last one gfw has had time to process
+years = target_years()
+
+logger.debug('Retrieve polygons from Carto')
+# same zones as the per-zone detail reports
+gdf_zones = read_carto("SELECT * FROM com_011_rw1_maritime_boundaries_edit WHERE pol_type IN ('Overlapping claim','200NM','Joint regime')",
+        index_col='cartodb_id')
+gdf_zones = gdf_zones.astype({'mrgid':'int','mrgid_ter1':'int','mrgid_sov1':'int',
+        'mrgid_eez':'int',})
+
+# columns of com_030d_fishing_effort_by_zone, in order
+cols_out = ['mrgid','geoname','pol_type','iso_ter1','iso_sov1','iso_ter2','iso_sov2',
+        'iso_ter3','iso_sov3','year','id','value']
+df_zone_attrs = pd.DataFrame(gdf_zones[cols_out[:9]]).drop_duplicates('mrgid')
+
+results = []
+for year in years:
+    report_path = os.path.join(WORKING_DIR, '4wings_{}_{}.zip'.format(SPATIAL_RESOLUTION, year))
+    # reports are only moved into place once whole, but check any left by older runs;
+    # the api may also answer with plain csv, which is kept under the same name and
+    # needs no check, while a zip cut off before its directory no longer reads as one
+    if os.path.isfile(report_path):
+        with open(report_path, 'rb') as f:
+            is_zip = f.read(4) == b'PK\x03\x04'
+        try:
+            if zipfile.is_zipfile(report_path):
+                verify_zip(report_path)
+            elif is_zip:
+                raise zipfile.BadZipFile('Truncated zip: ' + report_path)
+        except zipfile.BadZipFile:
+            logger.info('Previously downloaded gridded effort for {} is damaged; downloading again'.format(year))
+            os.remove(report_path)
+    if os.path.isfile(report_path):
+        logger.info('Using previously downloaded gridded effort for ' + str(year))
+    else:
+        logger.info('Download gridded effort for ' + str(year))
+        download_4wings_report(year, report_path, spatial_resolution=SPATIAL_RESOLUTION)
+    logger.info('Total gridded effort within each zone for ' + str(year))
+    sums = sum_gridded_effort_by_zone(report_path, gdf_zones)
+    df_year = df_zone_attrs.copy()
+    df_year['year'] = year
+    # no individual report backs these values
+    df_year['id'] = None
+    df_year['value'] = df_year['mrgid'].map(sums).fillna(0.0)
+    results.append(df_year[cols_out])
 
-INITIATE_REPORT_ENDPOINT = 'https://gateway.api.globalfishingwatch.org//v1/4wings/report?spatialResolution=low&temporalResolution=yearly&groupBy=flag&datasets[0]=public-global-fishing-effort:v20201001&date-range=2020-01-01T00:00:00.000Z,2021-09-01T00:00:00.000Z&format=json'
+df_reports = pd.concat(results, axis=0, ignore_index=True)
+df_reports = df_reports.astype({'mrgid':'int','year':'int','value':'float'})
 
-INITIATE_REPORT_HEADERS = {
-    'Content-Type':'application/json',
-    'Authorization':os.getenv('GFW_API_KEY')
-}
+logger.info('Store results locally and upload them to Carto')
+reports_csv = os.path.join(WORKING_DIR, 'gfw-api_fishing-effort_4wings.csv')
+with contextlib.suppress(FileNotFoundError):
+    os.remove(reports_csv)
+df_reports.to_csv(reports_csv, header=True, index=False, )
 
-request_data_string = '{"geojson": {"type": "Polygon","coordinates": [[[-180,-85.051128],[180,-85.051128],[180,85.051128],[-180,85.051128], [-180,-85.051128] ] ] } }'
-request_data = json.loads(request_data_string)
-r = requests.post(INITIATE_REPORT_ENDPOINT, headers=INITIATE_REPORT_HEADERS, data=request_data)
-print(r)
\ No newline at end of file
+# to_carto(df_reports, dataset_name, if_exists='replace')
@@ -0,0 +1,115 @@
+'''
+Measure throughput of the fishing-effort collector against the local fake GFW API
+Reports reports/hour, time to last result, and peak memory, so changes to the
+collector can be compared offline
+
+Example, 500 zone-years with reports taking ~20s each:
+    python fishing-effort_benchmark.py --reports 500 --latency-median 20
+'''
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date
+
+from gfw_api import ReportEngine, RateLimiter, build_req_data_mrgid
+from gfw_fake_api import DEFAULT_CONFIG, make_server
+from gfw_ledger import ReportLedger
+
+# set up logging
+
+# get top-level logger object
+logger = logging.getLogger()
+for handler in logger.handlers: logger.removeHandler(handler)
+# manually set level
+logger.setLevel(logging.INFO)
+# print to console
+console = logging.StreamHandler()
+logger.addHandler(console)
+logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+def serve(port_queue, config):
+    # runs in its own process, so the server does not count toward collector memory
+    logging.getLogger().setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, **config)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on linux, bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def main():
+    # server runs in a child process; kept out of module level so that the child, which
+    # re-imports this script under the spawn start method (macos, windows), does not rerun it
+    parser = argparse.ArgumentParser(description='Benchmark fishing-effort collector against fake GFW API')
+    parser.add_argument('--reports', type=int, default=200, help='number of zone-years to collect')
+    parser.add_argument('--max-pending', type=int, default=20)
+    parser.add_argument('--max-downloads', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=5.0, help='initial requests per second of limiter')
+    parser.add_argument('--max-rate', type=float, default=50.0)
+    parser.add_argument('--poll-initial', type=float, default=2.0)
+    parser.add_argument('--poll-max', type=float, default=30.0)
+    parser.add_argument('--output', default=None, help='file in which to store results as JSON')
+    for key, value in DEFAULT_CONFIG.items():
+        if key == 'seed':
+            parser.add_argument('--seed', type=int, default=0)
+        else:
+            parser.add_argument('--' + key.replace('_', '-'), type=type(value), default=value)
+    args = parser.parse_args()
+    server_config = {k: getattr(args, k) for k in DEFAULT_CONFIG}
+
+    port_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(target=serve, args=(port_queue, server_config), daemon=True)
+    server_process.start()
+    api_base = 'http://127.0.0.1:{}/'.format(port_queue.get(timeout=30))
+    logger.info('Fake GFW API running at ' + api_base)
+
+    with tempfile.TemporaryDirectory() as working_dir:
+        ledger = ReportLedger(os.path.join(working_dir, 'ledger.sqlite'))
+        jobs = []
+        for i in range(args.reports):
+            mrgid, year = 1000 + i // 10, 2012 + i % 10
+            report_name = 'Benchmark report {}, {}'.format(mrgid, year)
+            jobs.append({'mrgid': mrgid, 'year': year, 'report_name': report_name,
+                    'req_data': build_req_data_mrgid(report_name, (date(year,1,1), date(year,12,31)), mrgid)})
+
+        limiter = RateLimiter(rate=args.rate, max_rate=args.max_rate, log_interval=60)
+        engine = ReportEngine(working_dir, api_key='benchmark', max_pending=args.max_pending,
+                max_downloads=args.max_downloads, limiter=limiter, poll_initial=args.poll_initial,
+                poll_max=args.poll_max, ledger=ledger, api_base=api_base)
+        started = time.monotonic()
+        records = engine.run(jobs)
+        collected = time.monotonic() - started
+        ledger.close()
+
+    server_process.terminate()
+
+    n_ok = sum(1 for record in records if record['value'] is not None)
+    results = {
+        'reports': args.reports,
+        'collected': n_ok,
+        'failed': args.reports - n_ok,
+        'split': sum(1 for record in records if record['parts'] > 1),
+        'time_to_last_result_s': round(collected, 2),
+        'reports_per_hour': round(3600 * n_ok / collected, 1) if collected > 0 else None,
+        'median_report_latency_s': round(statistics.median(engine._durations), 2) if engine._durations else None,
+        'requests': limiter.n_requests,
+        'throttled': limiter.n_throttled,
+        'peak_memory_mb': round(peak_memory_mb(), 1),
+        'config': dict(vars(args)),
+    }
+    print(json.dumps(results, indent=4))
+    if args.output is not None:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == '__main__':
+    main()
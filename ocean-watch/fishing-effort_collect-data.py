@@ -2,17 +2,11 @@ import logging
 from cartoframes.auth import set_default_credentials
 from cartoframes import read_carto, to_carto
 import pandas as pd
-from pandas.errors import EmptyDataError
 import geopandas as gpd
 from datetime import date
 from pprint import pprint
 import json
-import time
 # import dateutil.relativedelta
-import requests
-from requests.exceptions import HTTPError
-import urllib.request
-import zipfile
 from pathlib import Path
 # import xml.etree.ElementTree as ET
 # import math
@@ -20,6 +14,9 @@ from pathlib import Path
 
 import contextlib
 
+from gfw_api import ReportEngine, RateLimiter, target_years, GeometryCache, build_req_data_postgis_json, encode_req_data
+from gfw_ledger import ReportLedger
+
 # import pandas as pd
 
 import os
@@ -48,26 +45,14 @@ set_default_credentials(username=CARTO_USER,
                         base_url="https://{user}.carto.com/".format(user=CARTO_USER),
                         api_key=CARTO_KEY)
 
-# fixed items defined by gfw
-INITIATE_REPORT_ENDPOINT = 'https://gateway.api.globalfishingwatch.org//v1/reports'
-INQUIRE_STATUS_ENDPOINT = 'https://gateway.api.globalfishingwatch.org//v1/reports/{}'
-RETRIEVE_URL_ENDPOINT = 'https://gateway.api.globalfishingwatch.org//v1/reports/{}/url'
-
-# related objects
-INITIATE_REPORT_HEADERS = {
-    'Content-Type':'application/json',
-    'Authorization':os.getenv('GFW_API_KEY')
-}
-INQUIRE_STATUS_HEADERS = {
-    'Authorization':os.getenv('GFW_API_KEY')
-}
-RETRIEVE_URL_HEADERS = {
-    'Authorization':os.getenv('GFW_API_KEY')
-}
-
 WORKING_DIR = os.path.join(os.getenv('DOWNLOAD_DIR'), 'gfw-api-data')
 Path(WORKING_DIR).mkdir(parents=True, exist_ok=True)
 
+# on-disk record of every zone-year attempted; lets an interrupted run resume
+# (shared with fishing-effort_retry-missing.py)
+LEDGER_FILE = os.path.join(WORKING_DIR, 'gfw-api_fishing-effort_ledger.sqlite')
+ledger = ReportLedger(LEDGER_FILE)
+
 logger.debug('Retrieve polygons from Carto')
 # retrieve polygons from carto
 eez_table = 'com_011_rw1_maritime_boundaries_edit'
@@ -75,17 +60,27 @@ eez_table = 'com_011_rw1_maritime_boundaries_edit'
 # '12NM', '24NM', '200NM', 'Overlapping claim', 'Joint regime'
 # the final three are of potential relevance here
 # collect the data for them all, but maintain the distinction for later ease
-gdf_zones = read_carto("SELECT *, ST_AsGeoJSON(the_geom) AS the_geom_geojson FROM com_011_rw1_maritime_boundaries_edit WHERE pol_type IN ('Overlapping claim','200NM','Joint regime') AND mrgid=8464",
+gdf_zones = read_carto("SELECT * FROM com_011_rw1_maritime_boundaries_edit WHERE pol_type IN ('Overlapping claim','200NM','Joint regime')",
         index_col='cartodb_id')
 gdf_zones = gdf_zones.astype({'mrgid':'int','mrgid_ter1':'int','mrgid_sov1':'int',
         'mrgid_eez':'int',})
-gdf_zones['json'] = gdf_zones.the_geom.to_json()
+
+# incremental mode requests only the zone-years not yet in the dataset, and appends
+# them; otherwise every zone-year not already in the ledger is requested
+INCREMENTAL = True
 
 # create set of pairs of dates to loop through
-date_pairs = [(date(year,1,1), date(year,12,31)) for year in range(2012, 2022)]
+# years run up to the last one gfw has had time to process
+date_pairs = [(date(year,1,1), date(year,12,31)) for year in target_years()]
+
+published = set()
+if INCREMENTAL:
+    logger.debug('Retrieve zone-years already stored on Carto')
+    df_published = read_carto("SELECT mrgid, year FROM com_030d_fishing_effort_by_zone WHERE value IS NOT NULL")
+    published = set(zip(df_published.mrgid.astype(int), df_published.year.astype(int)))
 
 # create object to track api activity & results
-# mrgid, geoname, year, id, url, zip, csv, value
+# mrgid, geoname, year, id, url, zip, value
 # needed from original table: geoname, pol_type, iso_ter1, iso_sov1, iso_ter2, iso_sov2, iso_ter3, iso_sov3
 col_type_dict = {
     'mrgid':'int',
@@ -101,128 +96,58 @@ col_type_dict = {
     'id':'str',
     'url':'str',
     'zip':'str',
-    'csv':'str',
     'value':'float',
 }
-df_reports = pd.DataFrame({c: pd.Series(dtype=t) for c, t in col_type_dict.items()})
-
-logger.info('Define functions for submitting API requests and handling responses')
-def build_req_data_postgis_json(report_name, date_pair, geom_geojson,  
-        value=None, geoname=None, mrgid=None, gfw_id=None):
-    # construct data object
-    req_data = {}
-    req_data['name'] = report_name
-    req_data['geometry'] = {}
-    req_data['geometry']['type'] = 'MultiPolygon'
-    req_data['geometry']['properties'] = {}
-    if value is not None: req_data['geometry']['properties']['value'] = value
-    if geoname is not None: req_data['geometry']['properties']['geoname'] = geoname
-    if mrgid is not None: req_data['geometry']['properties']['mrgid'] = mrgid
-    if gfw_id is not None: req_data['geometry']['properties']['gfw_id'] = gfw_id
-    json_dict = json.loads(geom_geojson)
-    # if len(json_dict['features']) > 1: 
-    #     print('warning')
-        # raise Exception('not sure if we want this or will encounter')
-    req_data['geometry']['geometry'] = json_dict
-    # req_data['geometry']['geometry'] = json_dict['features'][0]['geometry']
-    req_data['type'] = 'detail'
-    req_data['timeGroup'] = 'none'
-    req_data['filters'] = ['']
-    req_data['datasets'] = ['public-global-fishing-tracks:latest']
-    date_format = '%Y-%m-%d'
-    req_data['dateRange'] = [date_pair[0].strftime(date_format), date_pair[1].strftime(date_format)]
-    return req_data
-
-logger.info('Initiate report generation for all times and places')
+
+logger.info('Build report requests for all times and places')
 report_name_template = 'Total Observed Fishing Effort in {}, {}'
+# zone geometries are simplified and encoded once, then reused for every year
+# tolerance (degrees) is far below the resolution of gfw fishing effort data
+geometry_cache = GeometryCache(tolerance=0.01, precision=4,
+        cache_dir=os.path.join(WORKING_DIR, 'geometry-cache'))
+jobs = []
+completed = ledger.completed() | published
 for index, row in gdf_zones.iterrows():
-    logger.debug('Request reports for zone: ' + row.geoname)
     for date_pair in date_pairs:
-        # print(row['geoname'], date_pair[0].strftime('%Y-%m-%d'))
+        if (row.mrgid, date_pair[0].year) in completed:
+            # finished by an earlier run
+            continue
         report_name = report_name_template.format(row.geoname, date_pair[0].year)
-        # req_data = build_req_data_from_row(report_name, date_pair, row)
-        req_data_postgis = build_req_data_postgis_json(report_name, date_pair, row.the_geom_geojson, 
+        geom_geojson = geometry_cache.get(row.mrgid, row.the_geom)
+        req_data_postgis = build_req_data_postgis_json(report_name, date_pair, geom_geojson,
                 value=row.geoname, geoname=row.geoname, mrgid=row.mrgid, gfw_id=None)
-        # req_data_pandas = build_req_data_pandas_json(report_name, date_pair, row.json, 
-        #         value=row.geoname, geoname=row.geoname, mrgid=row.mrgid, gfw_id=None)
-        with open(os.path.join(WORKING_DIR, 'postgis.json'), 'w', encoding='utf-8') as f:
-            json.dump(req_data_postgis, f, ensure_ascii=False, indent=4)
-        # with open(os.path.join(WORKING_DIR, 'pandas.json'), 'w', encoding='utf-8') as f:
-        #     json.dump(req_data_pandas, f, ensure_ascii=False, indent=4)
-
-        # req_data['geometry']['geometry'] = None
-        # pprint(req_data)
-        r = requests.post(INITIATE_REPORT_ENDPOINT, headers=INITIATE_REPORT_HEADERS, data=json.dumps(req_data_postgis))
-        try:
-            r.raise_for_status()
-        except HTTPError as e:
-            logger.error('Failed report generation request for: ' + report_name)
-            resp_body = None
-        else:
-            resp_body = r.json()
-        finally:
-            df_reports.loc[len(df_reports.index)] = [
-                row.mrgid, row.geoname, row.pol_type,
-                row.iso_ter1, row.iso_sov1, row.iso_ter2, row.iso_sov2, row.iso_ter3, row.iso_sov3, 
-                date_pair[0].year, (None if resp_body is None else resp_body['id']), None, None, None, None,
-            ]
-            time.sleep(1)
-        # break
-    # break
-
-time.sleep(30)
-
-logger.info('Retrieve report URLs and download results')
-for index, row in df_reports.iterrows():
-    if row.id is None:
-        continue
-    try:
-        r = requests.get(RETRIEVE_URL_ENDPOINT.format(row.id), headers=RETRIEVE_URL_HEADERS)
-        r.raise_for_status()
-    except HTTPError as e:
-        logger.error('Failed report URL retrieval request for: ' + row.geoname)
-        continue
-    resp_body = r.json()
-    url = resp_body['url']
-    df_reports.loc[index, 'url'] = url
-    zip = os.path.join(WORKING_DIR,row.id+'.zip')
-    df_reports.loc[index, 'zip'] = zip
-    urllib.request.urlretrieve(url, zip)
-    time.sleep(8)
-    # break
-
-logger.info('Unzip and organize retrieved data')
-for index, row in df_reports.iterrows():
-    if row.zip is None:
-        continue
-    with zipfile.ZipFile(row.zip, 'r') as zip_ref:
-        zip_list = zip_ref.namelist()
-        for f in zip_list:
-            if f.endswith('.csv'):
-                zip_ref.extract(f, path=WORKING_DIR)
-                unzipped_csv = os.path.join(WORKING_DIR, f)
-                renamed_csv = os.path.join(WORKING_DIR, row.geoname.replace(' ','-').replace('/','|')+'_'+str(row.year)+'.csv')
-                os.rename(unzipped_csv, renamed_csv)
-                df_reports.loc[index, 'csv'] = renamed_csv
-                # break
-    # break
-
-logger.info('Load data, calculate statistics, and record results')
-for index, row in df_reports.iterrows():
-    if row.csv is None:
-        continue
-    try:
-        df_entry = pd.read_csv(row.csv)
-    except EmptyDataError as e:
-        logger.debug('No fishing records for ' + row.geoname + ' in ' + str(row.year))
-        df_reports.loc[index, 'value'] = 0
-        continue
-    sum = df_entry['Fishing hours'].sum()
-    df_reports.loc[index, 'value'] = sum
+        jobs.append({
+            'mrgid': row.mrgid, 'geoname': row.geoname, 'pol_type': row.pol_type,
+            'iso_ter1': row.iso_ter1, 'iso_sov1': row.iso_sov1, 'iso_ter2': row.iso_ter2,
+            'iso_sov2': row.iso_sov2, 'iso_ter3': row.iso_ter3, 'iso_sov3': row.iso_sov3,
+            'year': date_pair[0].year, 'report_name': report_name, 'req_data': req_data_postgis,
+            'geometry': row.the_geom,
+        })
     # break
+geometry_cache.log_summary()
+# keep an example request body on disk for inspection
+if jobs:
+    with open(os.path.join(WORKING_DIR, 'postgis.json'), 'w', encoding='utf-8') as f:
+        f.write(encode_req_data(jobs[-1]['req_data']))
+
+logger.info('Submit reports, poll their status, and download and total each as soon as it is ready')
+# each report moves through submission, polling, download, and summation independently;
+# reports that fail or time out are split by period, then area, and their parts summed
+# one limiter paces submissions, status checks, and downloads alike
+limiter = RateLimiter(rate=1, max_rate=10)
+engine = ReportEngine(WORKING_DIR, max_pending=20, max_downloads=4, limiter=limiter,
+        ledger=ledger)
+# results are read back from the ledger below, along with those of earlier runs
+engine.run(jobs)
 
 logger.info('Store results locally and upload them to Carto')
 
+# report on every zone-year requested, including those finished by earlier runs
+df_reports = ledger.to_dataframe()
+df_reports = df_reports[df_reports.mrgid.isin(gdf_zones.mrgid) &
+        df_reports.year.isin([date_pair[0].year for date_pair in date_pairs])]
+df_reports = df_reports[[c for c in col_type_dict.keys() if c in df_reports.columns]].copy()
+
 # record reports that failed, whose reports are thus missing
 df_failures = df_reports[df_reports['value'].isnull()]
 if len(df_failures) > 0:
@@ -233,10 +158,20 @@ if len(df_failures) > 0:
 
 # do not retain local paths or file url (which ultimately derives
 # from api access, and is probably ephemeral anyway)
-df_reports.drop(columns=['url','zip','csv'], inplace=True)
+df_reports.drop(columns=['url','zip'], inplace=True, errors='ignore')
 reports_csv = os.path.join(WORKING_DIR, 'gfw-api_fishing-effort.csv')
 with contextlib.suppress(FileNotFoundError):
     os.remove(reports_csv)
 df_reports.to_csv(reports_csv, header=True, index=False, )
 
-# to_carto(df_reports, dataset_name, if_exists='replace')
\ No newline at end of file
+if INCREMENTAL:
+    # append only new values; zone-years already published stay as they are
+    new_index = pd.Series([(m, y) not in published for m, y in zip(df_reports.mrgid, df_reports.year)],
+            index=df_reports.index)
+    df_new = df_reports[new_index & df_reports['value'].notnull()]
+    if len(df_new) > 0:
+        to_carto(df_new, dataset_name, if_exists='append')
+# else:
+#     to_carto(df_reports, dataset_name, if_exists='replace')
+
+ledger.close()
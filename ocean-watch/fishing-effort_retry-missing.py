@@ -2,18 +2,13 @@ import logging
 from cartoframes.auth import set_default_credentials
 from cartoframes import read_carto, to_carto
 import pandas as pd
-from pandas.errors import EmptyDataError
 import geopandas as gpd
 from datetime import date
 from datetime import datetime
 from pprint import pprint
 import json
-import time
+from shapely.geometry import shape
 # import dateutil.relativedelta
-import requests
-from requests.exceptions import HTTPError
-import urllib.request
-import zipfile
 from pathlib import Path
 # import xml.etree.ElementTree as ET
 # import math
@@ -21,6 +16,9 @@ from pathlib import Path
 
 import contextlib
 
+from gfw_api import ReportEngine, RateLimiter, target_years, build_req_data_mrgid
+from gfw_ledger import ReportLedger
+
 # import pandas as pd
 
 import os
@@ -49,39 +47,12 @@ set_default_credentials(username=CARTO_USER,
                         base_url="https://{user}.carto.com/".format(user=CARTO_USER),
                         api_key=CARTO_KEY)
 
-# fixed items defined by gfw
-INITIATE_REPORT_ENDPOINT = 'https://gateway.api.globalfishingwatch.org//v1/reports'
-INQUIRE_STATUS_ENDPOINT = 'https://gateway.api.globalfishingwatch.org//v1/reports/{}'
-RETRIEVE_URL_ENDPOINT = 'https://gateway.api.globalfishingwatch.org//v1/reports/{}/url'
-
-# related objects
-INITIATE_REPORT_HEADERS = {
-    'Content-Type':'application/json',
-    'Authorization':os.getenv('GFW_API_KEY')
-}
-INQUIRE_STATUS_HEADERS = {
-    'Authorization':os.getenv('GFW_API_KEY')
-}
-RETRIEVE_URL_HEADERS = {
-    'Authorization':os.getenv('GFW_API_KEY')
-}
-
 WORKING_DIR = os.path.join(os.getenv('DOWNLOAD_DIR'), 'gfw-api-data')
 Path(WORKING_DIR).mkdir(parents=True, exist_ok=True)
 
-logger.debug('Generate list of missing entries (zone-year pairs)')
-entries_table = dataset_name
-query_missing = (
-    "SELECT zone.mrgid, zone.geoname, zone.pol_type, zone.year, effort.value FROM ( "
-    "    SELECT zone.mrgid, zone.geoname, zone.pol_type, UNNEST(ARRAY[2012,2013,2014,2015,2016,2017,2018,2019,2020]) AS year "
-    "    FROM com_011_rw1_maritime_boundaries_edit zone "
-    "    WHERE zone.pol_type IN ('200NM','Overlapping claim','Joint regime')) AS zone "
-    "LEFT OUTER JOIN com_030d_fishing_effort_by_zone effort ON (zone.mrgid = effort.mrgid AND zone.year = effort.year) "
-    "WHERE effort.value IS NULL "
-    "ORDER BY geoname ASC, year ASC "
-)
-gdf_missing = read_carto(query_missing)
-print(len(gdf_missing))
+# on-disk record of every zone-year attempted; lets an interrupted run resume
+# (shared with fishing-effort_collect-data.py)
+LEDGER_FILE = os.path.join(WORKING_DIR, 'gfw-api_fishing-effort_ledger.sqlite')
 
 logger.debug('Retrieve polygons from Carto')
 # retrieve polygons from carto
@@ -94,7 +65,29 @@ gdf_zones = read_carto("SELECT *, ST_AsGeoJSON(the_geom) AS the_geom_geojson FRO
         index_col='cartodb_id')
 gdf_zones = gdf_zones.astype({'mrgid':'int','mrgid_ter1':'int','mrgid_sov1':'int',
         'mrgid_eez':'int',})
-gdf_zones['json'] = gdf_zones.the_geom.to_json()
+
+logger.debug('Generate list of missing entries (zone-year pairs)')
+# years for which every zone should have an entry, up to the last one gfw
+# has had time to process
+years = target_years()
+ledger = ReportLedger(LEDGER_FILE)
+# bring the ledger up to date with entries already published, including any
+# added by other runs or scripts
+df_published = read_carto("SELECT mrgid, year, value FROM com_030d_fishing_effort_by_zone WHERE value IS NOT NULL")
+published = set(zip(df_published.mrgid.astype(int), df_published.year.astype(int)))
+completed = ledger.completed()
+for mrgid, year, value in df_published[['mrgid','year','value']].itertuples(index=False):
+    if (int(mrgid), int(year)) not in completed:
+        ledger.record(mrgid, year, value=float(value))
+zone_ids = gdf_zones.mrgid.unique()
+pairs_missing = ledger.missing((mrgid, year) for mrgid in zone_ids for year in years)
+gdf_missing = pd.DataFrame(pairs_missing, columns=['mrgid','year'])
+gdf_missing = gdf_missing.merge(gdf_zones[['mrgid','geoname','pol_type']].drop_duplicates('mrgid'),
+        how='left', on='mrgid')
+gdf_missing['value'] = None
+gdf_missing = gdf_missing[['mrgid','geoname','pol_type','year','value']]
+gdf_missing.sort_values(['geoname','year'], inplace=True, ignore_index=True)
+print(len(gdf_missing))
 
 # combine these together to make a single dataframe from which all query info can be drawn
 
@@ -108,7 +101,7 @@ df_combined = df_combined.astype({'mrgid':'int'})
 del gdf_zones
 
 # create object to track api activity & results
-# mrgid, geoname, year, id, url, zip, csv, value
+# mrgid, geoname, year, id, url, zip, value
 # needed from original table: geoname, pol_type, iso_ter1, iso_sov1, iso_ter2, iso_sov2, iso_ter3, iso_sov3
 col_type_dict = {
     'mrgid':'int',
@@ -124,55 +117,15 @@ col_type_dict = {
     'id':'str',
     'url':'str',
     'zip':'str',
-    'csv':'str',
     'value':'float',
 }
-df_attempts = pd.DataFrame({c: pd.Series(dtype=t) for c, t in col_type_dict.items()})
-
-logger.info('Define functions for submitting API requests and handling responses')
-def build_req_data_postgis_json(report_name, date_pair, geom_geojson,  
-        value=None, geoname=None, mrgid=None, gfw_id=None):
-    # construct data object
-    req_data = {}
-    req_data['name'] = report_name
-    req_data['geometry'] = {}
-    req_data['geometry']['type'] = 'MultiPolygon'
-    req_data['geometry']['properties'] = {}
-    if value is not None: req_data['geometry']['properties']['value'] = value
-    if geoname is not None: req_data['geometry']['properties']['geoname'] = geoname
-    if mrgid is not None: req_data['geometry']['properties']['mrgid'] = mrgid
-    if gfw_id is not None: req_data['geometry']['properties']['gfw_id'] = gfw_id
-    json_dict = json.loads(geom_geojson)
-    # if len(json_dict['features']) > 1: 
-    #     print('warning')
-        # raise Exception('not sure if we want this or will encounter')
-    req_data['geometry']['geometry'] = json_dict
-    # req_data['geometry']['geometry'] = json_dict['features'][0]['geometry']
-    req_data['type'] = 'detail'
-    req_data['timeGroup'] = 'none'
-    req_data['filters'] = ['']
-    req_data['datasets'] = ['public-global-fishing-tracks:latest']
-    date_format = '%Y-%m-%d'
-    req_data['dateRange'] = [date_pair[0].strftime(date_format), date_pair[1].strftime(date_format)]
-    return req_data
 
-def build_req_data_mrgid(report_name, date_pair, mrgid):
-    # construct data object
-    req_data = {}
-    req_data['name'] = report_name
-    req_data['region'] = {'dataset':'public-eez-areas','id':mrgid}
-    req_data['type'] = 'detail'
-    req_data['timeGroup'] = 'none'
-    req_data['filters'] = ['']
-    req_data['datasets'] = ['public-global-fishing-tracks:latest']
-    date_format = '%Y-%m-%d'
-    req_data['dateRange'] = [date_pair[0].strftime(date_format), date_pair[1].strftime(date_format)]
-    return req_data
-
-logger.info('Initiate report generation for missing entries (zone-year pairs)')
+logger.info('Build report requests for missing entries (zone-year pairs)')
 report_name_template = 'Total Observed Fishing Effort in {}, {}'
+jobs = []
 for index, row in df_combined.iterrows():
     # shortcut to skip some unfulfillable requests
+    # no longer needed: the engine now splits reports for these zones into parts
     # skip_list = [
     #     8493, # canada
     #     8492, # indonesia
@@ -182,85 +135,36 @@ for index, row in df_combined.iterrows():
     # if row.mrgid in skip_list:
     #     logger.debug('Skipping '+row.geoname)
     #     continue
-    logger.debug('Request reports for zone: ' + row.geoname + ', ' + str(row.year))
     date_pair = (datetime.strptime(str(row.year)+'-01-01', '%Y-%m-%d'), datetime.strptime(str(row.year)+'-12-31', '%Y-%m-%d'))
     report_name = report_name_template.format(row.geoname, date_pair[0].year)
 
     # req_data = build_req_data_postgis_json(report_name, date_pair, row.the_geom_geojson, 
     #         value=row.geoname, geoname=row.geoname, mrgid=row.mrgid, gfw_id=None)
     req_data = build_req_data_mrgid(report_name, date_pair, row.mrgid)
-    with open(os.path.join(WORKING_DIR, 'postgis.json'), 'w', encoding='utf-8') as f:
-        json.dump(req_data, f, ensure_ascii=False, indent=4)
-
-    r = requests.post(INITIATE_REPORT_ENDPOINT, headers=INITIATE_REPORT_HEADERS, data=json.dumps(req_data))
-    try:
-        r.raise_for_status()
-    except HTTPError as e:
-        logger.error('Failed report generation request for: ' + report_name)
-        logger.error(e.response.text)
-        resp_body = None
-    else:
-        resp_body = r.json()
-    finally:
-        df_attempts.loc[len(df_attempts.index)] = [
-            row.mrgid, row.geoname, row.pol_type,
-            row.iso_ter1, row.iso_sov1, row.iso_ter2, row.iso_sov2, row.iso_ter3, row.iso_sov3, 
-            date_pair[0].year, (None if resp_body is None else resp_body['id']), None, None, None, None,
-        ]
-        time.sleep(5)
-    # break
-
-time.sleep(10800)
-
-logger.info('Retrieve report URLs and download results')
-for index, row in df_attempts.iterrows():
-    if pd.isnull(row.id):
-        continue
-    try:
-        r = requests.get(RETRIEVE_URL_ENDPOINT.format(row.id), headers=RETRIEVE_URL_HEADERS)
-        r.raise_for_status()
-    except HTTPError as e:
-        logger.error('Failed report URL retrieval request for: ' + row.geoname)
-        logger.error(e.response.text)
-        continue
-    resp_body = r.json()
-    url = resp_body['url']
-    df_attempts.loc[index, 'url'] = url
-    zip = os.path.join(WORKING_DIR,row.id+'.zip')
-    df_attempts.loc[index, 'zip'] = zip
-    urllib.request.urlretrieve(url, zip)
-    time.sleep(8)
-    # break
-
-logger.info('Unzip and organize retrieved data')
-for index, row in df_attempts.iterrows():
-    if pd.isnull(row.zip):
-        continue
-    with zipfile.ZipFile(row.zip, 'r') as zip_ref:
-        zip_list = zip_ref.namelist()
-        for f in zip_list:
-            if f.endswith('.csv'):
-                zip_ref.extract(f, path=WORKING_DIR)
-                unzipped_csv = os.path.join(WORKING_DIR, f)
-                renamed_csv = os.path.join(WORKING_DIR, row.geoname.replace(' ','-').replace('/','|')+'_'+str(row.year)+'.csv')
-                os.rename(unzipped_csv, renamed_csv)
-                df_attempts.loc[index, 'csv'] = renamed_csv
-                # break
-    # break
-
-logger.info('Load data, calculate statistics, and record results')
-for index, row in df_attempts.iterrows():
-    if pd.isnull(row.csv):
-        continue
-    try:
-        df_entry = pd.read_csv(row.csv)
-    except EmptyDataError as e:
-        logger.debug('No fishing records for ' + row.geoname + ' in ' + str(row.year))
-        df_attempts.loc[index, 'value'] = 0
-        continue
-    sum = df_entry['Fishing hours'].sum()
-    df_attempts.loc[index, 'value'] = sum
+    jobs.append({
+        'mrgid': row.mrgid, 'geoname': row.geoname, 'pol_type': row.pol_type,
+        'iso_ter1': row.iso_ter1, 'iso_sov1': row.iso_sov1, 'iso_ter2': row.iso_ter2,
+        'iso_sov2': row.iso_sov2, 'iso_ter3': row.iso_ter3, 'iso_sov3': row.iso_sov3,
+        'year': date_pair[0].year, 'report_name': report_name, 'req_data': req_data,
+        # lets a report that cannot be split further by period be split by area
+        'geometry': shape(json.loads(row.the_geom_geojson)),
+    })
     # break
+# keep an example request body on disk for inspection
+if jobs:
+    with open(os.path.join(WORKING_DIR, 'postgis.json'), 'w', encoding='utf-8') as f:
+        json.dump(jobs[-1]['req_data'], f, ensure_ascii=False, indent=4)
+
+logger.info('Submit reports, poll their status, and download and total each as soon as it is ready')
+# retried zones are the slow ones; any report not ready within two hours is
+# split into smaller ones rather than waited on further
+# one limiter paces submissions, status checks, and downloads alike
+limiter = RateLimiter(rate=0.2, max_rate=10)
+engine = ReportEngine(WORKING_DIR, max_pending=20, max_downloads=4, limiter=limiter,
+        poll_initial=60, poll_max=900, report_timeout=2*60*60, ledger=ledger)
+records = engine.run(jobs)
+df_attempts = pd.DataFrame.from_records(records, columns=list(col_type_dict.keys()))
+df_attempts = df_attempts.astype({'mrgid':'int','year':'int','value':'float'})
 
 logger.info('Store results locally and upload them to Carto')
 
@@ -275,12 +179,22 @@ if len(df_failures) > 0:
 
 # do not retain local paths or file url (which ultimately derives
 # from api access, and is probably ephemeral anyway)
-df_attempts.drop(columns=['url','zip','csv'], inplace=True, errors='ignore')
+df_attempts.drop(columns=['url','zip'], inplace=True, errors='ignore')
 reports_csv = os.path.join(WORKING_DIR, 'gfw-api_fishing-effort_retries.csv')
 with contextlib.suppress(FileNotFoundError):
     os.remove(reports_csv)
 df_attempts.to_csv(reports_csv, header=True, index=False, )
 
-record_index = pd.notnull(df_attempts['value'])
-if len(df_attempts[record_index]) > 0:
-    to_carto(df_attempts[record_index], dataset_name, if_exists='append')
\ No newline at end of file
+# upload from the ledger rather than this run's records, so values collected by an
+# earlier run that stopped before uploading them are appended too
+df_reports = ledger.to_dataframe()
+df_reports = df_reports[df_reports.mrgid.isin(zone_ids) & df_reports.year.isin(years)]
+# append only new values; zone-years already published stay as they are
+new_index = pd.Series([(m, y) not in published for m, y in zip(df_reports.mrgid, df_reports.year)],
+        index=df_reports.index)
+df_new = df_reports[new_index & df_reports['value'].notnull()]
+df_new = df_new[[c for c in col_type_dict.keys() if c in df_new.columns and c not in ('url','zip')]]
+if len(df_new) > 0:
+    to_carto(df_new, dataset_name, if_exists='append')
+
+ledger.close()
@@ -0,0 +1,969 @@
+'''
+Shared helpers for requesting, monitoring, and retrieving Global Fishing Watch reports
+Imported by the fishing-effort scripts in this directory
+'''
+import asyncio
+from email.utils import parsedate_to_datetime
+import concurrent.futures
+import functools
+import hashlib
+import json
+import logging
+import os
+import random
+import statistics
+import time
+from datetime import date, datetime, timedelta, timezone
+import zipfile
+
+import pandas as pd
+from pandas.errors import EmptyDataError
+import requests
+import shapely
+from shapely.geometry import MultiPolygon, box, mapping
+from requests.exceptions import ChunkedEncodingError, ConnectionError, HTTPError, Timeout
+
+from gfw_ledger import ZONE_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# fixed items defined by gfw
+GFW_API_BASE = 'https://gateway.api.globalfishingwatch.org/'
+INITIATE_REPORT_ENDPOINT = GFW_API_BASE + '/v1/reports'
+INQUIRE_STATUS_ENDPOINT = GFW_API_BASE + '/v1/reports/{}'
+RETRIEVE_URL_ENDPOINT = GFW_API_BASE + '/v1/reports/{}/url'
+FOURWINGS_REPORT_ENDPOINT = GFW_API_BASE + '/v1/4wings/report'
+FOURWINGS_DATASET = 'public-global-fishing-effort:v20201001'
+# whole globe, within the latitude limits of the 4wings grid
+FOURWINGS_GLOBE = {'type': 'Polygon', 'coordinates': [[[-180, -85.051128], [180, -85.051128],
+        [180, 85.051128], [-180, 85.051128], [-180, -85.051128]]]}
+
+# status values reported by the status endpoint, grouped by how they are handled
+REPORT_STATUS_DONE = ('done', 'completed', 'finished')
+REPORT_STATUS_FAILED = ('failed', 'error', 'cancelled', 'canceled')
+
+# first year of the fishing effort by zone series
+FIRST_YEAR = 2012
+
+def target_years(first_year=FIRST_YEAR, today=None, lag_days=30):
+    '''
+    Years for which fishing effort should be available, derived from the current date
+    A year is included once it has ended and gfw has had lag_days to process it
+    INPUT   first_year: first year of series (int)
+            today: date from which to judge; current date if not provided (date)
+            lag_days: days allowed after the end of a year before it is requested (int)
+    RETURN  years: years to collect, in order (list of ints)
+    '''
+    if today is None:
+        today = date.today()
+    last_year = (today - timedelta(days=lag_days)).year - 1
+    return list(range(first_year, last_year + 1))
+
+def build_headers(api_key=None, content_type=False):
+    '''
+    Build headers for requests to the GFW API
+    INPUT   api_key: GFW API key; read from GFW_API_KEY if not provided (string)
+            content_type: whether to declare a JSON body (boolean)
+    RETURN  headers: request headers (dictionary)
+    '''
+    headers = {'Authorization': api_key if api_key is not None else os.getenv('GFW_API_KEY')}
+    if content_type:
+        headers['Content-Type'] = 'application/json'
+    return headers
+
+# placeholder standing in for pre-encoded geometry while the rest of a body is encoded
+GEOMETRY_PLACEHOLDER = '__encoded_geometry__'
+
+class RawJSON(str):
+    '''Already-encoded JSON, spliced into request bodies as-is by encode_req_data'''
+
+
+def _round_coords(coords, precision):
+    # returns rounded copy of nested GeoJSON coordinates, and number of positions in it
+    if len(coords) and isinstance(coords[0], (int, float)):
+        return [round(c, precision) for c in coords], 1
+    rounded, n = [], 0
+    for c in coords:
+        r, k = _round_coords(c, precision)
+        rounded.append(r)
+        n += k
+    return rounded, n
+
+def encode_geometry(geom, tolerance=0.01, precision=4):
+    '''
+    Encode geometry as compact GeoJSON for inclusion in a report request
+    INPUT   geom: zone geometry (shapely geometry)
+            tolerance: simplification tolerance, in degrees; 0 to keep every vertex (numeric)
+            precision: number of decimal places retained in coordinates (int)
+    RETURN  geom_geojson: encoded geometry (RawJSON)
+            n_in: number of positions in original geometry (int)
+            n_out: number of positions in encoded geometry (int)
+    '''
+    n_in = int(shapely.get_num_coordinates(geom))
+    if tolerance:
+        # preserve_topology keeps rings valid, so no part of the zone is dropped
+        geom = geom.simplify(tolerance, preserve_topology=True)
+    geom_dict = mapping(geom)
+    coords, n_out = _round_coords(geom_dict['coordinates'], precision)
+    encoded = json.dumps({'type': geom_dict['type'], 'coordinates': coords}, separators=(',', ':'))
+    return RawJSON(encoded), n_in, n_out
+
+def encode_req_data(req_data):
+    '''
+    Encode report request body, splicing in geometry that is already encoded
+    INPUT   req_data: request body (dictionary)
+    RETURN  body: encoded request body (string)
+    '''
+    geometry = req_data.get('geometry', {}).get('geometry')
+    if not isinstance(geometry, RawJSON):
+        return json.dumps(req_data)
+    req_data = dict(req_data, geometry=dict(req_data['geometry'], geometry=GEOMETRY_PLACEHOLDER))
+    return json.dumps(req_data).replace(json.dumps(GEOMETRY_PLACEHOLDER), geometry, 1)
+
+
+class GeometryCache:
+    '''
+    Encoded request geometry for each zone, prepared once and reused for every year requested
+    Entries are keyed by mrgid and validated against a hash of the source geometry and
+    encoding settings, so edits to a zone or to the settings are picked up automatically
+    '''
+    def __init__(self, tolerance=0.01, precision=4, cache_dir=None):
+        '''
+        INPUT   tolerance: simplification tolerance, in degrees (numeric)
+                precision: number of decimal places retained in coordinates (int)
+                cache_dir: directory in which to keep encoded geometries between runs;
+                    memory only if not provided (string)
+        '''
+        self.tolerance = tolerance
+        self.precision = precision
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._cache = {}
+        self.stats = []
+
+    def _digest(self, geom):
+        h = hashlib.sha1(geom.wkb)
+        h.update('{}|{}'.format(self.tolerance, self.precision).encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, mrgid, geom):
+        '''
+        INPUT   mrgid: marine regions identifier of zone (int)
+                geom: zone geometry (shapely geometry)
+        RETURN  geom_geojson: encoded geometry (RawJSON)
+        '''
+        digest = self._digest(geom)
+        cached = self._cache.get(mrgid)
+        if cached is not None and cached[0] == digest:
+            return cached[1]
+        cache_file = None
+        if self.cache_dir is not None:
+            cache_file = os.path.join(self.cache_dir, '{}_{}.json'.format(mrgid, digest))
+            if os.path.isfile(cache_file):
+                with open(cache_file, 'r', encoding='utf-8') as f:
+                    encoded = RawJSON(f.read())
+                self._cache[mrgid] = (digest, encoded)
+                return encoded
+        started = time.perf_counter()
+        encoded, n_in, n_out = encode_geometry(geom, self.tolerance, self.precision)
+        seconds = time.perf_counter() - started
+        self.stats.append({'mrgid': mrgid, 'positions_in': n_in, 'positions_out': n_out,
+                'bytes': len(encoded), 'seconds': seconds})
+        logger.debug('Prepared geometry for mrgid {}: {} -> {} positions, {:.1f} kB, {:.3f}s'.format(
+                mrgid, n_in, n_out, len(encoded) / 1024, seconds))
+        if cache_file is not None:
+            with open(cache_file, 'w', encoding='utf-8') as f:
+                f.write(encoded)
+        self._cache[mrgid] = (digest, encoded)
+        return encoded
+
+    def log_summary(self):
+        '''
+        Log size of prepared payloads and time spent preparing them
+        '''
+        if not self.stats:
+            return
+        sizes = [s['bytes'] for s in self.stats]
+        logger.info('Prepared {} geometries: {:.0f}% of original positions, '
+                '{:.1f} kB mean / {:.1f} kB max payload, {:.1f}s serializing'.format(
+                len(self.stats),
+                100 * sum(s['positions_out'] for s in self.stats) / max(1, sum(s['positions_in'] for s in self.stats)),
+                statistics.mean(sizes) / 1024, max(sizes) / 1024,
+                sum(s['seconds'] for s in self.stats)))
+
+def build_req_data_postgis_json(report_name, date_pair, geom_geojson,
+        value=None, geoname=None, mrgid=None, gfw_id=None):
+    '''
+    Construct body of report request for a zone defined by its own geometry
+    INPUT   report_name: name of report (string)
+            date_pair: start and end of report period (tuple of dates)
+            geom_geojson: zone geometry, as returned by ST_AsGeoJSON or GeometryCache (string)
+            value, geoname, mrgid, gfw_id: optional properties attached to geometry
+    RETURN  req_data: request body (dictionary)
+    '''
+    req_data = {}
+    req_data['name'] = report_name
+    req_data['geometry'] = {}
+    req_data['geometry']['type'] = 'MultiPolygon'
+    req_data['geometry']['properties'] = {}
+    if value is not None: req_data['geometry']['properties']['value'] = value
+    if geoname is not None: req_data['geometry']['properties']['geoname'] = geoname
+    if mrgid is not None: req_data['geometry']['properties']['mrgid'] = mrgid
+    if gfw_id is not None: req_data['geometry']['properties']['gfw_id'] = gfw_id
+    if isinstance(geom_geojson, RawJSON):
+        # already encoded; spliced into the body as-is by encode_req_data
+        req_data['geometry']['geometry'] = geom_geojson
+    else:
+        req_data['geometry']['geometry'] = json.loads(geom_geojson)
+    req_data['type'] = 'detail'
+    req_data['timeGroup'] = 'none'
+    req_data['filters'] = ['']
+    req_data['datasets'] = ['public-global-fishing-tracks:latest']
+    date_format = '%Y-%m-%d'
+    req_data['dateRange'] = [date_pair[0].strftime(date_format), date_pair[1].strftime(date_format)]
+    return req_data
+
+def build_req_data_mrgid(report_name, date_pair, mrgid):
+    '''
+    Construct body of report request for a zone known to GFW by its mrgid
+    INPUT   report_name: name of report (string)
+            date_pair: start and end of report period (tuple of dates)
+            mrgid: marine regions identifier of zone (int)
+    RETURN  req_data: request body (dictionary)
+    '''
+    req_data = {}
+    req_data['name'] = report_name
+    req_data['region'] = {'dataset':'public-eez-areas','id':mrgid}
+    req_data['type'] = 'detail'
+    req_data['timeGroup'] = 'none'
+    req_data['filters'] = ['']
+    req_data['datasets'] = ['public-global-fishing-tracks:latest']
+    date_format = '%Y-%m-%d'
+    req_data['dateRange'] = [date_pair[0].strftime(date_format), date_pair[1].strftime(date_format)]
+    return req_data
+
+
+def sum_report_zip(zip_path, columns=('Fishing hours',), chunksize=200000):
+    '''
+    Sum columns of the CSV(s) in a report archive, reading them straight from the
+    archive in chunks so that nothing is extracted to disk or held in memory in full
+    INPUT   zip_path: location of report archive (string)
+            columns: columns to sum (sequence of strings)
+            chunksize: number of rows to parse at a time (int)
+    RETURN  sums: total of each column; zero for a report with no records (dictionary)
+    '''
+    sums = {c: 0.0 for c in columns}
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for member in zip_ref.namelist():
+            if not member.endswith('.csv'):
+                continue
+            with zip_ref.open(member) as f:
+                try:
+                    reader = pd.read_csv(f, usecols=list(columns), chunksize=chunksize)
+                except EmptyDataError:
+                    # report generated, but no fishing records in it
+                    continue
+                for chunk in reader:
+                    for c in columns:
+                        sums[c] += chunk[c].sum()
+    return sums
+
+
+def download_4wings_report(year, path, api_key=None, spatial_resolution='low',
+        dataset=FOURWINGS_DATASET, geojson=None):
+    '''
+    Download gridded fishing effort for one year from the 4wings report API
+    INPUT   year: year of report (int)
+            path: location in which to store report (string)
+            api_key: GFW API key; read from GFW_API_KEY if not provided (string)
+            spatial_resolution: 'low' (tenth degree) or 'high' (hundredth degree) (string)
+            dataset: 4wings dataset to report on (string)
+            geojson: area to report on; whole globe if not provided (dictionary)
+    RETURN  path: location of stored report, zip or csv (string)
+    RAISE   DownloadIncomplete or zipfile.BadZipFile if the report did not arrive whole
+    '''
+    params = {
+        'spatial-resolution': spatial_resolution,
+        'temporal-resolution': 'yearly',
+        'datasets[0]': dataset,
+        'date-range': '{}-01-01T00:00:00.000Z,{}-01-01T00:00:00.000Z'.format(year, year + 1),
+        'format': 'csv',
+    }
+    body = {'geojson': geojson if geojson is not None else FOURWINGS_GLOBE}
+    # fetch into a .part file and only move it into place once it is confirmed whole,
+    # so an interrupted download is never mistaken for a finished one
+    part = path + '.part'
+    with requests.post(FOURWINGS_REPORT_ENDPOINT, params=params, json=body,
+            headers=build_headers(api_key, content_type=True), stream=True) as r:
+        r.raise_for_status()
+        expected = content_total(r)
+        with open(part, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=1024*1024):
+                f.write(chunk)
+    size = os.path.getsize(part)
+    if expected is not None and size != expected:
+        raise DownloadIncomplete('Received {} of {} bytes: {}'.format(size, expected, path))
+    if zipfile.is_zipfile(part):
+        verify_zip(part)
+    os.replace(part, path)
+    return path
+
+def sum_gridded_effort_by_zone(report_path, gdf_zones, lat_col='Lat', lon_col='Lon',
+        value_col='Apparent Fishing hours', chunksize=500000):
+    '''
+    Total gridded fishing effort within each zone, matching grid cells to zones
+    through the spatial index of the zones, one chunk of cells at a time
+    INPUT   report_path: 4wings report, zip or csv (string)
+            gdf_zones: zones with 'mrgid' and geometry (GeoDataFrame)
+            lat_col, lon_col: columns holding grid cell coordinates (string)
+            value_col: column holding fishing effort (string)
+            chunksize: number of grid cells to process at a time (int)
+    RETURN  sums: total effort per zone; zero for zones without any (Series indexed by mrgid)
+    '''
+    # imported here so that geopandas is only required by the gridded mode
+    import geopandas as gpd
+
+    zones = gdf_zones[['mrgid', gdf_zones.geometry.name]].reset_index(drop=True)
+    # build the spatial index once, before the first chunk is joined
+    zones.sindex
+    partials = []
+
+    def add_chunks(f):
+        for chunk in pd.read_csv(f, usecols=[lat_col, lon_col, value_col], chunksize=chunksize):
+            points = gpd.GeoDataFrame(chunk[[value_col]],
+                    geometry=gpd.points_from_xy(chunk[lon_col], chunk[lat_col]), crs=zones.crs)
+            matched = gpd.sjoin(points, zones, how='inner', predicate='within')
+            partials.append(matched.groupby('mrgid')[value_col].sum())
+
+    if zipfile.is_zipfile(report_path):
+        with zipfile.ZipFile(report_path, 'r') as zip_ref:
+            for member in zip_ref.namelist():
+                if member.endswith('.csv'):
+                    with zip_ref.open(member) as f:
+                        add_chunks(f)
+    else:
+        with open(report_path, 'rb') as f:
+            add_chunks(f)
+    if partials:
+        sums = pd.concat(partials).groupby(level=0).sum()
+    else:
+        sums = pd.Series(dtype='float')
+    return sums.reindex(pd.Index(zones['mrgid'].unique(), name='mrgid'), fill_value=0.0)
+
+def parse_retry_after(value):
+    '''
+    Interpret Retry-After header, which may be a number of seconds or an HTTP date
+    INPUT   value: header value; None if absent (string)
+    RETURN  seconds: seconds to wait; None if absent or unreadable (numeric)
+    '''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class RateLimiter:
+    '''
+    Token bucket shared by every call made to the GFW API
+    The rate grows while calls succeed and is cut back, with a pause for any
+    Retry-After, whenever the API answers 429, so throughput settles just under
+    the real quota rather than at a pessimistic constant
+
+    Until the first 429 the rate grows by a fixed share with each accepted request,
+    to find the quota quickly. After a 429 it follows a cubic curve in the time
+    since the cut, as in TCP CUBIC: it climbs fast back towards the rate at which
+    the 429 came, levels off there, then probes beyond it. Adding a constant per
+    request instead left the rate far below the quota for minutes after each cut
+    '''
+    def __init__(self, rate=1.0, burst=5, min_rate=0.05, max_rate=20.0,
+            increase=0.05, decrease=0.5, cubic=0.04, log_interval=300):
+        '''
+        INPUT   rate: initial requests per second (numeric)
+                burst: maximum number of requests that may be made back to back (int)
+                min_rate, max_rate: bounds on requests per second (numeric)
+                increase: share by which rate grows with each accepted request before
+                    the first 429; 0.05 doubles it in about 14 requests (numeric)
+                decrease: factor applied to rate after a 429 (numeric)
+                cubic: scale of the cubic recovery, in requests per second per second cubed;
+                    0.04 regains the rate of the last 429 in about 5 s from a cut to half
+                    of 10 req/s, and about 2 s from half of 1 req/s (numeric)
+                log_interval: seconds between reports of effective rate (numeric)
+        '''
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cubic = cubic
+        self.log_interval = log_interval
+        # rate at the last 429, and when it came; None until the first
+        self.rate_at_throttle = None
+        self.throttled_at = None
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.n_requests = 0
+        self.n_throttled = 0
+        self._window_start = time.monotonic()
+        self._window_requests = 0
+        self._lock = None
+        self._loop = None
+
+    def _get_lock(self):
+        # a lock belongs to the event loop it was first used in
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._lock = asyncio.Lock()
+            self._loop = loop
+        return self._lock
+
+    async def acquire(self):
+        '''
+        Wait until a request may be made
+        '''
+        async with self._get_lock():
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+        self.n_requests += 1
+        self._window_requests += 1
+        self._log_rate()
+
+    def succeeded(self):
+        '''
+        Note a request accepted by the API
+        '''
+        if self.rate_at_throttle is None:
+            rate = self.rate * (1 + self.increase)
+        else:
+            # time the curve takes to climb from the cut back to the rate of the last 429
+            k = (self.rate_at_throttle * (1 - self.decrease) / self.cubic) ** (1 / 3)
+            t = time.monotonic() - self.throttled_at
+            rate = self.rate_at_throttle + self.cubic * (t - k) ** 3
+        self.rate = min(self.max_rate, max(self.min_rate, rate))
+
+    def throttled(self, retry_after=None):
+        '''
+        Note a request rejected with 429, slowing down and pausing as asked
+        INPUT   retry_after: Retry-After header of response, if any (string)
+        '''
+        self.n_throttled += 1
+        now = time.monotonic()
+        # requests sent together are refused together; cut the rate once for all of them
+        if now >= self.blocked_until:
+            self.rate_at_throttle = self.rate
+            self.throttled_at = now
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+        delay = parse_retry_after(retry_after)
+        if delay is None:
+            delay = 1 / self.rate
+        self.blocked_until = max(self.blocked_until, now + delay)
+        self.tokens = 0.0
+        logger.warning('GFW API asked to slow down; pausing {:.0f}s, rate now {:.2f} req/s'.format(
+                delay, self.rate))
+
+    def _log_rate(self, force=False):
+        now = time.monotonic()
+        elapsed = now - self._window_start
+        if not force and elapsed < self.log_interval:
+            return
+        logger.info('GFW API effective rate: {:.2f} req/s over last {:.0f}s (limit {:.2f} req/s, '
+                '{} requests, {} throttled in total)'.format(self._window_requests / max(elapsed, 1e-9),
+                elapsed, self.rate, self.n_requests, self.n_throttled))
+        self._window_start = now
+        self._window_requests = 0
+
+    def log_summary(self):
+        '''
+        Log rate achieved since the last periodic report
+        '''
+        self._log_rate(force=True)
+
+
+def split_date_range(date_range, min_days=31):
+    '''
+    Split report period in two
+    INPUT   date_range: first and last day of period, as in req_data['dateRange'] (list of strings)
+            min_days: shortest period that may be split (int)
+    RETURN  date_ranges: two halves of period; None if too short to split (list of lists)
+    '''
+    date_format = '%Y-%m-%d'
+    start = datetime.strptime(date_range[0], date_format).date()
+    end = datetime.strptime(date_range[1], date_format).date()
+    if (end - start).days + 1 < min_days:
+        return None
+    mid = start + (end - start) // 2
+    return [[start.strftime(date_format), mid.strftime(date_format)],
+            [(mid + timedelta(days=1)).strftime(date_format), end.strftime(date_format)]]
+
+def _polygonal(geom):
+    # polygons of geometry, dropping any lines or points left along a cut
+    if geom.is_empty:
+        return []
+    if geom.geom_type == 'Polygon':
+        return [geom]
+    if hasattr(geom, 'geoms'):
+        return [p for g in geom.geoms for p in _polygonal(g)]
+    return []
+
+def split_geometry(geom):
+    '''
+    Split zone into two parts of similar size that together cover it exactly
+    Separate polygons of a MultiPolygon are shared out by area; a single polygon
+    is cut across the longer side of its bounding box
+    INPUT   geom: zone geometry (shapely geometry)
+    RETURN  parts: two polygonal parts; None if geometry cannot be split (list of MultiPolygons)
+    '''
+    polygons = _polygonal(geom)
+    if len(polygons) > 1:
+        groups, areas = [[], []], [0.0, 0.0]
+        for polygon in sorted(polygons, key=lambda p: p.area, reverse=True):
+            i = areas.index(min(areas))
+            groups[i].append(polygon)
+            areas[i] += polygon.area
+        return [MultiPolygon(g) for g in groups]
+    if not polygons:
+        return None
+    minx, miny, maxx, maxy = geom.bounds
+    if maxx - minx >= maxy - miny:
+        mid = (minx + maxx) / 2
+        halves = [box(minx, miny, mid, maxy), box(mid, miny, maxx, maxy)]
+    else:
+        mid = (miny + maxy) / 2
+        halves = [box(minx, miny, maxx, mid), box(minx, mid, maxx, maxy)]
+    parts = [MultiPolygon(_polygonal(geom.intersection(h))) for h in halves]
+    parts = [p for p in parts if not p.is_empty]
+    return parts if len(parts) == 2 else None
+
+def split_job(job, min_days=90, tolerance=0.01, precision=4):
+    '''
+    Divide a report into two smaller ones whose results sum to the original's
+    Splits the report period while it is at least min_days long, then the zone
+    geometry, if the job provides it as 'geometry'
+    INPUT   job: report to split, as passed to ReportEngine (dictionary)
+            min_days: shortest period that may be split (int)
+            tolerance, precision: encoding settings for split geometry (see encode_geometry)
+    RETURN  jobs: two smaller reports; None if the report cannot be split (list of dictionaries)
+    '''
+    req_data = job['req_data']
+    date_ranges = split_date_range(req_data['dateRange'], min_days=min_days)
+    if date_ranges is not None:
+        jobs = []
+        for i, date_range in enumerate(date_ranges):
+            sub_job = dict(job, report_name='{} ({} to {})'.format(job['report_name'], *date_range))
+            sub_job['req_data'] = dict(req_data, name=sub_job['report_name'], dateRange=date_range)
+            jobs.append(sub_job)
+        return jobs
+    if job.get('geometry') is None:
+        return None
+    parts = split_geometry(job['geometry'])
+    if parts is None:
+        return None
+    date_format = '%Y-%m-%d'
+    date_pair = [datetime.strptime(d, date_format).date() for d in req_data['dateRange']]
+    jobs = []
+    for i, part in enumerate(parts):
+        report_name = '{} (area {}/{})'.format(job['report_name'], i + 1, len(parts))
+        geom_geojson, _, _ = encode_geometry(part, tolerance, precision)
+        sub_req_data = build_req_data_postgis_json(report_name, date_pair, geom_geojson)
+        sub_req_data['geometry']['properties'] = dict(req_data.get('geometry', {}).get('properties', {}))
+        jobs.append(dict(job, report_name=report_name, req_data=sub_req_data, geometry=part))
+    return jobs
+
+def content_total(response, offset=0):
+    '''
+    Full size of file being downloaded, from Content-Range or Content-Length
+    INPUT   response: response to (possibly ranged) GET (requests.Response)
+            offset: byte at which the response body starts (int)
+    RETURN  size: size in bytes; None if not declared (int)
+    '''
+    content_range = response.headers.get('Content-Range', '')
+    if '/' in content_range and not content_range.endswith('/*'):
+        return int(content_range.rsplit('/', 1)[1])
+    if response.headers.get('Content-Length') is not None and \
+            response.headers.get('Content-Encoding') in (None, 'identity'):
+        return offset + int(response.headers['Content-Length'])
+    return None
+
+def verify_zip(path):
+    '''
+    Confirm that archive is complete and that every member matches its CRC
+    INPUT   path: location of archive (string)
+    RETURN  None; raises zipfile.BadZipFile if archive is damaged
+    '''
+    with zipfile.ZipFile(path, 'r') as zip_ref:
+        bad = zip_ref.testzip()
+    if bad is not None:
+        raise zipfile.BadZipFile('CRC mismatch in ' + bad)
+
+class ReportFailed(Exception):
+    '''Report could not be generated or retrieved'''
+
+
+class ReportSplittable(ReportFailed):
+    '''Report failed or timed out while being generated; smaller reports may not'''
+
+
+class DownloadIncomplete(Exception):
+    '''Download ended before the whole file arrived'''
+
+
+class ReportEngine:
+    '''
+    Drive each report through submission, status polling, URL retrieval, and download
+    as its own asyncio task, so that every report is collected as soon as it is ready
+    rather than after a fixed wait sized for the slowest one
+
+    Blocking requests calls run on a private thread pool; a shared session keeps
+    connections to the gateway alive between calls
+    '''
+    def __init__(self, working_dir, api_key=None, max_pending=20, max_downloads=4,
+            limiter=None, poll_initial=15.0, poll_factor=1.5, poll_max=600.0,
+            report_timeout=6*60*60, ledger=None, api_base=GFW_API_BASE,
+            value_column='Fishing hours', max_split_depth=5, min_split_days=90,
+            download_attempts=5):
+        '''
+        INPUT   working_dir: directory in which to store downloaded report archives (string)
+                api_key: GFW API key; read from GFW_API_KEY if not provided (string)
+                max_pending: maximum number of reports being generated at once (int)
+                max_downloads: maximum number of simultaneous downloads; downloads share
+                    the session's pooled connections (int)
+                limiter: rate limit shared by all calls to the API; a default RateLimiter
+                    if not provided (RateLimiter)
+                poll_initial: seconds before first status check of a report (numeric)
+                poll_factor: growth of wait between successive status checks (numeric)
+                poll_max: maximum seconds between status checks (numeric)
+                report_timeout: seconds after which a pending report is abandoned (numeric)
+                ledger: record of progress to resume from and update; jobs must then
+                    provide 'mrgid' and 'year' (ReportLedger)
+                api_base: root of the reports API, for pointing the engine elsewhere,
+                    e.g. at gfw_fake_api.py (string)
+                value_column: report column summed into each record's 'value' (string)
+                max_split_depth: how many times a failed or timed-out report may be
+                    halved, by period and then by geometry, before giving up (int)
+                min_split_days: shortest report period that may be halved (int)
+                download_attempts: attempts at each download, each resuming the last (int)
+        '''
+        self.working_dir = working_dir
+        self.api_key = api_key
+        self.max_pending = max_pending
+        self.max_downloads = max_downloads
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.max_throttled = 10
+        self.poll_initial = poll_initial
+        self.poll_factor = poll_factor
+        self.poll_max = poll_max
+        self.report_timeout = report_timeout
+        self.ledger = ledger
+        self.initiate_endpoint = api_base + '/v1/reports'
+        self.status_endpoint = api_base + '/v1/reports/{}'
+        self.url_endpoint = api_base + '/v1/reports/{}/url'
+        self.value_column = value_column
+        self.max_split_depth = max_split_depth
+        self.min_split_days = min_split_days
+        self.download_attempts = download_attempts
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_pending + max_downloads)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._durations = []
+
+    async def _request(self, method, url, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = functools.partial(self.session.request, method, url, **kwargs)
+        for attempt in range(self.max_throttled + 1):
+            await self.limiter.acquire()
+            r = await loop.run_in_executor(self._executor, call)
+            if r.status_code != 429:
+                self.limiter.succeeded()
+                return r
+            self.limiter.throttled(r.headers.get('Retry-After'))
+        return r
+
+    async def _submit(self, job):
+        r = await self._request('POST', self.initiate_endpoint,
+                headers=build_headers(self.api_key, content_type=True),
+                data=encode_req_data(job['req_data']))
+        try:
+            r.raise_for_status()
+        except HTTPError as e:
+            raise ReportFailed('Failed report generation request: ' + e.response.text) from e
+        return r.json()['id']
+
+    def _first_poll_delay(self):
+        # reports of similar size tend to take similar time, so once a few have
+        # finished there is little point asking about a new one much sooner
+        if len(self._durations) < 3:
+            return self.poll_initial
+        return max(self.poll_initial, 0.5 * statistics.median(self._durations))
+
+    async def _wait_until_done(self, report_id, submitted=None):
+        # submitted is the time a report picked up from an earlier run was submitted;
+        # it is checked at once and times out on the clock of its submission
+        started = time.monotonic()
+        delay = self._first_poll_delay()
+        if submitted is not None:
+            started -= max(0.0, time.time() - submitted)
+            delay = 0
+        while True:
+            await asyncio.sleep(delay * random.uniform(0.9, 1.1))
+            r = await self._request('GET', self.status_endpoint.format(report_id),
+                    headers=build_headers(self.api_key))
+            try:
+                r.raise_for_status()
+            except HTTPError as e:
+                raise ReportFailed('Failed report status request: ' + e.response.text) from e
+            status = str(r.json().get('status', '')).lower()
+            elapsed = time.monotonic() - started
+            if status in REPORT_STATUS_DONE:
+                if submitted is None:
+                    self._durations.append(elapsed)
+                return
+            if status in REPORT_STATUS_FAILED:
+                raise ReportSplittable('Report generation ended with status: ' + status)
+            if elapsed > self.report_timeout:
+                raise ReportSplittable('Report generation timed out after {:.0f}s'.format(elapsed))
+            delay = min(delay * self.poll_factor, self.poll_max)
+
+    async def _retrieve_url(self, report_id):
+        r = await self._request('GET', self.url_endpoint.format(report_id),
+                headers=build_headers(self.api_key))
+        try:
+            r.raise_for_status()
+        except HTTPError as e:
+            raise ReportFailed('Failed report URL retrieval request: ' + e.response.text) from e
+        return r.json()['url']
+
+    def _download_attempt(self, url, zip):
+        # one attempt at fetching into a .part file, resuming from whatever an earlier
+        # attempt left there, and moving it into place once its size and checksums are confirmed
+        # returns response of a throttled attempt, for the caller to back off; None on success
+        part = zip + '.part'
+        offset = os.path.getsize(part) if os.path.isfile(part) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+        with self.session.get(url, stream=True, headers=headers, timeout=60) as r:
+            if r.status_code == 429:
+                return r
+            if r.status_code == 416:
+                # nothing left to fetch; the checks below decide if the file is whole
+                expected = None
+            else:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    # server sent the whole file rather than the requested range
+                    offset = 0
+                expected = content_total(r, offset)
+                with open(part, 'ab' if offset else 'wb') as f:
+                    for chunk in r.iter_content(chunk_size=1024*1024):
+                        f.write(chunk)
+        size = os.path.getsize(part)
+        if expected is not None and size != expected:
+            raise DownloadIncomplete('Received {} of {} bytes'.format(size, expected))
+        try:
+            verify_zip(part)
+        except zipfile.BadZipFile:
+            os.remove(part)
+            raise
+        os.replace(part, zip)
+        return None
+
+    async def _download(self, url, zip):
+        # every attempt, including those resuming an interrupted one, waits its turn
+        # with the limiter and reports back to it like any other call to the API
+        async with self._download_slots:
+            loop = asyncio.get_running_loop()
+            n_failed = 0
+            n_throttled = 0
+            while True:
+                await self.limiter.acquire()
+                try:
+                    throttled = await loop.run_in_executor(self._executor,
+                            functools.partial(self._download_attempt, url, zip))
+                except (ConnectionError, ChunkedEncodingError, Timeout, DownloadIncomplete) as e:
+                    logger.debug('Download interrupted, resuming: ' + zip + ': ' + str(e))
+                except zipfile.BadZipFile as e:
+                    logger.debug('Downloaded archive is corrupt, starting over: ' + zip + ': ' + str(e))
+                else:
+                    if throttled is None:
+                        self.limiter.succeeded()
+                        return
+                    self.limiter.throttled(throttled.headers.get('Retry-After'))
+                    n_throttled += 1
+                    if n_throttled > self.max_throttled:
+                        raise ReportFailed('Download repeatedly throttled')
+                    continue
+                n_failed += 1
+                if n_failed >= self.download_attempts:
+                    raise ReportFailed('Download failed after {} attempts: {}'.format(self.download_attempts, zip))
+
+    def _record(self, job, **fields):
+        # mirror progress into the ledger, if one is in use, so an interrupted run can resume
+        if self.ledger is None:
+            return
+        zone_fields = {k: job[k] for k in ZONE_FIELDS if k in job}
+        self.ledger.record(job['mrgid'], job['year'], **zone_fields, **fields)
+
+    async def _resume(self, job, entry):
+        # pick up a report submitted by an earlier run; returns its id if it finished
+        # a report that has failed or run out of time raises ReportSplittable, to be
+        # split rather than submitted whole again
+        try:
+            await self._wait_until_done(entry['id'], submitted=entry['submitted'])
+        except ReportSplittable:
+            raise
+        except ReportFailed as e:
+            logger.debug('Unable to resume report for ' + job['report_name'] + ', resubmitting: ' + str(e))
+            return None
+        return entry['id']
+
+    async def _value(self, zip):
+        loop = asyncio.get_running_loop()
+        sums = await loop.run_in_executor(self._executor,
+                functools.partial(sum_report_zip, zip, columns=[self.value_column]))
+        return float(sums[self.value_column])
+
+    async def _run_report(self, job, entry=None, track=True):
+        # one report from submission to value; progress goes to the ledger if track is set
+        record = {}
+        async with self._pending_slots:
+            report_id = None
+            if entry is not None and entry['id'] and not entry['error']:
+                report_id = await self._resume(job, entry)
+            if report_id is None:
+                report_id = await self._submit(job)
+                if track:
+                    self._record(job, id=report_id, url=None, zip=None, value=None, error=None,
+                            submitted=time.time(), failed=None)
+                await self._wait_until_done(report_id)
+            record['id'] = report_id
+        record['url'] = await self._retrieve_url(record['id'])
+        if track:
+            self._record(job, url=record['url'])
+        zip = os.path.join(self.working_dir, record['id'] + '.zip')
+        await self._download(record['url'], zip)
+        record['zip'] = zip
+        if track:
+            self._record(job, zip=zip)
+        record['value'] = await self._value(zip)
+        return record
+
+    async def _run_split(self, job, depth, parent, reason=None):
+        # collect report in parts, halving again any part that also fails on the API's side
+        # reason is given for a newly failed report, to be recorded before its parts begin
+        sub_jobs = split_job(job, min_days=self.min_split_days)
+        if sub_jobs is None:
+            raise ReportFailed('Report cannot be split further: ' + job['report_name'])
+        if reason is not None and job is parent:
+            self._record(job, split=reason)
+        elif reason is not None and self.ledger is not None:
+            self.ledger.record_part(parent['mrgid'], parent['year'], job['report_name'], split=reason)
+        logger.info('Splitting report into {} parts: {}'.format(len(sub_jobs), job['report_name']))
+        values = await asyncio.gather(*[self._run_part(sub_job, depth, parent) for sub_job in sub_jobs])
+        return sum(v for v, n in values), sum(n for v, n in values)
+
+    async def _run_part(self, job, depth, parent):
+        # returns value of part and number of reports it took
+        # parts are recorded against the zone-year of parent, so a resumed run reuses
+        # finished parts and goes straight to the parts of those that were split
+        entry = None
+        if self.ledger is not None:
+            entry = self.ledger.get_part(parent['mrgid'], parent['year'], job['report_name'])
+        if entry is not None and entry['value'] is not None:
+            return entry['value'], 1
+        if entry is not None and entry['split'] and depth < self.max_split_depth:
+            return await self._run_split(job, depth + 1, parent)
+        try:
+            record = await self._run_report(job, track=False)
+        except ReportSplittable as e:
+            if depth >= self.max_split_depth:
+                raise
+            logger.debug('Part failed, splitting further: ' + job['report_name'] + ': ' + str(e))
+            return await self._run_split(job, depth + 1, parent, reason=str(e))
+        if self.ledger is not None:
+            self.ledger.record_part(parent['mrgid'], parent['year'], job['report_name'], value=record['value'])
+        return record['value'], 1
+
+    async def _collect(self, job):
+        record = {k: v for k, v in job.items() if k not in ('req_data', 'geometry')}
+        record.update({'id': None, 'url': None, 'zip': None, 'value': None, 'parts': 1, 'error': None})
+        entry = None
+        if self.ledger is not None:
+            entry = self.ledger.get(job['mrgid'], job['year'])
+        try:
+            if entry is not None and entry['zip'] and os.path.isfile(entry['zip']):
+                logger.debug('Report already downloaded: ' + job['report_name'])
+                record.update({'id': entry['id'], 'url': entry['url'], 'zip': entry['zip']})
+                record['value'] = await self._value(entry['zip'])
+            elif entry is not None and entry['split'] and self.max_split_depth >= 1:
+                # report failed in an earlier run; its parts take over from it
+                logger.debug('Report already split, collecting parts: ' + job['report_name'])
+                record['value'], record['parts'] = await self._run_split(job, 1, job)
+            elif entry is not None and entry['failed'] and self.max_split_depth >= 1:
+                # report failed in an earlier run that stopped before splitting it
+                logger.info('Report already failed, collecting it in parts: ' + job['report_name'])
+                record['value'], record['parts'] = await self._run_split(job, 1, job, reason=entry['failed'])
+            else:
+                try:
+                    record.update(await self._run_report(job, entry=entry))
+                except ReportSplittable as e:
+                    if self.max_split_depth < 1:
+                        raise
+                    # large zones can fail or time out as a whole; smaller parts may not
+                    # errors in making requests, e.g. a bad key or body, would fail the parts too
+                    logger.info('Report failed, collecting it in parts: ' + job['report_name'] + ': ' + str(e))
+                    self._record(job, failed=str(e))
+                    record['value'], record['parts'] = await self._run_split(job, 1, job, reason=str(e))
+            self._record(job, value=record['value'], error=None)
+        except (ReportFailed, requests.RequestException, KeyError, ValueError, zipfile.BadZipFile) as e:
+            # unexpected response bodies or report contents fail this job only, not the whole run
+            logger.error('Failed to collect report: ' + job['report_name'])
+            logger.error(e)
+            record['error'] = '{}: {}'.format(type(e).__name__, e)
+            self._record(job, error=record['error'])
+        else:
+            logger.debug('Collected report: ' + job['report_name'])
+        return record
+
+    async def collect_all(self, jobs):
+        '''
+        Collect all reports concurrently
+        INPUT   jobs: reports to collect; each must provide 'report_name' and 'req_data',
+                    and any other keys are passed through to its record (list of dictionaries)
+                    jobs may also provide 'geometry' (shapely geometry) so that a report
+                    that fails can be split by area once its period cannot be split further
+        RETURN  records: one record per job, in job order, with report 'id', 'url', 'zip',
+                    'value', number of 'parts' it was collected in, and 'error' added
+                    (list of dictionaries)
+        '''
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_pending + self.max_downloads)
+        self._pending_slots = asyncio.Semaphore(self.max_pending)
+        self._download_slots = asyncio.Semaphore(self.max_downloads)
+        try:
+            return await asyncio.gather(*[self._collect(job) for job in jobs])
+        finally:
+            self.limiter.log_summary()
+            self._executor.shutdown(wait=False)
+
+    def run(self, jobs):
+        '''
+        Blocking entry point for scripts; see collect_all
+        '''
+        return asyncio.run(self.collect_all(jobs))
@@ -0,0 +1,241 @@
+'''
+Local stand-in for the GFW reports API, for exercising the fishing-effort
+collection without credentials or the real gateway
+
+Implements the endpoints used by gfw_api.ReportEngine:
+    POST /v1/reports                submit report; returns its id
+    GET  /v1/reports/{id}           report status; 'pending' until its latency has passed
+    GET  /v1/reports/{id}/url       location of finished report archive
+    GET  /files/{id}.zip            report archive (honors Range requests)
+with configurable report latencies, failure rate, request quota, and random 429s
+
+Run standalone with:
+    python gfw_fake_api.py --port 8765 --latency-median 20
+and point ReportEngine(api_base='http://127.0.0.1:8765/') at it
+'''
+import argparse
+import io
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+import uuid
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# header of the csv inside a gfw detail report
+REPORT_CSV_HEADER = 'Flag,Vessel Name,Gear Type,Vessel Type,MMSI,IMO,CallSign,First Transmission Date,Last Transmission Date,Apparent Fishing hours,Fishing hours'
+
+DEFAULT_CONFIG = {
+    # seconds from submission until a report is ready, drawn from a lognormal distribution
+    'latency_median': 20.0,
+    'latency_sigma': 0.75,
+    # share of reports that end with status 'failed'
+    'failure_rate': 0.02,
+    # requests per second allowed before answering 429; 0 for no quota
+    'quota_rate': 10.0,
+    'quota_burst': 20,
+    # share of otherwise acceptable requests answered with 429 anyway
+    'random_429_rate': 0.0,
+    # seconds advertised in Retry-After
+    'retry_after': 2,
+    # rows of fishing records in each report, drawn uniformly; 0 gives an empty csv
+    'rows_min': 0,
+    'rows_max': 2000,
+    'seed': None,
+}
+
+
+def build_report_zip(n_rows, rng):
+    '''
+    Build archive resembling a gfw detail report
+    INPUT   n_rows: number of fishing records (int)
+            rng: source of random values (random.Random)
+    RETURN  content: zip archive (bytes)
+            total: sum of 'Fishing hours' in archive (numeric)
+    '''
+    lines = []
+    total = 0.0
+    if n_rows > 0:
+        lines.append(REPORT_CSV_HEADER)
+        for i in range(n_rows):
+            hours = round(rng.expovariate(1 / 40.0), 4)
+            total += hours
+            lines.append('XXX,VESSEL {0},trawlers,fishing,{0},,,2020-01-01,2020-12-31,{1},{1}'.format(i, hours))
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_DEFLATED) as zip_ref:
+        zip_ref.writestr('report.csv', '\n'.join(lines))
+        zip_ref.writestr('README.txt', 'Generated by gfw_fake_api.py')
+    return buffer.getvalue(), total
+
+
+class FakeReportsState:
+    '''
+    Reports submitted to the fake API and its request quota
+    '''
+    def __init__(self, config):
+        self.config = dict(DEFAULT_CONFIG, **config)
+        self.rng = random.Random(self.config['seed'])
+        self.lock = threading.Lock()
+        self.reports = {}
+        self.tokens = float(self.config['quota_burst'])
+        self.updated = time.monotonic()
+        self.counts = {'requests': 0, 'throttled': 0, 'submitted': 0, 'downloads': 0}
+
+    def admit(self):
+        # True if request fits within quota
+        with self.lock:
+            self.counts['requests'] += 1
+            if self.rng.random() < self.config['random_429_rate']:
+                self.counts['throttled'] += 1
+                return False
+            if self.config['quota_rate'] <= 0:
+                return True
+            now = time.monotonic()
+            self.tokens = min(self.config['quota_burst'],
+                    self.tokens + (now - self.updated) * self.config['quota_rate'])
+            self.updated = now
+            if self.tokens < 1:
+                self.counts['throttled'] += 1
+                return False
+            self.tokens -= 1
+            return True
+
+    def submit(self, body):
+        with self.lock:
+            report_id = uuid.uuid4().hex
+            latency = self.config['latency_median'] * math.exp(
+                    self.rng.gauss(0, self.config['latency_sigma']))
+            failed = self.rng.random() < self.config['failure_rate']
+            n_rows = self.rng.randint(self.config['rows_min'], self.config['rows_max'])
+            self.reports[report_id] = {'ready_at': time.monotonic() + latency, 'failed': failed,
+                    'n_rows': n_rows, 'name': body.get('name'), 'zip': None}
+            self.counts['submitted'] += 1
+            return report_id
+
+    def status(self, report_id):
+        report = self.reports.get(report_id)
+        if report is None:
+            return None
+        if time.monotonic() < report['ready_at']:
+            return 'pending'
+        return 'failed' if report['failed'] else 'done'
+
+    def archive(self, report_id):
+        with self.lock:
+            report = self.reports[report_id]
+            if report['zip'] is None:
+                report['zip'], report['total'] = build_report_zip(report['n_rows'], self.rng)
+            self.counts['downloads'] += 1
+            return report['zip']
+
+
+class FakeReportsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _path(self):
+        # the real endpoints contain a double slash; treat any run of slashes as one
+        return re.sub('/+', '/', self.path.split('?')[0])
+
+    def _send(self, code, body=b'', content_type='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _throttled(self):
+        if self.server.state.admit():
+            return False
+        self._send(429, {'error': 'Too Many Requests'},
+                headers={'Retry-After': str(self.server.state.config['retry_after'])})
+        return True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        raw = self.rfile.read(length)
+        if self._throttled():
+            return
+        if self._path() != '/v1/reports':
+            return self._send(404, {'error': 'Not Found'})
+        try:
+            body = json.loads(raw or b'{}')
+        except ValueError:
+            return self._send(422, {'error': 'Invalid JSON'})
+        self._send(200, {'id': self.server.state.submit(body)})
+
+    def do_GET(self):
+        if self._throttled():
+            return
+        state = self.server.state
+        path = self._path()
+        m = re.fullmatch(r'/v1/reports/([0-9a-f]+)', path)
+        if m:
+            status = state.status(m.group(1))
+            if status is None:
+                return self._send(404, {'error': 'Not Found'})
+            return self._send(200, {'id': m.group(1), 'status': status})
+        m = re.fullmatch(r'/v1/reports/([0-9a-f]+)/url', path)
+        if m:
+            if state.status(m.group(1)) != 'done':
+                return self._send(404, {'error': 'Report not available'})
+            host, port = self.server.server_address[:2]
+            return self._send(200, {'url': 'http://{}:{}/files/{}.zip'.format(host, port, m.group(1))})
+        m = re.fullmatch(r'/files/([0-9a-f]+)\.zip', path)
+        if m:
+            if state.status(m.group(1)) != 'done':
+                return self._send(404, {'error': 'Not Found'})
+            content = state.archive(m.group(1))
+            range_match = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range', ''))
+            if range_match:
+                start = int(range_match.group(1))
+                if start >= len(content):
+                    return self._send(416, b'', content_type='application/zip',
+                            headers={'Content-Range': 'bytes */{}'.format(len(content))})
+                return self._send(206, content[start:], content_type='application/zip',
+                        headers={'Content-Range': 'bytes {}-{}/{}'.format(start, len(content) - 1, len(content)),
+                                'Accept-Ranges': 'bytes'})
+            return self._send(200, content, content_type='application/zip',
+                    headers={'Accept-Ranges': 'bytes'})
+        self._send(404, {'error': 'Not Found'})
+
+
+def make_server(host='127.0.0.1', port=0, **config):
+    '''
+    Create fake API server; call serve_forever() on it, directly or in a thread
+    INPUT   host, port: address to listen on; port 0 picks a free one
+            config: overrides of DEFAULT_CONFIG
+    RETURN  server: server, with its state at server.state (ThreadingHTTPServer)
+    '''
+    server = ThreadingHTTPServer((host, port), FakeReportsHandler)
+    server.daemon_threads = True
+    server.state = FakeReportsState(config)
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the GFW reports API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    for key, value in DEFAULT_CONFIG.items():
+        if key == 'seed':
+            parser.add_argument('--seed', type=int, default=None)
+        else:
+            parser.add_argument('--' + key.replace('_', '-'), type=type(value), default=value)
+    args = vars(parser.parse_args())
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    server = make_server(args.pop('host'), args.pop('port'), **args)
+    logger.info('Fake GFW reports API listening on http://{}:{}/'.format(*server.server_address[:2]))
+    server.serve_forever()
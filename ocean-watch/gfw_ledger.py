@@ -0,0 +1,124 @@
+'''
+On-disk record of GFW report attempts, keyed by zone and year
+Lets the fishing-effort scripts resume after an interruption without repeating
+finished work or losing track of reports that are still being generated
+'''
+import sqlite3
+import time
+
+import pandas as pd
+
+# zone attributes carried through to com_030d_fishing_effort_by_zone
+ZONE_FIELDS = ('geoname', 'pol_type', 'iso_ter1', 'iso_sov1', 'iso_ter2', 'iso_sov2',
+        'iso_ter3', 'iso_sov3')
+# progress of the report for each zone-year; submitted is the time the report was
+# submitted, failed is set once the report has failed or timed out on the API's side,
+# and split once it is being collected in parts instead
+REPORT_FIELDS = ('id', 'url', 'zip', 'value', 'error', 'submitted', 'failed', 'split')
+FIELDS = ZONE_FIELDS + REPORT_FIELDS
+# fields stored as numbers; the rest are text
+REAL_FIELDS = ('value', 'submitted')
+
+
+class ReportLedger:
+    '''
+    SQLite-backed ledger with one row per (mrgid, year), plus one row per part of
+    each report that had to be collected in parts
+    Every call to record() is committed immediately, so the ledger is only ever
+    as far behind as the last completed step
+    '''
+    def __init__(self, path):
+        '''
+        INPUT   path: location of ledger database; created if it does not exist (string)
+        '''
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        cols = ', '.join(['{} {}'.format(f, 'REAL' if f in REAL_FIELDS else 'TEXT') for f in FIELDS])
+        self.conn.execute('CREATE TABLE IF NOT EXISTS reports (mrgid INTEGER NOT NULL, '
+                'year INTEGER NOT NULL, ' + cols + ', updated REAL, PRIMARY KEY (mrgid, year))')
+        # ledgers from before a field was added gain its column
+        existing = {row['name'] for row in self.conn.execute('PRAGMA table_info(reports)')}
+        for f in FIELDS:
+            if f not in existing:
+                self.conn.execute('ALTER TABLE reports ADD COLUMN {} {}'.format(f, 'REAL' if f in REAL_FIELDS else 'TEXT'))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS parts (mrgid INTEGER NOT NULL, year INTEGER NOT NULL, '
+                'name TEXT NOT NULL, value REAL, split TEXT, updated REAL, PRIMARY KEY (mrgid, year, name))')
+        self.conn.commit()
+
+    def record(self, mrgid, year, **fields):
+        '''
+        Insert or update the entry for a zone-year; fields not given are left unchanged
+        INPUT   mrgid: marine regions identifier of zone (int)
+                year: year of report (int)
+                fields: values to store, drawn from FIELDS
+        '''
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError('Unknown ledger fields: ' + ', '.join(sorted(unknown)))
+        fields['updated'] = time.time()
+        names = list(fields)
+        self.conn.execute(
+            'INSERT INTO reports (mrgid, year, {cols}) VALUES (?, ?, {marks}) '
+            'ON CONFLICT (mrgid, year) DO UPDATE SET {updates}'.format(
+                cols=', '.join(names), marks=', '.join('?' * len(names)),
+                updates=', '.join(['{0}=excluded.{0}'.format(n) for n in names])),
+            [int(mrgid), int(year)] + [fields[n] for n in names])
+        self.conn.commit()
+
+    def get(self, mrgid, year):
+        '''
+        RETURN  entry: stored fields for zone-year; None if never attempted (dictionary)
+        '''
+        row = self.conn.execute('SELECT * FROM reports WHERE mrgid=? AND year=?',
+                (int(mrgid), int(year))).fetchone()
+        return None if row is None else dict(row)
+
+    def record_part(self, mrgid, year, name, value=None, split=None):
+        '''
+        Store outcome of one part of a report collected in parts
+        INPUT   mrgid: marine regions identifier of zone (int)
+                year: year of report (int)
+                name: report name of part (string)
+                value: value of part, once collected (numeric)
+                split: reason the part was itself split, if it was (string)
+        '''
+        self.conn.execute('INSERT OR REPLACE INTO parts (mrgid, year, name, value, split, updated) '
+                'VALUES (?, ?, ?, ?, ?, ?)', (int(mrgid), int(year), name, value, split, time.time()))
+        self.conn.commit()
+
+    def get_part(self, mrgid, year, name):
+        '''
+        RETURN  entry: stored 'value' and 'split' of part; None if never recorded (dictionary)
+        '''
+        row = self.conn.execute('SELECT value, split FROM parts WHERE mrgid=? AND year=? AND name=?',
+                (int(mrgid), int(year), name)).fetchone()
+        return None if row is None else dict(row)
+
+    def completed(self):
+        '''
+        RETURN  pairs: zone-years for which a value has been recorded (set of (mrgid, year) tuples)
+        '''
+        rows = self.conn.execute('SELECT mrgid, year FROM reports WHERE value IS NOT NULL')
+        return {(row['mrgid'], row['year']) for row in rows}
+
+    def missing(self, pairs):
+        '''
+        INPUT   pairs: zone-years wanted (iterable of (mrgid, year) tuples)
+        RETURN  pairs: those without a recorded value, in the order given (list of tuples)
+        '''
+        done = self.completed()
+        return [(int(m), int(y)) for m, y in pairs if (int(m), int(y)) not in done]
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM reports').fetchone()[0]
+
+    def to_dataframe(self):
+        '''
+        RETURN  df: all ledger entries, ordered by zone and year (DataFrame)
+        '''
+        return pd.read_sql_query('SELECT mrgid, year, ' + ', '.join(FIELDS) +
+                ' FROM reports ORDER BY mrgid, year', self.conn)
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,372 @@
+'''
+Shared helpers for working with HydroBASINS level 12 basins locally
+The global level 12 dataset has too many features to be stored on Carto, so it is
+kept on disk, with its attributes cached in a compact columnar file
+Imported by the river-mouths scripts in this directory
+'''
+import concurrent.futures
+import logging
+import os
+import zipfile
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# files can be downloaded (manually) at:
+#   https://www.dropbox.com/sh/hmpwobbz9qixxpe/AACPCyoHHAQUt_HNdIbWOFF4a/HydroBASINS/standard?dl=0&subfolder_nav_tracking=1
+REGION_IDS = ['af','ar','as','au','eu','gr','na','sa','si']
+ZIP_FILE_TEMPLATE = 'hybas_{}_lev{:02d}_v1c.zip'
+SHP_FILE_TEMPLATE = 'hybas_{}_lev{:02d}_v1c.shp'
+CACHE_FILE = 'hybas_lev12_v1c_attributes.feather'
+INDEX_FILE = 'hybas_v1c_pfafstetter_index.feather'
+LEVELS = list(range(1, 13))
+
+# attributes kept in the cache: identifiers and topology, stored as int64, and
+# distances and areas, stored as float64
+CACHE_COLUMNS = ['HYBAS_ID', 'PFAF_ID', 'NEXT_DOWN', 'NEXT_SINK', 'MAIN_BAS', 'ENDO', 'COAST',
+        'ORDER', 'SORT', 'DIST_SINK', 'DIST_MAIN', 'SUB_AREA', 'UP_AREA']
+
+def region_shapefile(data_dir, region_id, level=12):
+    '''
+    Locate shapefile of one region at one level, extracting it from its archive if needed
+    INPUT   data_dir: directory holding hydrobasins archives (string)
+            region_id: two-letter hydrobasins region, e.g. 'af' (string)
+            level: hydrobasins level, 1 to 12 (int)
+    RETURN  shp_file: location of shapefile (string)
+    '''
+    shp_file = os.path.join(data_dir, SHP_FILE_TEMPLATE.format(region_id, level))
+    if not os.path.isfile(shp_file):
+        with zipfile.ZipFile(os.path.join(data_dir, ZIP_FILE_TEMPLATE.format(region_id, level)), 'r') as zip:
+            zip.extractall(data_dir)
+    return shp_file
+
+def build_attribute_cache(data_dir, cache_path=None, columns=CACHE_COLUMNS):
+    '''
+    Read attributes of every region's level 12 basins once and store the needed
+    columns in an uncompressed Feather file that can be memory-mapped
+    INPUT   data_dir: directory holding hydrobasins archives (string)
+            cache_path: location of cache; CACHE_FILE in data_dir if not provided (string)
+            columns: attributes to keep (list of strings)
+    RETURN  cache_path: location of cache (string)
+    '''
+    # imported here so that reading the cache does not require geopandas
+    import geopandas as gpd
+
+    if cache_path is None:
+        cache_path = os.path.join(data_dir, CACHE_FILE)
+    frames = []
+    for region_id in REGION_IDS:
+        logger.info('Read level 12 basin attributes for region ' + region_id)
+        gdf_reg = gpd.read_file(region_shapefile(data_dir, region_id), ignore_geometry=True)
+        df_reg = pd.DataFrame(gdf_reg[list(columns)])
+        frames.append(df_reg.astype({col: 'int64' if pd.api.types.is_integer_dtype(df_reg[col]) else 'float64'
+                for col in df_reg.columns}))
+        del gdf_reg
+    # one concatenation, rather than growing the frame region by region
+    df_l12 = pd.concat(frames, axis=0, ignore_index=True)
+    if df_l12['HYBAS_ID'].duplicated().any():
+        raise ValueError('Duplicate HYBAS_ID across hydrobasins regions')
+    tmp = cache_path + '.tmp'
+    df_l12.to_feather(tmp, compression='uncompressed')
+    os.replace(tmp, cache_path)
+    logger.info('Cached {} level 12 basins in {}'.format(len(df_l12), cache_path))
+    return cache_path
+
+def load_attributes(data_dir, columns=None, cache_path=None):
+    '''
+    Load level 12 basin attributes from cache, building it first if needed, or
+    rebuilding it if it lacks any column requested
+    INPUT   data_dir: directory holding hydrobasins archives (string)
+            columns: attributes to load; all cached ones if not provided (list of strings)
+            cache_path: location of cache; CACHE_FILE in data_dir if not provided (string)
+    RETURN  df_l12: one row per level 12 basin (DataFrame)
+    '''
+    import pyarrow.feather
+
+    if cache_path is None:
+        cache_path = os.path.join(data_dir, CACHE_FILE)
+    if not os.path.isfile(cache_path):
+        build_attribute_cache(data_dir, cache_path)
+    elif columns is not None:
+        cached = pyarrow.feather.read_table(cache_path, memory_map=True).column_names
+        missing = [col for col in columns if col not in cached]
+        if missing:
+            logger.info('Rebuilding level 12 basin cache to add ' + ', '.join(missing))
+            build_attribute_cache(data_dir, cache_path, columns=cached + missing)
+    # only the requested columns are read, straight from the mapped file
+    table = pyarrow.feather.read_table(cache_path, columns=columns, memory_map=True)
+    return table.to_pandas()
+
+def _assign_region(data_dir, region_id, x, y, max_distance):
+    # runs in a worker process: match points to one region's level 12 basins
+    # returns positions of points inside a basin with its id, and positions of the
+    # others near one with its id and distance
+    import geopandas as gpd
+    import shapely
+    from shapely.strtree import STRtree
+
+    gdf_reg = gpd.read_file(region_shapefile(data_dir, region_id), columns=['HYBAS_ID'])
+    geoms = gdf_reg.geometry.values
+    hybas_ids = gdf_reg['HYBAS_ID'].to_numpy('int64')
+    xmin, ymin, xmax, ymax = gdf_reg.total_bounds
+    # only points near the region need testing against its basins
+    near = np.flatnonzero((x >= xmin - max_distance) & (x <= xmax + max_distance) &
+            (y >= ymin - max_distance) & (y <= ymax + max_distance))
+    points = shapely.points(x[near], y[near])
+    shapely.prepare(geoms)
+    tree = STRtree(geoms)
+    point_pos, geom_pos = tree.query(points, predicate='intersects')
+    # a point on a shared boundary is given to the first basin found
+    point_pos, first = np.unique(point_pos, return_index=True)
+    inside = (near[point_pos], hybas_ids[geom_pos[first]])
+    outside = np.setdiff1d(np.arange(len(near)), point_pos)
+    nearest = (np.array([], dtype='int64'), np.array([], dtype='int64'), np.array([], dtype='float64'))
+    if len(outside) > 0 and max_distance > 0:
+        (point_pos, geom_pos), distance = tree.query_nearest(points[outside], max_distance=max_distance,
+                return_distance=True, all_matches=False)
+        nearest = (near[outside[point_pos]], hybas_ids[geom_pos], distance)
+    return inside, nearest
+
+def assign_basins(data_dir, x, y, max_distance=0.1, max_workers=None):
+    '''
+    Find level 12 basin containing each point, by point-in-polygon test against each
+    region's basins through a spatial index, with the regions processed in parallel
+    Points in no basin, such as river mouths moved offshore, take the nearest basin
+    within max_distance
+    INPUT   data_dir: directory holding hydrobasins archives (string)
+            x, y: longitudes and latitudes of points (array-like)
+            max_distance: furthest a point may be from the basin it is given, in degrees (numeric)
+            max_workers: number of regions processed at once; one per CPU if not provided (int)
+    RETURN  df: one row per point, with 'hybas_id' (Int64; missing if no basin is near
+                enough) and 'distance' (0 inside a basin, in degrees) (DataFrame)
+    '''
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    hybas_id = np.zeros(len(x), dtype='int64')
+    distance = np.full(len(x), np.inf)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_assign_region, data_dir, region_id, x, y, max_distance): region_id
+                for region_id in REGION_IDS}
+        for future in concurrent.futures.as_completed(futures):
+            (pos_in, ids_in), (pos_near, ids_near, dist_near) = future.result()
+            hybas_id[pos_in] = ids_in
+            distance[pos_in] = 0.0
+            # regions overlap only at their edges; the closer basin wins
+            closer = dist_near < distance[pos_near]
+            hybas_id[pos_near[closer]] = ids_near[closer]
+            distance[pos_near[closer]] = dist_near[closer]
+            logger.debug('Assigned {} points inside and {} near basins of region {}'.format(
+                    len(pos_in), len(pos_near), futures[future]))
+    found = np.isfinite(distance)
+    return pd.DataFrame({
+        'hybas_id': pd.arrays.IntegerArray(hybas_id, ~found),
+        'distance': np.where(found, distance, np.nan),
+    })
+
+
+class PfafstetterIndex:
+    '''
+    Basin of every level containing a level 12 basin, found from its Pfafstetter code
+    A level L basin's code is the first L digits of the code of every level 12 basin
+    within it, so each level is held as its codes, sorted, alongside their HYBAS_IDs,
+    and looked up by binary search on the truncated level 12 codes
+    '''
+    def __init__(self, df_index):
+        '''
+        INPUT   df_index: 'level', 'PFAF_ID' and 'HYBAS_ID' of every basin (DataFrame)
+        '''
+        self.levels = {}
+        for level, df_level in df_index.groupby('level'):
+            df_level = df_level.sort_values('PFAF_ID')
+            if df_level['PFAF_ID'].duplicated().any():
+                raise ValueError('Duplicate Pfafstetter codes at level {}'.format(level))
+            self.levels[int(level)] = (df_level['PFAF_ID'].to_numpy('int64'),
+                    df_level['HYBAS_ID'].to_numpy('int64'))
+
+    @staticmethod
+    def build(data_dir, index_path=None, levels=LEVELS):
+        '''
+        Read codes of every basin at every level once and store them for later runs
+        INPUT   data_dir: directory holding hydrobasins archives for every level (string)
+                index_path: location of index; INDEX_FILE in data_dir if not provided (string)
+                levels: hydrobasins levels to include (list of ints)
+        RETURN  index_path: location of index (string)
+        '''
+        import geopandas as gpd
+
+        if index_path is None:
+            index_path = os.path.join(data_dir, INDEX_FILE)
+        frames = []
+        for level in levels:
+            if level == 12:
+                # level 12 codes come from the attribute cache
+                df_level = load_attributes(data_dir, columns=['HYBAS_ID', 'PFAF_ID'])
+            else:
+                df_level = pd.concat([pd.DataFrame(gpd.read_file(region_shapefile(data_dir, region_id, level),
+                        ignore_geometry=True)[['HYBAS_ID', 'PFAF_ID']]).astype('int64')
+                        for region_id in REGION_IDS], axis=0, ignore_index=True)
+            df_level.insert(0, 'level', level)
+            frames.append(df_level)
+            logger.info('Read basin codes for level {}'.format(level))
+        df_index = pd.concat(frames, axis=0, ignore_index=True)
+        df_index['level'] = df_index['level'].astype('int8')
+        df_index.sort_values(['level', 'PFAF_ID'], inplace=True, ignore_index=True)
+        tmp = index_path + '.tmp'
+        df_index.to_feather(tmp, compression='uncompressed')
+        os.replace(tmp, index_path)
+        return index_path
+
+    @classmethod
+    def load(cls, data_dir, index_path=None):
+        '''
+        Load index, building it first if needed
+        INPUT   data_dir: directory holding hydrobasins archives for every level (string)
+                index_path: location of index; INDEX_FILE in data_dir if not provided (string)
+        RETURN  index: (PfafstetterIndex)
+        '''
+        import pyarrow.feather
+
+        if index_path is None:
+            index_path = os.path.join(data_dir, INDEX_FILE)
+        if not os.path.isfile(index_path):
+            cls.build(data_dir, index_path)
+        return cls(pyarrow.feather.read_table(index_path, memory_map=True).to_pandas())
+
+    def lookup(self, pfaf_id_12, levels=LEVELS):
+        '''
+        Find basins containing level 12 basins at each requested level, in one pass per level
+        INPUT   pfaf_id_12: Pfafstetter codes of level 12 basins; missing values allowed
+                    (array-like of ints or strings)
+                levels: levels wanted (list of ints)
+        RETURN  df: one row per code, with 'hybas_id_{level}' for each level; missing where
+                    the code is missing or unknown at that level (DataFrame of Int64)
+        '''
+        codes = pd.to_numeric(pd.Series(pfaf_id_12), errors='coerce')
+        present = codes.notnull().to_numpy()
+        codes = codes.fillna(0).to_numpy('int64')
+        df = pd.DataFrame(index=range(len(codes)))
+        for level in levels:
+            level_codes, level_ids = self.levels[level]
+            prefixes = codes // 10 ** (12 - level)
+            pos = np.searchsorted(level_codes, prefixes)
+            pos_clipped = np.minimum(pos, len(level_codes) - 1)
+            found = present & (pos < len(level_codes)) & (level_codes[pos_clipped] == prefixes)
+            df['hybas_id_{}'.format(level)] = pd.arrays.IntegerArray(
+                    np.where(found, level_ids[pos_clipped], 0), ~found)
+        return df
+
+
+class BasinGraph:
+    '''
+    Drainage network of level 12 basins, following NEXT_DOWN from each basin to the
+    one it flows into
+    Basins are held as integer arrays, ordered by generation: the number of steps
+    from a basin to its outlet, deepest first. Every basin flows into one of the
+    next generation, so adding each generation into the next in turn carries any
+    per-basin attribute down to the outlets in one pass, touching each basin once
+    '''
+    def __init__(self, hybas_ids, next_down):
+        '''
+        INPUT   hybas_ids: HYBAS_ID of every basin (array-like of ints)
+                next_down: HYBAS_ID of basin each flows into; 0 for outlets (array-like of ints)
+        '''
+        hybas_ids = np.asarray(hybas_ids, dtype='int64')
+        next_down = np.asarray(next_down, dtype='int64')
+        # basins are numbered by position in sorted HYBAS_IDs
+        sort = np.argsort(hybas_ids)
+        self.hybas_ids = hybas_ids[sort]
+        if (np.diff(self.hybas_ids) == 0).any():
+            raise ValueError('Duplicate HYBAS_ID in basin graph')
+        next_down = next_down[sort]
+        pos = np.minimum(np.searchsorted(self.hybas_ids, next_down), len(self.hybas_ids) - 1)
+        known = self.hybas_ids[pos] == next_down
+        if ((next_down != 0) & ~known).any():
+            logger.warning('{} basins flow into unknown basins; treated as outlets'.format(
+                    ((next_down != 0) & ~known).sum()))
+        self.down = np.where(known, pos, -1).astype('int32')
+        # steps to outlet, by pointer jumping: each round doubles how far every jump reaches
+        depth = (self.down >= 0).astype('int64')
+        jump = self.down.astype('int64')
+        for _ in range(int(np.log2(max(len(jump), 1))) + 2):
+            linked = jump >= 0
+            if not linked.any():
+                break
+            depth[linked] += depth[jump[linked]]
+            jump[linked] = jump[jump[linked]]
+        else:
+            raise ValueError('Basin graph has a cycle')
+        self.depth = depth.astype('int32')
+        # deepest generation first; generation g runs from bounds[g] to bounds[g + 1]
+        self.order = np.argsort(-self.depth, kind='stable').astype('int32')
+        counts = np.bincount(self.depth)[::-1]
+        self.bounds = np.concatenate([[0], np.cumsum(counts)]).astype('int64')
+
+    @classmethod
+    def from_attributes(cls, df_l12):
+        '''
+        INPUT   df_l12: 'HYBAS_ID' and 'NEXT_DOWN' of every level 12 basin, e.g. from load_attributes (DataFrame)
+        RETURN  graph: (BasinGraph)
+        '''
+        return cls(df_l12['HYBAS_ID'].to_numpy(), df_l12['NEXT_DOWN'].to_numpy())
+
+    def __len__(self):
+        return len(self.hybas_ids)
+
+    def positions(self, hybas_ids):
+        '''
+        INPUT   hybas_ids: basins to locate; missing values allowed (array-like of ints)
+        RETURN  pos: position of each basin in graph; -1 where missing or unknown (array of ints)
+        '''
+        ids = pd.to_numeric(pd.Series(hybas_ids), errors='coerce')
+        present = ids.notnull().to_numpy()
+        ids = ids.fillna(0).to_numpy('int64')
+        pos = np.minimum(np.searchsorted(self.hybas_ids, ids), len(self.hybas_ids) - 1)
+        return np.where(present & (self.hybas_ids[pos] == ids), pos, -1)
+
+    def align(self, values):
+        '''
+        Arrange per-basin values in graph order
+        INPUT   values: values indexed by HYBAS_ID; basins not included count as 0 (Series or DataFrame)
+        RETURN  arr: one row per basin of graph (array of floats)
+        '''
+        pos = self.positions(values.index)
+        found = pos >= 0
+        if not found.all():
+            logger.warning('{} values for basins not in graph ignored'.format((~found).sum()))
+        data = np.asarray(values, dtype='float64')
+        arr = np.zeros((len(self),) + data.shape[1:], dtype='float64')
+        np.add.at(arr, pos[found], data[found])
+        return arr
+
+    def accumulate(self, values):
+        '''
+        Total of per-basin values over each basin and everything upstream of it
+        INPUT   values: one value, or row of values, per basin in graph order, e.g. from align (array)
+        RETURN  totals: upstream totals, same shape as values (array of floats)
+        '''
+        totals = np.array(values, dtype='float64')
+        if len(totals) != len(self):
+            raise ValueError('Expected {} basin values, got {}'.format(len(self), len(totals)))
+        # every generation but the outlets' is added into the next
+        for start, end in zip(self.bounds[:-2], self.bounds[1:-1]):
+            nodes = self.order[start:end]
+            np.add.at(totals, self.down[nodes], totals[nodes])
+        return totals
+
+    def catchment_totals(self, values, hybas_ids):
+        '''
+        Upstream totals of per-basin values for the catchments of given basins, such as
+        the terminal basins of river mouths
+        INPUT   values: values indexed by HYBAS_ID (Series or DataFrame)
+                hybas_ids: basins whose catchments are wanted; missing values allowed (array-like of ints)
+        RETURN  totals: one row per basin requested, NaN where missing or unknown (Series or DataFrame)
+        '''
+        totals = self.accumulate(self.align(values))
+        pos = self.positions(hybas_ids)
+        result = totals[np.maximum(pos, 0)]
+        result[pos < 0] = np.nan
+        if isinstance(values, pd.DataFrame):
+            return pd.DataFrame(result, columns=values.columns)
+        return pd.Series(result, name=values.name)
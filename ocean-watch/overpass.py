@@ -0,0 +1,255 @@
+'''
+Shared helpers for harvesting OpenStreetMap features from the Overpass API over
+tiles that adapt to where the features are
+Tiles with no land are skipped, tiles the server gives up on are split in four,
+and the outcome of every tile is kept in a JSON plan so that a later harvest
+goes straight to the tiles that are still needed
+Imported by river-mouths_harvest-names.py
+'''
+import json
+import logging
+import os
+import random
+import time
+
+import requests
+from requests.exceptions import ConnectionError, ReadTimeout
+
+import hydrobasins
+
+logger = logging.getLogger(__name__)
+
+# hosted Overpass API instances (others can be found at https://wiki.openstreetmap.org/wiki/Overpass_API)
+OVERPASS_URLS = ['https://lz4.overpass-api.de/api/interpreter', 'https://overpass.openstreetmap.fr/api/interpreter',
+        'https://z.overpass-api.de/api/interpreter', 'https://overpass.kumi.systems/api/interpreter']
+
+# template for Overpass QL query of named rivers; bbox is (south, west, north, east)
+# maxsize is the memory, in bytes, the server may use before giving up on the query
+RIVER_QUERY = '''
+[out:json]
+[timeout:{timeout}]
+[maxsize:{maxsize}];
+way{bbox}[waterway=river]["name"];
+(._;>;);out;
+'''
+
+# remarks with which the server reports giving up on a query part way through
+GIVE_UP_REMARKS = ('timed out', 'out of memory')
+
+# tile outcomes recorded in plan; tiles with a final status are not requested again
+FINAL_STATUSES = ('done', 'empty', 'skipped')
+
+
+class TileTooBig(Exception):
+    '''Server gave up on a tile, because it timed out or the response grew too large'''
+
+
+class ServersBusy(Exception):
+    '''No server would take the query, after every attempt'''
+
+
+def root_tiles(size=10, west=-180, north=90, east=180, south=-90):
+    '''
+    Grid of tiles covering an area, from the top left to the bottom right, a column at a time
+    INPUT   size: width and height of each tile, in degrees (numeric)
+            west, north, east, south: limits of area (numeric)
+    RETURN  tiles: (south, west, north, east) of each tile (list of tuples)
+    '''
+    tiles = []
+    x_left = west
+    while x_left <= east - size:
+        y_top = north
+        while y_top >= south + size:
+            tiles.append((y_top - size, x_left, y_top, x_left + size))
+            y_top -= size
+        x_left += size
+    return tiles
+
+def split_tile(tile):
+    '''
+    INPUT   tile: (south, west, north, east) (tuple)
+    RETURN  tiles: quarters of tile, north-west, south-west, north-east, south-east (list of tuples)
+    '''
+    south, west, north, east = tile
+    y_mid, x_mid = (south + north) / 2, (west + east) / 2
+    return [(y_mid, west, north, x_mid), (south, west, y_mid, x_mid),
+            (y_mid, x_mid, north, east), (south, x_mid, y_mid, east)]
+
+def tile_key(tile):
+    '''
+    INPUT   tile: (south, west, north, east) (tuple)
+    RETURN  key: name of tile in plan and output files, e.g. '-10_20_0_30' (string)
+    '''
+    return '_'.join('{:g}'.format(v) for v in tile)
+
+def load_land_mask(hydrobasins_dir):
+    '''
+    Coarse land mask from the HydroBASINS level 1 basins of every region, which
+    between them cover all land that drains anywhere
+    INPUT   hydrobasins_dir: directory holding hydrobasins archives (string)
+    RETURN  mask: prepared land geometry (shapely geometry)
+    '''
+    import geopandas as gpd
+    import shapely
+
+    geoms = []
+    for region_id in hydrobasins.REGION_IDS:
+        geoms.extend(gpd.read_file(hydrobasins.region_shapefile(hydrobasins_dir, region_id, level=1)).geometry.tolist())
+    mask = shapely.union_all(geoms)
+    shapely.prepare(mask)
+    return mask
+
+def has_land(mask, tile):
+    '''
+    INPUT   mask: prepared land geometry, from load_land_mask (shapely geometry)
+            tile: (south, west, north, east) (tuple)
+    RETURN  land: whether any land lies in tile (boolean)
+    '''
+    from shapely.geometry import box
+
+    south, west, north, east = tile
+    return mask.intersects(box(west, south, east, north))
+
+def query_tile(session, tile, urls=OVERPASS_URLS, template=RIVER_QUERY, timeout=180, maxsize=512 * 1024 * 1024,
+        max_attempts=10, backoff_base=5, backoff_max=180):
+    '''
+    Request features in one tile, trying each server in turn and backing off between
+    rounds while all are busy
+    INPUT   session: (requests.Session)
+            tile: (south, west, north, east) (tuple)
+            urls: Overpass API endpoints (list of strings)
+            template: Overpass QL query with bbox, timeout and maxsize fields (string)
+            timeout: seconds the server may spend on query (int)
+            maxsize: bytes of memory the server may use on query (int)
+            max_attempts: rounds of all servers before giving up (int)
+            backoff_base, backoff_max: limits of randomized wait between rounds, in seconds (numeric)
+    RETURN  data: Overpass JSON response (dictionary)
+    RAISE   TileTooBig if the query times out or grows too large; ServersBusy if no server
+                takes it; requests.HTTPError if the query is refused
+    '''
+    query = template.format(bbox=tile, timeout=timeout, maxsize=maxsize)
+    for attempt in range(max_attempts):
+        for url in urls:
+            try:
+                # allow for the time the server may take, plus the transfer
+                response = session.get(url, params={'data': query}, headers={'User-agent': 'wriuser'},
+                        timeout=(30, timeout + 60))
+            except ReadTimeout:
+                # connected, but the server did not finish the query in time
+                raise TileTooBig('no response from {} within {} seconds'.format(url, timeout + 60))
+            except ConnectionError as e:
+                # includes ConnectTimeout: the server could not be reached, so try the next
+                logger.info('Could not reach {}: {}'.format(url, e))
+                continue
+            if response.status_code == 200:
+                try:
+                    data = response.json()
+                except ValueError:
+                    logger.info('Unreadable response from {} - trying different server'.format(url))
+                    continue
+                remark = data.get('remark', '')
+                if any(r in remark for r in GIVE_UP_REMARKS):
+                    raise TileTooBig(remark)
+                return data
+            if response.status_code in (429, 502, 503, 504):
+                logger.info('error {} from {} - trying different server'.format(response.status_code, url))
+                continue
+            response.raise_for_status()
+        wait = random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+        logger.info('all servers full - retrying in {:.0f} seconds'.format(wait))
+        time.sleep(wait)
+    raise ServersBusy('no server took query for ' + tile_key(tile))
+
+
+class TilePlan:
+    '''
+    Outcome of every tile harvested, kept in a JSON file keyed by tile
+    The file is rewritten after every change, so it is only ever as far behind as
+    the last tile finished
+    '''
+    def __init__(self, path):
+        '''
+        INPUT   path: location of plan; created on first change if it does not exist (string)
+        '''
+        self.path = path
+        self.tiles = {}
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.tiles = json.load(f)
+
+    def get(self, tile):
+        '''
+        INPUT   tile: (south, west, north, east) (tuple)
+        RETURN  entry: recorded outcome of tile; None if not yet recorded (dictionary)
+        '''
+        return self.tiles.get(tile_key(tile))
+
+    def record(self, tile, status, **info):
+        '''
+        INPUT   tile: (south, west, north, east) (tuple)
+                status: 'done', 'empty', 'skipped', 'split' or 'failed' (string)
+                info: further details of outcome, e.g. features and seconds
+        '''
+        self.tiles[tile_key(tile)] = dict(bbox=list(tile), status=status, updated=time.time(), **info)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.tiles, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def summary(self):
+        '''
+        RETURN  counts: number of tiles with each status (dictionary)
+        '''
+        counts = {}
+        for entry in self.tiles.values():
+            counts[entry['status']] = counts.get(entry['status'], 0) + 1
+        return counts
+
+
+def harvest_tiles(tiles, fetch, handle, plan, land_mask=None, min_size=0.625):
+    '''
+    Fetch every tile not already finished in plan, skipping those with no land and
+    splitting in four those the server gives up on, down to min_size
+    Tiles are worked through depth first, so each is finished before its neighbour
+    INPUT   tiles: (south, west, north, east) of tiles to start from (list of tuples)
+            fetch: function taking a tile and returning its data, raising TileTooBig or
+                ServersBusy, e.g. query_tile with other arguments set (function)
+            handle: function taking a tile and its data and returning number of features kept (function)
+            plan: record of tile outcomes (TilePlan)
+            land_mask: prepared land geometry; no tiles are skipped if not provided (shapely geometry)
+            min_size: smallest tile width to split down to, in degrees (numeric)
+    RETURN  counts: number of tiles with each status in plan (dictionary)
+    '''
+    stack = list(reversed(tiles))
+    while stack:
+        tile = stack.pop()
+        entry = plan.get(tile)
+        if entry is not None and entry['status'] in FINAL_STATUSES:
+            continue
+        if entry is not None and entry['status'] == 'split':
+            stack.extend(reversed(split_tile(tile)))
+            continue
+        if land_mask is not None and not has_land(land_mask, tile):
+            plan.record(tile, 'skipped')
+            continue
+        logger.info('Getting rivers for: ' + str(tile))
+        started = time.time()
+        try:
+            data = fetch(tile)
+        except TileTooBig as e:
+            if (tile[3] - tile[1]) / 2 < min_size:
+                logger.warning('unable to fetch data for {}, already smallest tile: {}'.format(tile, e))
+                plan.record(tile, 'failed', error=str(e))
+            else:
+                logger.info('Splitting {}: {}'.format(tile, e))
+                plan.record(tile, 'split', error=str(e), seconds=round(time.time() - started, 1))
+                stack.extend(reversed(split_tile(tile)))
+            continue
+        except (ServersBusy, requests.HTTPError) as e:
+            logger.warning('unable to fetch data for {}: {}'.format(tile, e))
+            plan.record(tile, 'failed', error=str(e))
+            continue
+        n_features = handle(tile, data)
+        plan.record(tile, 'done' if n_features > 0 else 'empty', features=n_features,
+                seconds=round(time.time() - started, 1))
+    return plan.summary()
@@ -3,15 +3,16 @@ import logging
 from cartoframes.auth import set_default_credentials
 from cartoframes import read_carto, to_carto
 import geopandas as gpd
-from datetime import datetime
-import dateutil.relativedelta
 import requests
-import xml.etree.ElementTree as ET
+import asyncio
+import json
 import math
-import time
 
 import pandas as pd
 
+from cmems import (variables, depths, build_wms_request, parse_response, download_subset, nearest_valid_cells,
+        RequestFailed, WMSClient, SERIES_START)
+
 
 import tempfile
 
@@ -44,114 +45,6 @@ CARTO_KEY = os.getenv('CARTO_WRI_RW_KEY')
 set_default_credentials(username=CARTO_USER,
                         base_url="https://{user}.carto.com/".format(user=CARTO_USER),
                         api_key=CARTO_KEY)
-# prepare request parameters
-variables = [
-    'o2',
-    'no3',
-    'po4'
-]
-depths = [
-    -0.49402499198913574,
-    -1.5413750410079956,
-    -2.6456689834594727,
-    -3.8194949626922607,
-    -5.078224182128906,
-]
-
-# define function for creating request
-
-def build_wms_request(x, y, variable, depth):
-    xmin = x-0.0
-    ymin = y-0.0
-    xmax = x+0.0000001
-    ymax = y+0.0000001
-    # make request the 16th of month before last..
-    now = datetime.utcnow()
-    dt_end = now.replace(day=16)
-    months_ago = 2 if (now.day > 16) else 3
-    dt_end = dt_end - dateutil.relativedelta.relativedelta(months=months_ago)
-    date_end = dt_end.strftime('%Y-%m-%d')
-    req_template = (
-        'https://nrt.cmems-du.eu/thredds/wms/global-analysis-forecast-bio-001-028-monthly?'
-        'SERVICE=WMS'
-        '&VERSION=1.1.1'
-        '&REQUEST=GetFeatureInfo'
-        '&QUERY_LAYERS={variable}'
-        '&BBOX={xmin},{ymin},{xmax},{ymax}'
-        '&HEIGHT=1'
-        '&WIDTH=1'
-        '&INFO_FORMAT=text/xml'
-        '&SRS=EPSG:4326'
-        '&X=0'
-        '&Y=0'
-        '&elevation={depth}'
-        '&time=2019-01-16T12:00:00.000Z/{date_end}T12:00:00.000Z'
-    )
-    return req_template.format(variable=variable, xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax, 
-        depth=depth, date_end=date_end)
-
-# print(example_resp.content)
-def parse_response(response):
-    '''
-    Parse content of response from GetFeatureInfo query to Copernicus WMS
-    INPUT   response: raw response object from requests library (requests.models.Response)
-    RETURN  df_resp: structured data object for response (DataFrame)
-    '''
-    if response.status_code != 200:
-        return None
-    root = ET.fromstring(response.content)
-    response_dict = {}
-    response_data_times = []
-    response_data_values = []
-
-    dt_format = '%Y-%m-%dT%H:%M:%S.000Z'
-
-    for child in root.iter('*'):
-        if(child.tag == 'FeatureInfoResponse'):
-            continue
-        if(child.tag == 'longitude'):
-            response_dict['longitude'] = float(child.text)
-        if(child.tag == 'latitude'):
-            response_dict['latitude'] = float(child.text)
-        if(child.tag == 'iIndex'):
-            response_dict['iIndex'] = int(child.text)
-        if(child.tag == 'jIndex'):
-            response_dict['jIndex'] = int(child.text)
-        if(child.tag == 'gridCentreLon'):
-            response_dict['gridCentreLon'] = float(child.text)
-        if(child.tag == 'gridCentreLat'):
-            response_dict['gridCentreLat'] = float(child.text)
-        if(child.tag == 'FeatureInfo'):
-            continue
-        if(child.tag == 'time'):
-            response_data_times.append(datetime.strptime(child.text, dt_format))
-        if(child.tag == 'value'):
-            if child.text == 'none':
-                # legitimate request, but no data available at this location (ie invalid coordinates)
-                return None
-            response_data_values.append(float(child.text));
-        # print(child.tag)
-    # resp_cols = ['longitude','latitude','gridCentreLon','gridCentreLat','dt','value']
-    df_resp = pd.DataFrame()
-    df_resp['longitude'] = [response_dict['longitude'] for i in range(len(response_data_times))]
-    df_resp['latitude'] = [response_dict['latitude'] for i in range(len(response_data_times))]
-    df_resp['gridCentreLon'] = [response_dict['gridCentreLon'] for i in range(len(response_data_times))]
-    df_resp['gridCentreLat'] = [response_dict['gridCentreLat'] for i in range(len(response_data_times))]
-    df_resp['dt'] = response_data_times
-    df_resp['value'] = response_data_values
-    return df_resp
-
-# # known-to-work query drawn from copernicus website (pretty viewer)
-# example_req = 'https://nrt.cmems-du.eu/thredds/wms/global-analysis-forecast-bio-001-028-monthly?SERVICE=WMS&VERSION=1.1.1&REQUEST=GetFeatureInfo&QUERY_LAYERS=o2&BBOX=-39.04,-13.92,-39.0399999,-13.9199999&HEIGHT=1&WIDTH=1&INFO_FORMAT=text/xml&SRS=EPSG:4326&X=0&Y=0&elevation=-0.49402499198913574&time=2019-01-16T12:00:00.000Z/2021-05-16T12:00:00.000Z'
-# print(example_req)
-# example_resp = requests.get(example_req)
-# df_example = parse_response(example_resp)
-
-test_req = build_wms_request(-39.04,-13.92,'o2',depths[0])
-print(test_req)
-test_resp = requests.get(test_req)
-df_test = parse_response(test_resp)
-
 
 def build_test_coords(x, y, dir=0, step=1, step_size=0.2):
     '''
@@ -193,16 +86,122 @@ def build_test_sequence(x, y, step_size=0.1, n_steps=4, dirs='ordinal'):
             test_coords.append(build_test_coords(x, y, dir=dir, step=step, step_size=step_size))
     return test_coords
 
+def build_test_rings(x, y, step_size=0.1, n_steps=4, dirs='ordinal'):
+    '''
+    Split test sequence into its concentric rings, nearest first
+    INPUT   see build_test_sequence
+    RETURN  rings: long/lat coordinates of each ring, in direction order (list of lists of tuples)
+    '''
+    test_seq = build_test_sequence(x, y, step_size=step_size, n_steps=n_steps, dirs=dirs)
+    n_dirs = len(test_seq) // n_steps
+    return [test_seq[i:i+n_dirs] for i in range(0, len(test_seq), n_dirs)]
+
+async def probe_point(client, x, y):
+    '''
+    Check whether Copernicus WMS has data at a point
+    INPUT   client: open client through which to make request (WMSClient)
+            x, y: long/lat coordinates of point (numeric)
+    RETURN  valid: whether request returned data (boolean)
+    '''
+    try:
+        resp = await client.fetch(build_wms_request(x, y, variables[0], depths[0]))
+    except RequestFailed as e:
+        logger.debug('Probe failed, treating point as invalid: ' + str(e))
+        return False
+    return parse_response(resp) is not None
+
+async def find_valid_point(client, rings):
+    '''
+    Probe each ring's points at once, moving out a ring only once the nearer one has
+    none; within a ring the first valid point in direction order wins, as if probed
+    one by one, and probes still outstanding for the mouth are then cancelled
+    INPUT   client: open client through which to make requests (WMSClient)
+            rings: candidate points, nearest ring first (list of lists of tuples)
+    RETURN  hit: position of ring and coordinates of first valid point; None if no
+                point is valid (tuple)
+    '''
+    for ring_index, ring in enumerate(rings):
+        probes = [asyncio.ensure_future(probe_point(client, x, y)) for x, y in ring]
+        try:
+            for coords, probe in zip(ring, probes):
+                if await probe:
+                    return ring_index, coords
+        finally:
+            for probe in probes:
+                probe.cancel()
+    return None
+
+async def find_valid_points(client, searches, on_result=None):
+    '''
+    Search around every river mouth concurrently
+    INPUT   client: client through which to make requests (WMSClient)
+            searches: probe rings for each river mouth (list of lists of lists of tuples)
+            on_result: called with position of search and its result as each finishes (function)
+    RETURN  hits: result of find_valid_point for each mouth, in order (list)
+    '''
+    async def search(i, rings):
+        hit = await find_valid_point(client, rings)
+        if on_result is not None:
+            on_result(i, hit)
+        return hit
+
+    async with client:
+        return await asyncio.gather(*[search(i, rings) for i, rings in enumerate(searches)])
+
 # pull data
 gdf_mouths = read_carto('ocn_calcs_010_target_river_mouths')
 
+# search the model's ocean mask locally rather than probing around each invalid mouth
+# through WMS; every repair found this way is confirmed with a single request, and
+# mouths whose candidate cannot be confirmed fall back to probing
+MASK_SEARCH = True
+# the probe sequence reaches 0.7 degrees from the mouth; repairs no further than that
+MAX_REPAIR_KM = 80
+SUBSET_DIR = os.path.join(os.getenv('DOWNLOAD_DIR'), 'cmems-subsets')
+
+candidates = {}
+if MASK_SEARCH:
+    logger.info('Locate nearest model cell with data for each river mouth')
+    # a single month of one variable is enough to tell ocean from land
+    mask_path = download_subset(variables[0], depths[0], SERIES_START, SERIES_START, SUBSET_DIR)
+    df_nearest = nearest_valid_cells(mask_path, variables[0],
+            gdf_mouths['the_geom'].x.values, gdf_mouths['the_geom'].y.values)
+    df_nearest.index = gdf_mouths.index
+    for index, nearest in df_nearest.iterrows():
+        if nearest['valid']:
+            candidates[index] = None
+        elif nearest['distance_km'] <= MAX_REPAIR_KM:
+            candidates[index] = (float(nearest['cell_x']), float(nearest['cell_y']))
+    logger.info('{} river mouths already in ocean cells, {} with a nearby ocean cell, {} with none'.format(
+            sum(1 for c in candidates.values() if c is None),
+            sum(1 for c in candidates.values() if c is not None),
+            len(gdf_mouths) - len(candidates)))
+
+# probes in flight at once, and attempts at each before the point is taken as invalid
+PROBE_MAX_PER_HOST = 16
+PROBE_MAX_ATTEMPTS = 4
+
+# outcome of each search is saved locally, CHECKPOINT_EVERY searches at a time, so an
+# interrupted run loses little work; a rerun applies saved outcomes, found or not, and
+# searches only the remaining mouths. delete the file to search everything again
+CHECKPOINT_FILE = os.path.join(os.getenv('DOWNLOAD_DIR'), 'river-mouths_adjust-coordinates_checkpoint.jsonl')
+CHECKPOINT_EVERY = 12
+
+checkpoint = {}
+if os.path.isfile(CHECKPOINT_FILE):
+    with open(CHECKPOINT_FILE, 'r', encoding='utf-8') as f:
+        for line in f:
+            entry = json.loads(line)
+            checkpoint[str(entry['hyriv_id'])] = entry
+    logger.info('Resuming from {} saved searches in {}'.format(len(checkpoint), CHECKPOINT_FILE))
+
 test_existing_valid_coords = False
+searches = []
 valid_rows = []
 matching_rows = []
 updated_rows = []
 helpless_rows = []
 n_requests = 0
-n_fixed = 0
 
 for index, row in gdf_mouths.iterrows():
     if index < 0:
@@ -210,7 +209,7 @@ for index, row in gdf_mouths.iterrows():
         continue
     x_valid = row['x_valid']
     y_valid = row['y_valid']
-    if x_valid is not None and y_valid is not None:
+    if pd.notnull(x_valid) and pd.notnull(y_valid):
         if not test_existing_valid_coords:
             continue
         valid_req = build_wms_request(float(x_valid), float(y_valid), variables[0], depths[0])
@@ -226,52 +225,69 @@ for index, row in gdf_mouths.iterrows():
             continue
     # if here, we do not have pre-existing, valid coordinates stored
     x, y = row['the_geom'].x, row['the_geom'].y
-    point_req = build_wms_request(x, y, variables[0], depths[0])
-    point_resp = requests.get(point_req)
-    n_requests += 1
-    df_resp = parse_response(point_resp)
-    if df_resp is not None:
-        # good to go, response worked
+    saved = checkpoint.get(str(row['hyriv_id']))
+    if saved is not None:
+        # searched by an earlier, interrupted run
+        if saved['x_valid'] is None:
+            helpless_rows.append(row['hyriv_id'])
+            continue
+        gdf_mouths.loc[index, 'x_valid'] = saved['x_valid']
+        gdf_mouths.loc[index, 'y_valid'] = saved['y_valid']
+        (matching_rows if saved['matching'] else updated_rows).append(row['hyriv_id'])
+        continue
+    if MASK_SEARCH and index in candidates and candidates[index] is None:
+        # the mouth's own cell has data in the ocean mask
         gdf_mouths.loc[index, 'x_valid'] = x
         gdf_mouths.loc[index, 'y_valid'] = y
         matching_rows.append(row['hyriv_id'])
         continue
+    if MASK_SEARCH and index not in candidates:
+        # nothing with data within reach of the probe sequence either
+        print('Unable to find valid point for base river mouth: HYRIV_ID=' +
+            row['hyriv_id'])
+        helpless_rows.append(row['hyriv_id'])
+        continue
+    # the mask's nearest ocean cell needs confirming; otherwise the mouth itself is
+    # tried first; failing that, the rings around the mouth
+    first = candidates[index] if MASK_SEARCH else (x, y)
+    searches.append({'index': index, 'hyriv_id': row['hyriv_id'], 'origin': (x, y),
+            'rings': [[first]] + build_test_rings(x, y, n_steps=7, dirs='secondary')})
+
+pending = []
+
+def flush_checkpoint():
+    # append outcomes of finished searches to checkpoint file
+    with open(CHECKPOINT_FILE, 'a', encoding='utf-8') as f:
+        for entry in pending:
+            f.write(json.dumps(entry) + '\n')
+    pending.clear()
+
+def apply_hit(i, hit):
+    # store outcome of one search as soon as it finishes
+    search = searches[i]
+    if hit is None:
+        print('Unable to find valid point for base river mouth: HYRIV_ID=' +
+            search['hyriv_id'])
+        helpless_rows.append(search['hyriv_id'])
+        pending.append({'hyriv_id': str(search['hyriv_id']), 'x_valid': None, 'y_valid': None, 'matching': False})
     else:
-        # query failed, need to find valid coordinates
-        found = False
-        test_seq = build_test_sequence(x, y, n_steps=7, dirs='secondary')
-        for test_coords in test_seq:
-            x_test = test_coords[0]
-            y_test = test_coords[1]
-            test_req = build_wms_request(x_test, y_test, variables[0], depths[0])
-            try:
-                test_resp = requests.get(test_req)
-            except ConnectionError as e:
-                print(e)
-                time.sleep(120)
-                continue
-            n_requests += 1
-            df_test = parse_response(test_resp)
-            if df_test is not None:
-                # success; test_coords -> valid_coords
-                gdf_mouths.loc[index, 'x_valid'] = x_test
-                gdf_mouths.loc[index, 'y_valid'] = y_test
-                updated_rows.append(row['hyriv_id'])
-                found = True
-                n_fixed += 1
-                if n_fixed > 12:
-                    to_carto(gdf_mouths, 'ocn_calcs_010test_target_river_mouths', if_exists='replace')
-                    print('Index of last repair: ' + str(index))
-                    n_fixed = 0
-                break
-        if not found:
-            print('Unable to find valid point for base river mouth: HYRIV_ID=' +
-                row['hyriv_id'])
-            helpless_rows.append(row['hyriv_id'])
-        # searching on this river mouth complete, whether successful or not
-    # slow process. can save incremental progress to disk, then manage loop manually
-    if index != 0 and index % 500 == 0:
-        to_carto(gdf_mouths, 'ocn_calcs_010test_target_river_mouths', if_exists='replace')
+        ring_index, (x_test, y_test) = hit
+        gdf_mouths.loc[search['index'], 'x_valid'] = x_test
+        gdf_mouths.loc[search['index'], 'y_valid'] = y_test
+        # mouth itself worked if it was the first point tried and succeeded
+        matching = ring_index == 0 and (x_test, y_test) == search['origin']
+        (matching_rows if matching else updated_rows).append(search['hyriv_id'])
+        pending.append({'hyriv_id': str(search['hyriv_id']), 'x_valid': x_test, 'y_valid': y_test, 'matching': matching})
+    if len(pending) >= CHECKPOINT_EVERY:
+        flush_checkpoint()
+
+logger.info('Search for valid points around {} river mouths'.format(len(searches)))
+client = WMSClient(max_per_host=PROBE_MAX_PER_HOST, max_attempts=PROBE_MAX_ATTEMPTS)
+try:
+    asyncio.run(find_valid_points(client, [search['rings'] for search in searches], on_result=apply_hit))
+finally:
+    flush_checkpoint()
+n_requests += client.n_requests
 
 print(n_requests)    
 print(gdf_mouths)
@@ -0,0 +1,154 @@
+'''
+Compare parsing of Copernicus WMS GetFeatureInfo responses by the shared parser
+in cmems.py against the per-script parser it replaced, on synthetic responses
+shaped like those for river mouths (one per mouth, variable and depth)
+
+Example, 5000 responses of 30 months each:
+    python river-mouths_benchmark-parser.py --responses 5000 --months 30
+'''
+import argparse
+import json
+import random
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+import dateutil.relativedelta
+import pandas as pd
+
+from cmems import parse_feature_info, parse_response, parse_responses
+
+class FakeResponse:
+    # stands in for requests.models.Response
+    def __init__(self, content):
+        self.status_code = 200
+        self.content = content
+
+def build_feature_info(x, y, n_months, rng, no_data=False):
+    '''
+    Create GetFeatureInfo response body resembling those of the Copernicus WMS
+    INPUT   x, y: requested longitude and latitude (numeric)
+            n_months: number of monthly values (int)
+            rng: source of random values (random.Random)
+            no_data: whether location is outside model, with 'none' values (boolean)
+    RETURN  content: response body (bytes)
+    '''
+    i, j = int(round((x + 180) * 4)), int(round((y + 80) * 4))
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>', '<FeatureInfoResponse>',
+            '<longitude>{}</longitude>'.format(x), '<latitude>{}</latitude>'.format(y),
+            '<iIndex>{}</iIndex>'.format(i), '<jIndex>{}</jIndex>'.format(j),
+            '<gridCentreLon>{}</gridCentreLon>'.format(-180 + i / 4),
+            '<gridCentreLat>{}</gridCentreLat>'.format(-80 + j / 4)]
+    dt = datetime(2019, 1, 16, 12)
+    for month in range(n_months):
+        value = 'none' if no_data else '{:.6f}'.format(rng.uniform(0, 300))
+        parts.append('<FeatureInfo><time>{}</time><value>{}</value></FeatureInfo>'.format(
+                (dt + dateutil.relativedelta.relativedelta(months=month)).strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                value))
+    parts.append('</FeatureInfoResponse>')
+    return '\n'.join(parts).encode('utf-8')
+
+def legacy_parse_response(response):
+    # parser formerly copied into each river-mouths script, kept for comparison
+    if response.status_code != 200:
+        return None
+    root = ET.fromstring(response.content)
+    response_dict = {}
+    response_data_times = []
+    response_data_values = []
+
+    dt_format = '%Y-%m-%dT%H:%M:%S.000Z'
+
+    for child in root.iter('*'):
+        if(child.tag == 'FeatureInfoResponse'):
+            continue
+        if(child.tag == 'longitude'):
+            response_dict['longitude'] = float(child.text)
+        if(child.tag == 'latitude'):
+            response_dict['latitude'] = float(child.text)
+        if(child.tag == 'iIndex'):
+            response_dict['iIndex'] = int(child.text)
+        if(child.tag == 'jIndex'):
+            response_dict['jIndex'] = int(child.text)
+        if(child.tag == 'gridCentreLon'):
+            response_dict['gridCentreLon'] = float(child.text)
+        if(child.tag == 'gridCentreLat'):
+            response_dict['gridCentreLat'] = float(child.text)
+        if(child.tag == 'FeatureInfo'):
+            continue
+        if(child.tag == 'time'):
+            response_data_times.append(datetime.strptime(child.text, dt_format))
+        if(child.tag == 'value'):
+            if child.text == 'none':
+                return None
+            response_data_values.append(float(child.text));
+    df_resp = pd.DataFrame()
+    df_resp['longitude'] = [response_dict['longitude'] for i in range(len(response_data_times))]
+    df_resp['latitude'] = [response_dict['latitude'] for i in range(len(response_data_times))]
+    df_resp['gridCentreLon'] = [response_dict['gridCentreLon'] for i in range(len(response_data_times))]
+    df_resp['gridCentreLat'] = [response_dict['gridCentreLat'] for i in range(len(response_data_times))]
+    df_resp['dt'] = response_data_times
+    df_resp['value'] = response_data_values
+    return df_resp
+
+def timed(func, repeat):
+    # best of several runs, in seconds
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+parser = argparse.ArgumentParser(description='Benchmark GetFeatureInfo response parsing')
+parser.add_argument('--responses', type=int, default=2000)
+parser.add_argument('--months', type=int, default=30, help='monthly values in each response')
+parser.add_argument('--no-data-rate', type=float, default=0.05, help='share of responses outside model')
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--output', default=None, help='file in which to store results as JSON')
+args = parser.parse_args()
+
+rng = random.Random(args.seed)
+contents = [build_feature_info(round(rng.uniform(-180, 180), 4), round(rng.uniform(-70, 80), 4),
+        args.months, rng, no_data=rng.random() < args.no_data_rate) for _ in range(args.responses)]
+responses = [FakeResponse(content) for content in contents]
+
+t_legacy, legacy = timed(lambda: [legacy_parse_response(r) for r in responses], args.repeat)
+t_frames, frames = timed(lambda: [parse_response(r) for r in responses], args.repeat)
+t_arrays, _ = timed(lambda: [parse_feature_info(c) for c in contents], args.repeat)
+t_legacy_concat, df_legacy = timed(
+        lambda: pd.concat([df for df in legacy if df is not None], ignore_index=True), args.repeat)
+t_batch, (df_batch, invalid) = timed(lambda: parse_responses(contents), args.repeat)
+
+# all parsers must agree before their speed means anything
+for df_old, df_new in zip(legacy, frames):
+    assert (df_old is None) == (df_new is None)
+    if df_old is not None:
+        pd.testing.assert_frame_equal(df_old, df_new, check_dtype=False)
+assert invalid == [i for i, df in enumerate(legacy) if df is None]
+pd.testing.assert_frame_equal(df_legacy, df_batch[df_legacy.columns], check_dtype=False)
+
+n_rows = len(df_batch)
+results = {
+    'responses': args.responses,
+    'rows': n_rows,
+    'legacy_s': round(t_legacy, 4),
+    'legacy_with_concat_s': round(t_legacy + t_legacy_concat, 4),
+    'shared_frames_s': round(t_frames, 4),
+    'shared_arrays_s': round(t_arrays, 4),
+    'shared_batch_s': round(t_batch, 4),
+    'responses_per_s': {
+        'legacy': round(args.responses / t_legacy, 1),
+        'shared_frames': round(args.responses / t_frames, 1),
+        'shared_arrays': round(args.responses / t_arrays, 1),
+        'shared_batch': round(args.responses / t_batch, 1),
+    },
+    'speedup_batch_vs_legacy_with_concat': round((t_legacy + t_legacy_concat) / t_batch, 2),
+    'config': dict(vars(args)),
+}
+print(json.dumps(results, indent=4))
+if args.output is not None:
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=4)
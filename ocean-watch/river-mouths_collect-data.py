@@ -3,15 +3,16 @@ import logging
 from cartoframes.auth import set_default_credentials
 from cartoframes import read_carto, to_carto
 import geopandas as gpd
-from datetime import datetime
-import dateutil.relativedelta
-import requests
-import xml.etree.ElementTree as ET
 import math
-import concurrent.futures
+import contextlib
+import requests
 
+import numpy as np
 import pandas as pd
 
+from cmems import variables, depths, build_wms_request, check_grid, grid_cell, next_month, parse_feature_info, parse_response, WMSClient, series_end, download_subset, sample_subset, SERIES_START
+from cmems_store import ResultStore, code_table, fact_frame, mouth_frame
+
 import os
 import sys
 
@@ -38,113 +39,59 @@ set_default_credentials(username=CARTO_USER,
                         base_url="https://{user}.carto.com/".format(user=CARTO_USER),
                         api_key=CARTO_KEY)
 # prepare request parameters
-variables = [
-    'o2',
-    'no3',
-    'po4'
-]
-depths = [
-    -0.49402499198913574,
-    -1.5413750410079956,
-    -2.6456689834594727,
-    -3.8194949626922607,
-    -5.078224182128906,
-]
-
-# define function for creating request
-def build_wms_request(x, y, variable, depth):
-    xmin = x-0.0
-    ymin = y-0.0
-    xmax = x+0.0000001
-    ymax = y+0.0000001
-    # make request the 16th of month before last..
-    now = datetime.utcnow()
-    dt_end = now.replace(day=16)
-    months_ago = 2 if (now.day > 16) else 3
-    dt_end = dt_end - dateutil.relativedelta.relativedelta(months=months_ago)
-    date_end = dt_end.strftime('%Y-%m-%d')
-    req_template = (
-        'https://nrt.cmems-du.eu/thredds/wms/global-analysis-forecast-bio-001-028-monthly?'
-        'SERVICE=WMS'
-        '&VERSION=1.1.1'
-        '&REQUEST=GetFeatureInfo'
-        '&QUERY_LAYERS={variable}'
-        '&BBOX={xmin},{ymin},{xmax},{ymax}'
-        '&HEIGHT=1'
-        '&WIDTH=1'
-        '&INFO_FORMAT=text/xml'
-        '&SRS=EPSG:4326'
-        '&X=0'
-        '&Y=0'
-        '&elevation={depth}'
-        '&time=2019-01-16T12:00:00.000Z/{date_end}T12:00:00.000Z'
-    )
-    return req_template.format(variable=variable, xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax, 
-        depth=depth, date_end=date_end)
-
-def parse_response(response):
-    '''
-    Parse content of response from GetFeatureInfo query to Copernicus WMS
-    INPUT   response: raw response object from requests library (requests.models.Response)
-    RETURN  df_resp: structured data object for response; None if unable to parse (DataFrame)
-    '''
-    if response.status_code != 200:
-        return None
-    root = ET.fromstring(response.content)
-    response_dict = {}
-    response_data_times = []
-    response_data_values = []
+# variables and depths are imported from cmems.py, shared by the river mouth scripts
 
-    dt_format = '%Y-%m-%dT%H:%M:%S.000Z'
+# gridded mode downloads each variable/depth field once, as NetCDF, and samples
+# every river mouth from it locally; otherwise each mouth is requested through WMS
+# gridded mode needs CMEMS_USER and CMEMS_PASSWORD, so keyless WMS stays the default
+GRIDDED = False
+SUBSET_DIR = os.path.join(os.getenv('DOWNLOAD_DIR'), 'cmems-subsets')
+# wms mode: requests in flight at once, attempts at each before it is written off,
+# and file listing the (hyriv_id, variable, depth) combinations written off
+WMS_MAX_PER_HOST = 10
+WMS_MAX_ATTEMPTS = 5
+DEAD_LETTER = os.path.join(os.getenv('DOWNLOAD_DIR'), 'river-mouths_dead-letter.jsonl')
+# incremental mode requests only the months after the latest already on Carto for
+# each series, and appends them; otherwise the whole series is collected and replaced
+INCREMENTAL = True
+# last month to collect; all of this run's results are kept under it
+DATE_END = series_end()
+# normalized mode stores a table of river mouths plus a narrow table of coded monthly
+# values, rather than repeating every mouth's attributes on every row
+NORMALIZED = False
+mouths_dataset_name = 'ocn_020alt_river_mouths'
+facts_dataset_name = 'ocn_020alt_chemical_concentrations_facts'
+codes_dataset_name = 'ocn_020alt_chemical_concentrations_codes'
+# parquet partitions and manifest of collected series; delete to start over
+STORE_DIR = os.path.join(os.getenv('DOWNLOAD_DIR'), 'river-mouths_results',
+        'normalized' if NORMALIZED else 'long', DATE_END)
+# columnar copy of the normalized tables
+NORMALIZED_DIR = os.path.join(os.getenv('DOWNLOAD_DIR'), 'river-mouths_normalized')
 
-    for child in root.iter('*'):
-        if(child.tag == 'FeatureInfoResponse'):
-            continue
-        if(child.tag == 'longitude'):
-            response_dict['longitude'] = float(child.text)
-        if(child.tag == 'latitude'):
-            response_dict['latitude'] = float(child.text)
-        if(child.tag == 'iIndex'):
-            response_dict['iIndex'] = int(child.text)
-        if(child.tag == 'jIndex'):
-            response_dict['jIndex'] = int(child.text)
-        if(child.tag == 'gridCentreLon'):
-            response_dict['gridCentreLon'] = float(child.text)
-        if(child.tag == 'gridCentreLat'):
-            response_dict['gridCentreLat'] = float(child.text)
-        if(child.tag == 'FeatureInfo'):
-            continue
-        if(child.tag == 'time'):
-            response_data_times.append(datetime.strptime(child.text, dt_format))
-        if(child.tag == 'value'):
-            if child.text == 'none':
-                # legitimate request, but no data available at this location (ie invalid coordinates)
-                return None
-            response_data_values.append(float(child.text));
-        # print(child.tag)
-    # resp_cols = ['longitude','latitude','gridCentreLon','gridCentreLat','dt','value']
-    df_resp = pd.DataFrame()
-    df_resp['longitude'] = [response_dict['longitude'] for i in range(len(response_data_times))]
-    df_resp['latitude'] = [response_dict['latitude'] for i in range(len(response_data_times))]
-    df_resp['gridCentreLon'] = [response_dict['gridCentreLon'] for i in range(len(response_data_times))]
-    df_resp['gridCentreLat'] = [response_dict['gridCentreLat'] for i in range(len(response_data_times))]
-    df_resp['dt'] = response_data_times
-    df_resp['value'] = response_data_values
-    return df_resp
+def series_start(hyriv_id, variable, depth):
+    '''
+    First month still to collect for a series
+    INPUT   hyriv_id: river mouth identifier (string)
+            variable: model variable (string)
+            depth: model depth (numeric)
+    RETURN  date_start: month after latest stored on Carto, or start of whole series
+                if none is stored or not in incremental mode, as YYYY-MM-DD (string)
+    '''
+    dt_latest = latest.get((str(hyriv_id), variable, float(depth)))
+    if dt_latest is None:
+        return SERIES_START
+    return next_month(dt_latest)
 
-def pull_data(row, variable, depth):
-    if row['x_valid'] is None or row['y_valid'] is None:
-        # corrected coordinates have not been set
-        # print('No valid coordinates for processed river mouth: HYRIV_ID='+hyriv_id)
-        return None
-    hyriv_id = row['hyriv_id']
-    x, y = float(row['x_valid']), float(row['y_valid'])
-    req = build_wms_request(x, y, variable, depth)
-    resp = requests.get(req)
-    df_resp = parse_response(resp)
-    if df_resp is None:
-        raise ValueError('Invalid response to supposedly valid location: HYRIV_ID='+hyriv_id)
-    df_resp['hyriv_id'] = hyriv_id
+def structure_data(df_resp, row, variable, depth):
+    '''
+    Attach river mouth attributes and request parameters to parsed time series
+    INPUT   df_resp: parsed response (DataFrame)
+            row: river mouth (Series)
+            variable: model variable (string)
+            depth: model depth (numeric)
+    RETURN  df_resp: structured data for river mouth (DataFrame)
+    '''
+    df_resp['hyriv_id'] = row['hyriv_id']
     df_resp['pfaf_id_12'] = row['pfaf_id_12']
     df_resp['hybas_id_5'] = row['hybas_id_5']
     df_resp['hybas_id_3'] = row['hybas_id_3']
@@ -157,55 +104,205 @@ def pull_data(row, variable, depth):
     df_resp = df_resp[cols_reorder]
     return df_resp
 
+def handle_cell_response(task, response):
+    '''
+    Parse time series requested once for a model grid cell and share it among all
+    river mouths in it
+    INPUT   task: request for the cell, with its 'rows' (river mouths; the first is the one
+                requested), 'variable' and 'depth'; months already stored on Carto for
+                a mouth are dropped (dictionary)
+            response: successful response to request (requests.models.Response)
+    RETURN  df_cell: structured data for every mouth in cell (DataFrame)
+    '''
+    rows = task['rows']
+    df_resp = parse_response(response)
+    if df_resp is None:
+        raise ValueError('Invalid response to supposedly valid location: HYRIV_ID='+str(rows[0]['hyriv_id']))
+    df_list = []
+    for row in rows:
+        df_row = df_resp.copy()
+        # each mouth keeps its own coordinates; the grid cell, and so the values, are shared
+        df_row['longitude'] = float(row['x_valid'])
+        df_row['latitude'] = float(row['y_valid'])
+        dt_latest = latest.get((str(row['hyriv_id']), task['variable'], float(task['depth'])))
+        if dt_latest is not None:
+            # compare dates only; normalized storage drops the time of day
+            df_row = df_row[df_row['dt'].dt.normalize() > dt_latest.normalize()]
+        df_list.append(structure_data(df_row, row, task['variable'], task['depth']))
+    return pd.concat(df_list, axis=0, ignore_index=True)
+
+def store_cell_response(task, response):
+    '''
+    Parse time series for a model grid cell and add it to the result store
+    INPUT   task, response: see handle_cell_response
+    RETURN  n_rows: number of rows stored (int)
+    '''
+    df_cell = handle_cell_response(task, response)
+    if NORMALIZED:
+        df_cell = fact_frame(df_cell, task['variable'], task['depth'])
+    store.add(df_cell, task['variable'], task['depth'])
+    return len(df_cell)
+
+def pull_gridded_data(gdf_mouths, store, done):
+    '''
+    Collect time series for every river mouth from gridded fields, one download per
+    variable and depth, sampling the nearest model cell to each mouth
+    INPUT   gdf_mouths: river mouths, with corrected coordinates in x_valid/y_valid (GeoDataFrame)
+            store: store to add each variable and depth to as it is sampled (ResultStore)
+            done: series already stored, to be skipped (set of (hyriv_id, variable, depth) tuples)
+    Only months after the latest stored on Carto for each series are kept
+    '''
+    gdf_valid = gdf_mouths[gdf_mouths['x_valid'].notnull() & gdf_mouths['y_valid'].notnull()]
+    gdf_valid = gdf_valid.reset_index(drop=True)
+    x = gdf_valid['x_valid'].astype(float).values
+    y = gdf_valid['y_valid'].astype(float).values
+    # only the part of the globe containing river mouths is needed
+    bbox = (math.floor(x.min()) - 1, math.floor(y.min()) - 1, math.ceil(x.max()) + 1, math.ceil(y.max()) + 1)
+    attr_cols = ['hyriv_id','pfaf_id_12','hybas_id_5','hybas_id_3','ord_flow','osm_name']
+    cols_reorder = ['longitude','latitude','gridCentreLon','gridCentreLat','dt','variable','depth','value',
+            'hyriv_id','pfaf_id_12','hybas_id_5','hybas_id_3','ord_flow','osm_name']
+    stored_ids = gdf_valid['hyriv_id'].astype(str)
+    for variable in variables:
+        for depth in depths:
+            starts = stored_ids.map(lambda h: series_start(h, variable, depth))
+            todo = ~stored_ids.map(lambda h: (h, variable, float(depth)) in done).values
+            todo = todo & (starts <= DATE_END).values
+            if not todo.any():
+                logger.debug('Nothing new to collect: ' + variable + ' at ' + str(depth))
+                continue
+            points = np.flatnonzero(todo)
+            # one window covering the earliest month missing from any series
+            date_start = starts[todo].min()
+            path = download_subset(variable, depth, date_start, DATE_END, SUBSET_DIR, bbox=bbox)
+            df_resp = sample_subset(path, variable, x[points], y[points])
+            # positions within sampled points, back to positions within gdf_valid
+            df_resp['point'] = points[df_resp['point'].values]
+            # drop months a series already has
+            point_starts = pd.to_datetime(starts.values[df_resp['point'].values])
+            df_resp = df_resp[(df_resp['dt'] >= point_starts).values]
+            df_invalid = df_resp[df_resp['value'].isnull()]
+            if len(df_invalid) > 0:
+                hyriv_ids = gdf_valid.loc[df_invalid['point'].unique(), 'hyriv_id']
+                logger.warning('No data at supposedly valid locations for ' + variable + ' at ' +
+                        str(depth) + ': HYRIV_ID=' + ', '.join(hyriv_ids.astype(str)))
+                df_resp = df_resp[df_resp['value'].notnull()]
+            df_attrs = gdf_valid.loc[df_resp['point'], attr_cols].reset_index(drop=True)
+            df_resp = pd.concat([df_resp.reset_index(drop=True), df_attrs], axis=1)
+            df_resp['variable'] = variable
+            df_resp['depth'] = depth
+            if NORMALIZED:
+                store.add(fact_frame(df_resp, variable, depth), variable, depth)
+            else:
+                store.add(df_resp[cols_reorder], variable, depth)
+        # each variable is safely on disk before the next is downloaded
+        store.flush()
+
 logger.debug('Pull river mouth data from Carto')
 gdf_mouths = read_carto('ocn_calcs_010_target_river_mouths')
 
-results = []
-logger.info('Initiate multithreading for WMS requests')
-# request all records for all permutations, combine into single dataframe
-with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-    args_list = []
-    args_pending = []
-    logger.info('Build request arguments')
+latest = {}
+if INCREMENTAL:
+    logger.debug('Retrieve latest month stored on Carto for each series')
+    if NORMALIZED:
+        df_latest = read_carto('SELECT hyriv_id, variable_code, depth_code, MAX(dt) AS dt FROM ' +
+                facts_dataset_name + ' GROUP BY hyriv_id, variable_code, depth_code')
+        df_latest['variable'] = [variables[int(code)] for code in df_latest['variable_code']]
+        df_latest['depth'] = [depths[int(code)] for code in df_latest['depth_code']]
+    else:
+        df_latest = read_carto('SELECT hyriv_id, variable, depth, MAX(dt) AS dt FROM ' + dataset_name +
+                ' GROUP BY hyriv_id, variable, depth')
+    dt_latest = pd.to_datetime(df_latest['dt'])
+    if dt_latest.dt.tz is not None:
+        dt_latest = dt_latest.dt.tz_convert(None)
+    latest = {(str(h), v, float(d)): dt for h, v, d, dt in zip(df_latest['hyriv_id'],
+            df_latest['variable'], df_latest['depth'], dt_latest)}
+    logger.info('{} series stored on Carto; collecting months after their latest, up to {}'.format(
+            len(latest), DATE_END))
+
+# results go straight to disk; series stored by an earlier, interrupted run are skipped
+store = ResultStore(STORE_DIR)
+done = store.completed()
+if len(done) > 0:
+    logger.info('{} series already stored in {}'.format(len(done), STORE_DIR))
+if GRIDDED:
+    logger.info('Download gridded fields and sample them at every river mouth')
+    pull_gridded_data(gdf_mouths, store, done)
+else:
+    logger.info('Build request tasks')
+    # mouths sharing a model grid cell share its values, so request each cell once
+    cells = {}
     for index, row in gdf_mouths.iterrows():
         # # manual control over looping for interrupted runs
         # if index < 0:
         #     continue
         # if index > 100:
         #     break
-        if row['x_valid'] is None or row['y_valid'] is None:
+        if pd.isna(row['x_valid']) or pd.isna(row['y_valid']):
             continue
+        cell = grid_cell(float(row['x_valid']), float(row['y_valid']))
+        cells.setdefault((int(cell[0]), int(cell[1])), []).append(row)
+    logger.info('{} river mouths fall in {} grid cells'.format(
+            sum(len(rows) for rows in cells.values()), len(cells)))
+    tasks = []
+    for rows in cells.values():
+        x, y = float(rows[0]['x_valid']), float(rows[0]['y_valid'])
         for variable in variables:
             for depth in depths:
-                args_list.append([index, row, variable, depth])
-                # if index == 0:
-                #     print([index, variable, depth])
-    args_pending = args_list.copy()
-    logger.info('Begin request submission loop')
-    while(args_pending): # if list not empty
-        args_try = args_pending.copy()
-        args_pending = []
-        logger.debug('Create Futures for outstanding requests ('+str(len(args_try))+')')
-        future_to_args = {executor.submit(pull_data, args[1], args[2], args[3]): args for args in args_try}
-        for future in concurrent.futures.as_completed(future_to_args):
-            args = future_to_args[future]
-            try:
-                results.append(future.result())
-                # print('completed', args)
-                if args[0] % 100 == 0 and args[2]==variables[-1] and args[3]==depths[-1]:
-                    print('successful request for idx#'+str(args[0])+' at '+str(datetime.now()))
-            except ConnectionError as e:
-                print(e)
-                args_pending.append(args)
-            except Exception as e:
-                print(e)
-                args_pending.append(args)
-        logger.debug('Futures completed')
-logger.info('Construct DataFrame from full set of responses')
-df_all = pd.concat([result for result in results if result is not None],
-        axis=0, ignore_index=True)
-df_all.sort_values(['hyriv_id','variable','depth','dt'],
-        axis=0, ascending=True, inplace=True, ignore_index=True)
-
-logger.info('Persist DataFrame to Carto')
-to_carto(df_all, dataset_name, if_exists='replace')
\ No newline at end of file
+                rows_todo = [row for row in rows
+                        if (str(row['hyriv_id']), variable, float(depth)) not in done
+                        and series_start(row['hyriv_id'], variable, depth) <= DATE_END]
+                if not rows_todo:
+                    continue
+                # one window covering the earliest month missing from any mouth in the cell
+                date_start = min(series_start(row['hyriv_id'], variable, depth) for row in rows_todo)
+                tasks.append({'url': build_wms_request(x, y, variable, depth, date_start, DATE_END),
+                        'rows': rows_todo, 'variable': variable, 'depth': depth,
+                        'keys': [{'hyriv_id': row['hyriv_id'], 'variable': variable, 'depth': depth}
+                                for row in rows_todo]})
+    if tasks:
+        # mouths are grouped by an assumed grid; confirm the server numbers cells the same way
+        rows = tasks[0]['rows']
+        parsed = parse_feature_info(requests.get(tasks[0]['url'], timeout=60).content)
+        if parsed is not None:
+            check_grid(parsed, float(rows[0]['x_valid']), float(rows[0]['y_valid']))
+    logger.info('Request {} time series from WMS'.format(len(tasks)))
+    # tasks that still fail after every attempt are listed here rather than retried forever
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(DEAD_LETTER)
+    client = WMSClient(max_per_host=WMS_MAX_PER_HOST, max_attempts=WMS_MAX_ATTEMPTS,
+            dead_letter=DEAD_LETTER)
+    client.run(tasks, store_cell_response)
+    if client.n_failed > 0:
+        logger.warning('{} requests failed; see {}'.format(client.n_failed, DEAD_LETTER))
+store.flush()
+
+# incremental runs only hold months not yet on Carto
+# each partition is marked in the store once uploaded, and a rerun after an
+# interrupted upload sends only those not yet marked, appending to what is there
+if_exists = 'append' if INCREMENTAL or store.uploaded() > 0 else 'replace'
+if NORMALIZED:
+    logger.info('Write normalized tables to ' + NORMALIZED_DIR)
+    os.makedirs(os.path.join(NORMALIZED_DIR, 'facts'), exist_ok=True)
+    df_mouths = mouth_frame(gdf_mouths)
+    df_mouths.to_parquet(os.path.join(NORMALIZED_DIR, 'mouths.parquet'), index=False)
+    df_codes = code_table()
+    df_codes.to_parquet(os.path.join(NORMALIZED_DIR, 'codes.parquet'), index=False)
+    logger.info('Persist river mouths and codes to Carto')
+    to_carto(df_mouths.astype({'osm_name': 'object'}), mouths_dataset_name, if_exists='replace')
+    to_carto(df_codes, codes_dataset_name, if_exists='replace')
+    logger.info('Persist stored values to Carto, one variable and depth at a time')
+    for variable, depth, df_part in store.partitions(pending=True):
+        df_part.to_parquet(os.path.join(NORMALIZED_DIR, 'facts', '{}_{:.4f}_{}.parquet'.format(
+                variable, abs(depth), DATE_END)), index=False)
+        logger.debug('Upload {} rows for {} at {}'.format(len(df_part), variable, depth))
+        to_carto(df_part, facts_dataset_name, if_exists=if_exists)
+        store.mark_uploaded(variable, depth)
+        if_exists = 'append'
+else:
+    logger.info('Persist stored results to Carto, one variable and depth at a time')
+    for variable, depth, df_part in store.partitions(pending=True):
+        logger.debug('Upload {} rows for {} at {}'.format(len(df_part), variable, depth))
+        to_carto(df_part, dataset_name, if_exists=if_exists)
+        store.mark_uploaded(variable, depth)
+        if_exists = 'append'
+store.close()
\ No newline at end of file
@@ -9,10 +9,11 @@ import requests
 import xml.etree.ElementTree as ET
 import math
 import concurrent.futures
-import zipfile
 
 import pandas as pd
 
+from hydrobasins import BasinGraph, PfafstetterIndex, assign_basins, load_attributes
+
 import os
 import sys
 
@@ -28,74 +29,87 @@ console = logging.StreamHandler()
 logger.addHandler(console)
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-logger.info('Adding level 12 basin info to processed river mouth points')
-
-# authenticate carto account 
-CARTO_USER = os.getenv('CARTO_WRI_RW_USER')
-CARTO_KEY = os.getenv('CARTO_WRI_RW_KEY')
-set_default_credentials(username=CARTO_USER,
-                        base_url="https://{user}.carto.com/".format(user=CARTO_USER),
-                        api_key=CARTO_KEY)
+def main():
+    # basins are assigned in a process pool, whose workers re-import this script on
+    # platforms that spawn them (macos, windows), so nothing runs at module level
+    logger.info('Adding level 12 basin info to processed river mouth points')
 
-# load level 12 basin dataset
-# global level 12 basin dataset has too many features--cannot be stored on carto
-# will instead be dealt with locally
-# files can be downloaded (manually) at:
-#   https://www.dropbox.com/sh/hmpwobbz9qixxpe/AACPCyoHHAQUt_HNdIbWOFF4a/HydroBASINS/standard?dl=0&subfolder_nav_tracking=1
-# approach borrowed from:
-#   https://github.com/resource-watch/data-pre-processing/blob/master/wat_068_rw0_watersheds/wat_068_rw0_watersheds_processing.py
-local_data_dir = '/mnt/c/Users/PKerins.local/data/ocean-watch/hydrosheds'
-region_ids = ['af','ar','as', 'au','eu','gr','na','sa','si']
-zip_file_template = os.path.join(local_data_dir, 'hybas_{}_lev12_v1c.zip')
-shp_file_template = os.path.join(local_data_dir, 'hybas_{}_lev12_v1c.shp')
+    # authenticate carto account 
+    CARTO_USER = os.getenv('CARTO_WRI_RW_USER')
+    CARTO_KEY = os.getenv('CARTO_WRI_RW_KEY')
+    set_default_credentials(username=CARTO_USER,
+                            base_url="https://{user}.carto.com/".format(user=CARTO_USER),
+                            api_key=CARTO_KEY)
 
-for region_id in region_ids:
-    if os.path.isfile(shp_file_template.format(region_id)):
-        continue
-    zip_file = zip_file_template.format(region_id)
-    with zipfile.ZipFile(zip_file, 'r') as zip:
-        zip.extractall(local_data_dir) 
+    # load level 12 basin dataset
+    # global level 12 basin dataset has too many features--cannot be stored on carto
+    # will instead be dealt with locally, through a columnar cache of the attributes
+    # needed, built from the hydrobasins archives on first use (see hydrobasins.py)
+    # approach borrowed from:
+    #   https://github.com/resource-watch/data-pre-processing/blob/master/wat_068_rw0_watersheds/wat_068_rw0_watersheds_processing.py
+    local_data_dir = '/mnt/c/Users/PKerins.local/data/ocean-watch/hydrosheds'
+    df_l12 = load_attributes(local_data_dir, columns=['HYBAS_ID','PFAF_ID','NEXT_DOWN','MAIN_BAS','SUB_AREA','UP_AREA'])
+    pfaf_by_hybas = pd.Series(df_l12['PFAF_ID'].values, index=df_l12['HYBAS_ID'].values)
 
-gdf_l12 = None   
-for region_id in region_ids:
-    shp_file = shp_file_template.format(region_id)
-    gdf_reg = gpd.read_file(shp_file, ignore_geometry=True)
-    if gdf_l12 is None:
-        gdf_l12 = gdf_reg
-    else:
-        gdf_l12 = gdf_l12.append(gdf_reg, ignore_index=True, verify_integrity=True, sort=False)
-gdf_l12 = gdf_l12.astype({'HYBAS_ID':'str','PFAF_ID':'str'})
+    # load processed river mouth dataset
+    gdf_mouths = read_carto('ocn_calcs_010_target_river_mouths')
+    if 'pfaf_id_12' in gdf_mouths.columns:
+        gdf_mouths.drop(columns=['pfaf_id_12','pfaf_id_5','pfaf_id_3','hybas_id_5','hybas_id_3','main_bas',
+                'catchment_area_km2'], inplace=True, errors='ignore')
 
-# load processed river mouth dataset
-gdf_mouths = read_carto('ocn_calcs_010_target_river_mouths')
-if 'pfaf_id_12' in gdf_mouths.columns:
-    gdf_mouths.drop(columns=['pfaf_id_12','pfaf_id_5','pfaf_id_3','hybas_id_5','hybas_id_3'], inplace=True, errors='ignore')
+    # look up level 12 river basin of each river mouth
+    # allows us to get the pfaf_id for each terminal river mouth level 12 basin
+    # basins are found by testing mouth points against the level 12 basin polygons locally;
+    # mouths just offshore of every basin take the nearest one within BASIN_MAX_DISTANCE degrees
+    # set ASSIGN_BASINS to False to rely only on hybas_l12 from the earth engine export
+    ASSIGN_BASINS = True
+    BASIN_MAX_DISTANCE = 0.1
+    hybas_l12 = pd.to_numeric(gdf_mouths['hybas_l12'], errors='coerce').astype('Int64')
+    if ASSIGN_BASINS:
+        df_assigned = assign_basins(local_data_dir, gdf_mouths.geometry.x.values, gdf_mouths.geometry.y.values,
+                max_distance=BASIN_MAX_DISTANCE)
+        assigned = pd.Series(df_assigned['hybas_id'].values, index=gdf_mouths.index)
+        both = assigned.notnull() & hybas_l12.notnull()
+        logger.info('Assigned level 12 basins to {} of {} river mouths ({} by nearest basin)'.format(
+                assigned.notnull().sum(), len(gdf_mouths), (df_assigned['distance'] > 0).sum()))
+        logger.info('{} assigned basins differ from hybas_l12 of export'.format((assigned[both] != hybas_l12[both]).sum()))
+        # keep exported basin where no basin is near enough
+        hybas_l12 = assigned.fillna(hybas_l12)
+        gdf_mouths['hybas_l12'] = hybas_l12.astype('string')
+    gdf_mouths['pfaf_id_12'] = hybas_l12.map(pfaf_by_hybas).astype('Int64').astype('string')
 
-# join level12 river basin data to river mouth data
-# allows us to get the pfaf_id for each terminal river mouth level 12 basin
-gdf_mouths = gdf_mouths.merge(gdf_l12, how='left', left_on='hybas_l12', right_on='HYBAS_ID', 
-        sort=False, validate='many_to_one')
-gdf_mouths.drop(columns=['HYBAS_ID', 'NEXT_DOWN',
-       'NEXT_SINK', 'MAIN_BAS', 'DIST_SINK', 'DIST_MAIN', 'SUB_AREA',
-       'UP_AREA', 'ENDO', 'COAST', 'ORDER', 'SORT'], inplace=True, errors='raise')
-gdf_mouths.rename(columns={'PFAF_ID': 'pfaf_id_12'}, inplace=True, errors='raise')
+    # use level 12 basin pfaf_id to find the corresponding basins at coarser levels,
+    # from a local index of every hydrobasins level rather than wat_068_rw0_watersheds_edit
+    # levels of basin identifiers stored for each river mouth, as hybas_id_{level}
+    basin_levels = [5, 3]
+    pfaf_index = PfafstetterIndex.load(local_data_dir)
+    df_basins = pfaf_index.lookup(gdf_mouths['pfaf_id_12'].to_numpy(), levels=basin_levels)
+    for col in df_basins.columns:
+        gdf_mouths[col] = df_basins[col].astype('string').to_numpy()
 
-# use level 12 basin pfaf_id to find the corresponding level 5 basin
-gdf_mouths['pfaf_id_5'] = gdf_mouths['pfaf_id_12'].str.slice(stop=5)
-gdf_l5 = read_carto("SELECT hybas_id::text, pfaf_id::text FROM wat_068_rw0_watersheds_edit WHERE level=5")
-gdf_mouths = gdf_mouths.merge(gdf_l5, how='left', left_on='pfaf_id_5', right_on='pfaf_id', 
-        sort=False)
-gdf_mouths.rename(columns={'hybas_id':'hybas_id_5'}, inplace=True, errors='raise')
-gdf_mouths.drop(columns=['pfaf_id'], inplace=True, errors='raise')
+    # total up per-basin attributes over the upstream catchment of each river mouth's
+    # terminal level 12 basin, following NEXT_DOWN through the drainage network in one pass
+    # optionally, CATCHMENT_ATTRIBUTE_FILE is a csv of further per-basin attributes to total,
+    # e.g. tree cover loss area, with a HYBAS_ID column; each is stored as catchment_{column}
+    CATCHMENT_ATTRIBUTE_FILE = None
+    basin_graph = BasinGraph.from_attributes(df_l12)
+    df_basin_values = df_l12.set_index('HYBAS_ID')[['SUB_AREA']]
+    if CATCHMENT_ATTRIBUTE_FILE is not None:
+        df_extra = pd.read_csv(CATCHMENT_ATTRIBUTE_FILE).set_index('HYBAS_ID')
+        df_basin_values = df_basin_values.join(df_extra, how='left').fillna(0)
+    df_catchment = basin_graph.catchment_totals(df_basin_values, hybas_l12.to_numpy())
+    gdf_mouths['main_bas'] = hybas_l12.map(df_l12.set_index('HYBAS_ID')['MAIN_BAS']).astype('Int64').astype('string')
+    gdf_mouths['catchment_area_km2'] = df_catchment['SUB_AREA'].values
+    for col in df_catchment.columns.drop('SUB_AREA'):
+        gdf_mouths['catchment_{}'.format(col.lower())] = df_catchment[col].values
+    # upstream area summed from sub-basins should match that given by hydrobasins
+    up_area = hybas_l12.map(df_l12.set_index('HYBAS_ID')['UP_AREA']).astype('float64').values
+    area_diff = (gdf_mouths['catchment_area_km2'].values - up_area) / up_area
+    logger.info('Largest difference of catchment area from hydrobasins UP_AREA: {:.2%}'.format(pd.Series(abs(area_diff)).max()))
 
-# use level 12 basin pfaf_id to find the corresponding level 3 basin
-gdf_mouths['pfaf_id_3'] = gdf_mouths['pfaf_id_12'].str.slice(stop=3)
-gdf_l3 = read_carto("SELECT hybas_id::text, pfaf_id::text FROM wat_068_rw0_watersheds_edit WHERE level=3")
-gdf_mouths = gdf_mouths.merge(gdf_l3, how='left', left_on='pfaf_id_3', right_on='pfaf_id', 
-        sort=False)
-gdf_mouths.rename(columns={'hybas_id':'hybas_id_3'}, inplace=True, errors='raise')
-gdf_mouths.drop(columns=['pfaf_id','pfaf_id_5','pfaf_id_3'], inplace=True, errors='raise')
+    # store enriched version of river mouth dataset with basin identifiers for
+    # level 12, 5, and 3 basins corresponding to river outlet, and upstream catchment totals
+    to_carto(gdf_mouths, 'ocn_calcs_010_target_river_mouths', if_exists='replace')
 
-# store enriched version of river mouth dataset with basin identifiers for
-# level 12, 5, and 3 basins corresponding to river outlet
-to_carto(gdf_mouths, 'ocn_calcs_010_target_river_mouths', if_exists='replace')
+if __name__ == '__main__':
+    main()
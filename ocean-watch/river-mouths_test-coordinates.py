@@ -4,14 +4,13 @@ from cartoframes.auth import set_default_credentials
 from cartoframes import read_carto, to_carto
 import geopandas as gpd
 from datetime import datetime
-import dateutil.relativedelta
-import requests
-import xml.etree.ElementTree as ET
-import math
-import concurrent.futures
+import json
+import time
 
 import pandas as pd
 
+from cmems import variables, depths, build_wms_request, parse_response, WMSClient
+
 import os
 import sys
 
@@ -34,142 +33,135 @@ set_default_credentials(username=CARTO_USER,
                         base_url="https://{user}.carto.com/".format(user=CARTO_USER),
                         api_key=CARTO_KEY)
 # prepare request parameters
-variables = [
-    'o2',
-    'no3',
-    'po4'
-]
-depths = [
-    -0.49402499198913574,
-    -1.5413750410079956,
-    -2.6456689834594727,
-    -3.8194949626922607,
-    -5.078224182128906,
-]
+# variables and depths are imported from cmems.py, shared by the river mouth scripts
 
-# define function for creating request
-def build_wms_request(x, y, variable, depth):
-    xmin = x-0.0
-    ymin = y-0.0
-    xmax = x+0.0000001
-    ymax = y+0.0000001
-    # make request the 16th of month before last..
-    now = datetime.utcnow()
-    dt_end = now.replace(day=16)
-    months_ago = 2 if (now.day > 16) else 3
-    dt_end = dt_end - dateutil.relativedelta.relativedelta(months=months_ago)
-    date_end = dt_end.strftime('%Y-%m-%d')
-    req_template = (
-        'https://nrt.cmems-du.eu/thredds/wms/global-analysis-forecast-bio-001-028-monthly?'
-        'SERVICE=WMS'
-        '&VERSION=1.1.1'
-        '&REQUEST=GetFeatureInfo'
-        '&QUERY_LAYERS={variable}'
-        '&BBOX={xmin},{ymin},{xmax},{ymax}'
-        '&HEIGHT=1'
-        '&WIDTH=1'
-        '&INFO_FORMAT=text/xml'
-        '&SRS=EPSG:4326'
-        '&X=0'
-        '&Y=0'
-        '&elevation={depth}'
-        '&time=2019-01-16T12:00:00.000Z/{date_end}T12:00:00.000Z'
-    )
-    return req_template.format(variable=variable, xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax, 
-        depth=depth, date_end=date_end)
+# 'sample' checks a stratified sample of river mouths, for routine health checks after
+# model updates; 'full' checks every river mouth
+AUDIT_MODE = 'sample'
+# column to stratify sample by; 'region' is the hydrobasins region, the first digit of pfaf_id_12
+STRATIFY_BY = 'ord_flow'
+SAMPLE_PER_STRATUM = 50
+SAMPLE_SEED = 0
+# requests in flight at once, and attempts at each before it counts as an error
+AUDIT_MAX_PER_HOST = 15
+AUDIT_MAX_ATTEMPTS = 3
+# reports are written as sorted JSON, so that successive audits can be diffed;
+# river mouths failing now but not in the previous report count as regressed
+AUDIT_DIR = os.path.join(os.getenv('DOWNLOAD_DIR'), 'river-mouths_audits')
+AUDIT_PREVIOUS = os.path.join(AUDIT_DIR, 'river-mouths_audit_latest.json')
 
-def parse_response(response):
+def select_mouths(gdf_mouths, mode, stratify_by, n_per_stratum, seed=0):
     '''
-    Parse content of response from GetFeatureInfo query to Copernicus WMS
-    INPUT   response: raw response object from requests library (requests.models.Response)
-    RETURN  df_resp: structured data object for response; None if unable to parse (DataFrame)
+    Choose river mouths to audit
+    INPUT   gdf_mouths: river mouths with stored valid coordinates (GeoDataFrame)
+            mode: 'sample' or 'full' (string)
+            stratify_by: column to stratify sample by, or 'region' (string)
+            n_per_stratum: maximum number of river mouths sampled from each stratum (int)
+            seed: seed of random sample (int)
+    RETURN  df: river mouths to check, with their 'stratum' (DataFrame)
     '''
-    if response.status_code != 200:
-        return None
-    root = ET.fromstring(response.content)
-    response_dict = {}
-    response_data_times = []
-    response_data_values = []
-
-    dt_format = '%Y-%m-%dT%H:%M:%S.000Z'
+    df = pd.DataFrame(gdf_mouths.drop(columns='the_geom', errors='ignore'))
+    if stratify_by == 'region':
+        df['stratum'] = df['pfaf_id_12'].astype(str).str[0]
+    else:
+        df['stratum'] = df[stratify_by].astype(str)
+    if mode == 'full':
+        return df
+    # shuffle once, then keep the first few of each stratum
+    df = df.sample(frac=1, random_state=seed)
+    return df.groupby('stratum', sort=False).head(n_per_stratum).sort_index()
 
-    for child in root.iter('*'):
-        if(child.tag == 'FeatureInfoResponse'):
-            continue
-        if(child.tag == 'longitude'):
-            response_dict['longitude'] = float(child.text)
-        if(child.tag == 'latitude'):
-            response_dict['latitude'] = float(child.text)
-        if(child.tag == 'iIndex'):
-            response_dict['iIndex'] = int(child.text)
-        if(child.tag == 'jIndex'):
-            response_dict['jIndex'] = int(child.text)
-        if(child.tag == 'gridCentreLon'):
-            response_dict['gridCentreLon'] = float(child.text)
-        if(child.tag == 'gridCentreLat'):
-            response_dict['gridCentreLat'] = float(child.text)
-        if(child.tag == 'FeatureInfo'):
-            continue
-        if(child.tag == 'time'):
-            response_data_times.append(datetime.strptime(child.text, dt_format))
-        if(child.tag == 'value'):
-            if child.text == 'none':
-                # legitimate request, but no data available at this location (ie invalid coordinates)
-                return None
-            response_data_values.append(float(child.text));
-        # print(child.tag)
-    # resp_cols = ['longitude','latitude','gridCentreLon','gridCentreLat','dt','value']
-    df_resp = pd.DataFrame()
-    df_resp['longitude'] = [response_dict['longitude'] for i in range(len(response_data_times))]
-    df_resp['latitude'] = [response_dict['latitude'] for i in range(len(response_data_times))]
-    df_resp['gridCentreLon'] = [response_dict['gridCentreLon'] for i in range(len(response_data_times))]
-    df_resp['gridCentreLat'] = [response_dict['gridCentreLat'] for i in range(len(response_data_times))]
-    df_resp['dt'] = response_data_times
-    df_resp['value'] = response_data_values
-    return df_resp
+def check_response(task, response):
+    '''
+    Record outcome of request for a stored valid point
+    INPUT   task: request, with 'hyriv_id' and 'stratum' (dictionary)
+            response: successful response to request (requests.models.Response)
+    RETURN  result: 'hyriv_id', 'stratum', 'status' ('ok' or 'invalid') and 'latency_s' (dictionary)
+    '''
+    df_resp = parse_response(response)
+    return {'hyriv_id': task['hyriv_id'], 'stratum': task['stratum'],
+            'status': 'ok' if df_resp is not None else 'invalid',
+            'latency_s': response.elapsed.total_seconds()}
 
-def pull_data(row, variable, depth):
-    if row['x_valid'] is None or row['y_valid'] is None:
-        # corrected coordinates have not been set
-        # print('No valid coordinates for processed river mouth: HYRIV_ID='+hyriv_id)
-        return None
-    hyriv_id = row['hyriv_id']
-    x, y = float(row['x_valid']), float(row['y_valid'])
-    req = build_wms_request(x, y, variable, depth)
-    resp = requests.get(req)
-    df_resp = parse_response(resp)
-    if df_resp is None:
-        raise ValueError('Invalid response to supposedly valid location: HYRIV_ID='+hyriv_id)
-    df_resp['hyriv_id'] = hyriv_id
-    df_resp['pfaf_id_12'] = row['pfaf_id_12']
-    df_resp['hybas_id_6'] = row['hybas_id_6']
-    df_resp['hybas_id_3'] = row['hybas_id_3']
-    df_resp['variable'] = variable
-    df_resp['depth'] = depth
-    cols_reorder = ['longitude','latitude','gridCentreLon','gridCentreLat','dt','variable','depth',
-            'hyriv_id','pfaf_id_12','hybas_id_6','hybas_id_3']
-    df_resp = df_resp[cols_reorder]
-    return df_resp
+def summarize(df_results, previous=None):
+    '''
+    Build audit report from outcomes of all requests
+    INPUT   df_results: one row per river mouth checked, with 'hyriv_id', 'stratum',
+                'status' ('ok', 'invalid', or 'error' if the request itself failed) and
+                'latency_s' (DataFrame)
+            previous: earlier report to compare with (dictionary)
+    RETURN  report: failure rates, latency percentiles, and river mouths checked and failing (dictionary)
+    '''
+    failed = df_results['status'] != 'ok'
+    latencies = df_results['latency_s'].dropna()
+    invalid = sorted(df_results.loc[df_results['status'] == 'invalid', 'hyriv_id'].astype(str))
+    errors = sorted(df_results.loc[df_results['status'] == 'error', 'hyriv_id'].astype(str))
+    by_stratum = {}
+    for stratum, df_stratum in df_results.groupby('stratum'):
+        by_stratum[str(stratum)] = {
+            'checked': int(len(df_stratum)),
+            'failure_rate': round(float((df_stratum['status'] != 'ok').mean()), 4),
+        }
+    report = {
+        'checked': int(len(df_results)),
+        'ok': int((~failed).sum()),
+        'invalid': len(invalid),
+        'errors': len(errors),
+        'failure_rate': round(float(failed.mean()), 4) if len(df_results) else None,
+        'latency_s': {'p{}'.format(q): round(float(latencies.quantile(q / 100)), 3)
+                for q in (50, 90, 95, 99)} if len(latencies) else None,
+        'strata': by_stratum,
+        'checked_hyriv_ids': sorted(df_results['hyriv_id'].astype(str)),
+        'invalid_hyriv_ids': invalid,
+        'error_hyriv_ids': errors,
+    }
+    if previous is None:
+        # every stored point passed when it was stored, so without an earlier report
+        # every invalid one has regressed
+        report['regressed_hyriv_ids'] = invalid
+    else:
+        # only mouths the earlier report found valid can have regressed; those it did not
+        # check, e.g. outside its sample, say nothing either way
+        previously_ok = set(previous.get('checked_hyriv_ids', [])) - \
+                set(previous['invalid_hyriv_ids']) - set(previous.get('error_hyriv_ids', []))
+        report['regressed_hyriv_ids'] = [h for h in invalid if h in previously_ok]
+    return report
 
 logger.debug('Pull river mouth data from Carto')
 gdf_mouths = read_carto('ocn_calcs_010_target_river_mouths')
+gdf_mouths = gdf_mouths[gdf_mouths['x_valid'].notnull() & gdf_mouths['y_valid'].notnull()]
+
+df_audit = select_mouths(gdf_mouths, AUDIT_MODE, STRATIFY_BY, SAMPLE_PER_STRATUM, seed=SAMPLE_SEED)
+logger.info('Audit {} of {} river mouths with stored coordinates ({} mode, by {})'.format(
+        len(df_audit), len(gdf_mouths), AUDIT_MODE, STRATIFY_BY))
+tasks = [{'url': build_wms_request(float(row['x_valid']), float(row['y_valid']), variables[-1], depths[-1]),
+        'hyriv_id': row['hyriv_id'], 'stratum': row['stratum'],
+        'keys': [{'hyriv_id': row['hyriv_id'], 'variable': variables[-1], 'depth': depths[-1]}]}
+        for index, row in df_audit.iterrows()]
+client = WMSClient(max_per_host=AUDIT_MAX_PER_HOST, max_attempts=AUDIT_MAX_ATTEMPTS)
+started = time.monotonic()
+results = client.run(tasks, check_response)
+elapsed = time.monotonic() - started
+df_results = pd.DataFrame([result if result is not None else
+        {'hyriv_id': task['hyriv_id'], 'stratum': task['stratum'], 'status': 'error', 'latency_s': None}
+        for task, result in zip(tasks, results)])
+
+previous = None
+if os.path.isfile(AUDIT_PREVIOUS):
+    with open(AUDIT_PREVIOUS, encoding='utf-8') as f:
+        previous = json.load(f)
+report = summarize(df_results, previous)
+report.update({'mode': AUDIT_MODE, 'stratify_by': STRATIFY_BY, 'population': int(len(gdf_mouths)),
+        'variable': variables[-1], 'depth': depths[-1], 'elapsed_s': round(elapsed, 1),
+        'run_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')})
+logger.info('Failure rate {} over {} river mouths; {} regressed'.format(
+        report['failure_rate'], report['checked'], len(report['regressed_hyriv_ids'])))
+for hyriv_id in report['regressed_hyriv_ids']:
+    print('Invalid response to supposedly valid location: HYRIV_ID=' + hyriv_id)
 
-results = []
-logger.info('Initiate multithreading for WMS requests')
-# request all records for all permutations, combine into single dataframe
-with concurrent.futures.ThreadPoolExecutor(max_workers=15) as executor:
-    args_list = []
-    for index, row in gdf_mouths.iterrows():
-        args_list.append([index, row, variables[-1], depths[-1]])
-    future_to_args = {executor.submit(pull_data, args[1], args[2], args[3]): args for args in args_list}
-    for future in concurrent.futures.as_completed(future_to_args):
-        args = future_to_args[future]
-        try:
-            future.result()
-            if args[0] % 100 == 0 and args[2]==variables[-1] and args[3]==depths[-1]:
-                print('completed request: idx#'+str(args[0])+': '+str(args[2])+' at -'+str(args[3])+'m')
-        except ValueError as e:
-            # print('Failed request: idx#'+str(args[0])+', ')
-            print(e)
-        except Exception as e:
-            raise e
\ No newline at end of file
+os.makedirs(AUDIT_DIR, exist_ok=True)
+report_path = os.path.join(AUDIT_DIR, 'river-mouths_audit_{}.json'.format(datetime.utcnow().strftime('%Y%m%dT%H%M%S')))
+for path in [report_path, AUDIT_PREVIOUS]:
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4, sort_keys=True)
+logger.info('Audit report written to ' + report_path)